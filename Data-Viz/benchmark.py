@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""Time every stage of the Data-Viz pipeline on a seeded synthetic data set.
+
+The stages are setup (customers where missing, its rollup triggers and dedup
+function), ingest (parallel COPY into staging tables), dedup (publishing the
+new events into customers), items (coalescing loader and product lookup),
+fusion (batched item fusion), fetch, aggregation, and rendering with a cold
+and a warm render cache. Each stage records its wall time, rows and the peak
+RSS of this process; results are written as JSON tagged with the git commit.
+
+The benchmark REPLACES the contents of customers and items, so it only runs
+against a separate database given with --database, or against the configured
+one with an explicit --replace-data. Extract, render and product caches go to
+a scratch directory, removed at the end, so every run starts cold.
+
+    python benchmark.py (--database NAME | --replace-data) [--rows 1M|10M|50M|N] [--seed S]
+                        [--workers N] [--output FILE]
+    python benchmark.py --compare OLD.json NEW.json
+"""
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+WORKSPACE_DIR = os.path.dirname(os.path.abspath(__file__))
+WAREHOUSE_DIR = os.path.join(os.path.dirname(WORKSPACE_DIR), 'Warehouse')
+RESULTS_DIR = os.path.join(WORKSPACE_DIR, '.cache', 'benchmarks')
+FUSION_SQL = os.path.join(WAREHOUSE_DIR, 'ex03', 'fusion_batched.sql')
+# the layout of setup_database.sh --partitioned: customers with its rollup
+# triggers and the insert_new_customers function that publish relies on
+PARTITIONED_SQL = os.path.join(WAREHOUSE_DIR, 'ex01', 'customers_partitioned.sql')
+CUSTOMERS_SQL = [
+    os.path.join(WAREHOUSE_DIR, 'ex01', 'rollups.sql'),
+    os.path.join(WAREHOUSE_DIR, 'ex02', 'incremental_dedup.sql')
+]
+
+# caches are read from the environment on import, point them at a scratch directory first
+SCRATCH_DIR = tempfile.mkdtemp(prefix='dataviz-benchmark-')
+for variable, name in [('DATAVIZ_CACHE_DIR', 'extracts'), ('DATAVIZ_RENDER_CACHE_DIR', 'renders'),
+                       ('DATAVIZ_PRODUCT_DIR', 'products')]:
+    os.environ[variable] = os.path.join(SCRATCH_DIR, name)
+
+import dashboard
+from dashboard import pie, mustache, Building, elbow, Clustering
+from sklearn.preprocessing import StandardScaler
+from common.bulk_load import POOL_MAX_CONN, publish, stage_file
+from common import db
+from common.db import connection, fetch_rows
+from common.items import build_product_dimension, read_items, revenue_by_brand, save_product_dimension, store_items
+from common.schema import fetch_typed
+from common.synthetic import DEFAULT_SEED, ensure_generated, parse_size
+
+
+def _reset_peak_rss():
+    """Restart the peak RSS of this process from its current RSS (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    """Peak RSS of this process since the last reset, or since it started."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def _children_peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+@contextmanager
+def stage(results, name):
+    """Time a stage; the body may set record['rows']."""
+    record = {'stage': name, 'rows': None}
+    _reset_peak_rss()
+    start = time.perf_counter()
+    yield record
+    record['seconds'] = round(time.perf_counter() - start, 4)
+    record['peak_rss_mb'] = round(_peak_rss_mb(), 1)
+    results.append(record)
+    rows = f"{record['rows']:>12,}" if record['rows'] is not None else f"{'':>12}"
+    print(f"[benchmark] {name:<28} {record['seconds']:9.2f}s {rows} rows {record['peak_rss_mb']:9.1f} MB")
+
+
+def _git(*args):
+    try:
+        return subprocess.run(['git', *args], cwd=WORKSPACE_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def ensure_schema():
+    """Create customers where it is missing and (re)install its triggers and functions."""
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('customers') IS NULL")
+            if cursor.fetchone()[0]:
+                with open(PARTITIONED_SQL) as f:
+                    cursor.execute(f.read())
+            # CREATE OR REPLACE and DROP ... IF EXISTS throughout, safe to run again
+            for path in CUSTOMERS_SQL:
+                with open(path) as f:
+                    cursor.execute(f.read())
+
+
+def run(rows, seed=DEFAULT_SEED, workers=None):
+    """Run every stage once and return the list of stage records."""
+    results = []
+
+    with stage(results, 'generate') as record:
+        paths, item_path = ensure_generated(rows, seed)
+        record['rows'] = rows
+
+    with stage(results, 'setup'):
+        ensure_schema()
+
+    with stage(results, 'ingest') as record:
+        with ThreadPoolExecutor(max_workers=min(len(paths), POOL_MAX_CONN)) as executor:
+            loads = list(executor.map(stage_file, paths))
+        record['rows'] = sum(load['rows'] for load in loads)
+        record['megabytes'] = round(sum(load['bytes'] for load in loads) / 1024 ** 2, 1)
+
+    with stage(results, 'dedup') as record:
+        record['rows'] = publish([load['table'] for load in loads], truncate=True)
+
+    with stage(results, 'items') as record:
+        items = read_items(item_path)
+        store_items(items)
+        save_product_dimension(build_product_dimension(items))
+        record['rows'] = len(items)
+
+    with stage(results, 'fusion') as record:
+        with connection() as conn:
+            # the procedure commits every batch, which needs autocommit
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("DROP TABLE IF EXISTS customers_fusion_batches")
+                    with open(FUSION_SQL) as f:
+                        cursor.execute(f.read())
+                    cursor.execute("CALL fuse_customers_batches()")
+                    cursor.execute("SELECT SUM(updated_rows) FROM customers_fusion_batches")
+                    record['rows'] = int(cursor.fetchone()[0] or 0)
+            finally:
+                conn.autocommit = False
+
+    datasets = {}
+    with stage(results, 'fetch/event_types') as record:
+        datasets['event_types'] = pie.get_event_type_distribution()
+        record['rows'] = len(datasets['event_types'] or [])
+    with stage(results, 'fetch/priced_purchases') as record:
+        priced = mustache.get_purchase_data()
+        record['rows'] = len(priced)
+    with stage(results, 'fetch/purchases') as record:
+        # fetched directly, the extract cache already holds the rows mustache asked for
+        purchases = fetch_typed(Building.PURCHASE_QUERY)
+        datasets['purchases'] = purchases
+        datasets['priced_purchases'] = purchases.dropna(subset=['price'])
+        record['rows'] = len(purchases)
+    with stage(results, 'fetch/customers') as record:
+        customers = elbow.get_customer_data()
+        record['rows'] = len(customers)
+    with stage(results, 'fetch/rfm') as record:
+        rfm = Clustering.get_customer_data()
+        record['rows'] = len(rfm)
+
+    with stage(results, 'aggregate/price_statistics') as record:
+        record['rows'] = int(mustache.price_statistics()['count'])
+    with stage(results, 'aggregate/brand_revenue') as record:
+        record['rows'] = int(revenue_by_brand()['purchases'].sum())
+    with stage(results, 'aggregate/k_sweep') as record:
+        sweep = elbow.sweep_k(StandardScaler().fit_transform(customers[elbow.FEATURES]))
+        datasets['customers'] = customers
+        datasets['k_sweep'] = sweep
+        datasets['cluster_count'] = sweep['elbow'] or elbow.DEFAULT_CLUSTER_COUNT
+        record['rows'] = len(customers)
+    with stage(results, 'aggregate/rfm_clusters') as record:
+        clustered, labels = Clustering.prepare_and_cluster_data(rfm)
+        datasets['segment_summary'] = Clustering.summarize_clusters(clustered)
+        datasets['segment_labels'] = labels
+        record['rows'] = len(rfm)
+
+    for name in ['render', 'render/cached']:
+        with stage(results, name) as record:
+            timings = dashboard.render_all(datasets, workers)
+            record['rows'] = len(timings)
+            record['charts'] = {chart: round(seconds, 4) for chart, seconds in timings.items()}
+            record['children_peak_rss_mb'] = round(_children_peak_rss_mb(), 1)
+
+    return results
+
+
+def compare(old_path, new_path):
+    """Print the stages of two result files side by side."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{'stage':<28} {old['commit'] or 'old':>12} {new['commit'] or 'new':>12} {'ratio':>7} "
+          f"{'MB old':>9} {'MB new':>9}")
+    before = {record['stage']: record for record in old['stages']}
+    for record in new['stages']:
+        previous = before.get(record['stage'])
+        if previous is None:
+            print(f"{record['stage']:<28} {'':>12} {record['seconds']:11.2f}s")
+            continue
+        ratio = record['seconds'] / previous['seconds'] if previous['seconds'] else float('nan')
+        print(f"{record['stage']:<28} {previous['seconds']:11.2f}s {record['seconds']:11.2f}s {ratio:7.2f} "
+              f"{previous['peak_rss_mb']:9.1f} {record['peak_rss_mb']:9.1f}")
+    if old['rows'] != new['rows']:
+        print(f"Warning: the runs used different sizes ({old['rows']} and {new['rows']} rows).")
+
+
+def main():
+    try:
+        _main(sys.argv[1:])
+    finally:
+        shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+
+
+def _main(args):
+    if '--compare' in args:
+        index = args.index('--compare')
+        compare(args[index + 1], args[index + 2])
+        return
+
+    options = {'--rows': '1M', '--seed': str(DEFAULT_SEED), '--workers': None, '--output': None,
+               '--database': None}
+    for option in options:
+        if option in args:
+            options[option] = args[args.index(option) + 1]
+    if options['--database']:
+        # read when the pool is first created, nothing has connected yet
+        db.DB_NAME = options['--database']
+    elif '--replace-data' not in args:
+        print(f"The benchmark replaces customers and items. Pass --database NAME to run it against "
+              f"another database, or --replace-data to replace them in {db.DB_NAME}.")
+        sys.exit(2)
+    rows, seed = parse_size(options['--rows']), int(options['--seed'])
+    workers = int(options['--workers']) if options['--workers'] else None
+
+    started = datetime.now()
+    stages = run(rows, seed, workers)
+    commit = _git('rev-parse', '--short', 'HEAD')
+    result = {
+        'commit': commit,
+        'dirty': bool(_git('status', '--porcelain', '--untracked-files=no')),
+        'started': started.isoformat(timespec='seconds'),
+        'rows': rows,
+        'seed': seed,
+        'database': db.DB_NAME,
+        'customers': fetch_rows("SELECT COUNT(*) FROM customers")[0][0],
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'stages': stages
+    }
+
+    output = options['--output'] or os.path.join(
+        RESULTS_DIR, f"{options['--rows']}_{commit or 'nogit'}_{started:%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"\nTotal {sum(record['seconds'] for record in stages):.2f}s, results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Shared helpers for the Data-Viz exercises."""
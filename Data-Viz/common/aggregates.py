@@ -0,0 +1,214 @@
+"""Declarative chart aggregates, compiled to server-side SQL or computed locally.
+
+A chart declares the aggregate it needs with `aggregate()` and calls `evaluate()`
+with either the SQL of the rows it is built from (pushdown, only the aggregated
+rows cross the wire), a `rollup_source()` (read from the maintained rollup
+tables of Warehouse/ex01/rollups.sql) or an already loaded DataFrame (local
+fallback).
+"""
+import numpy as np
+import pandas as pd
+
+from common.db import fetch_frame, fetch_rows
+from common.schema import exact_prices
+from common.trace import span
+
+TIME_BUCKETS = ('day', 'month')
+MEASURES = ('count', 'sum', 'mean', 'users')
+
+ROLLUP_MEASURES = {
+    'count': "SUM(event_count)",
+    'sum': "SUM(price_sum)",
+    'mean': "SUM(price_sum) / NULLIF(SUM(price_count), 0)",
+}
+
+# sums and means are rounded so the exact NUMERIC arithmetic of the database and
+# the float arithmetic of pandas give identical values and land in the same bins
+VALUE_DECIMALS = 6
+
+
+def aggregate(measure, column=None, bucket=None, per=None, bins=None, quantiles=None, time_column='event_time'):
+    """Describe an aggregate, e.g. daily count, monthly sum or per-user sum histogram."""
+    if quantiles is not None:
+        if column is None:
+            raise ValueError("quantiles need a column")
+        return {'kind': 'quantiles', 'column': column, 'quantiles': list(quantiles)}
+    if measure not in MEASURES:
+        raise ValueError(f"unknown measure: {measure}")
+    if measure == 'users':
+        column = column or 'user_id'
+    if measure != 'count' and column is None:
+        raise ValueError(f"measure '{measure}' needs a column")
+    if bucket is not None:
+        if bucket not in TIME_BUCKETS:
+            raise ValueError(f"unknown time bucket: {bucket}")
+        return {'kind': 'time', 'measure': measure, 'column': column,
+                'bucket': bucket, 'time_column': time_column}
+    if per is not None and bins is not None:
+        return {'kind': 'histogram', 'measure': measure, 'column': column,
+                'per': per, 'bins': [float(edge) for edge in bins]}
+    raise ValueError("an aggregate needs a time bucket, per-key bins or quantiles")
+
+
+def _measure_sql(measure, column):
+    if measure == 'count':
+        return "COUNT(*)"
+    if measure == 'sum':
+        return f"SUM({column})"
+    if measure == 'users':
+        return f"COUNT(DISTINCT {column})"
+    return f"AVG({column})"
+
+
+def rollup_source(event_type, first_day, last_day):
+    """Describe the rows of one event type between two days, both included, as read from the rollups."""
+    return {'rollup': True, 'event_type': event_type, 'first_day': first_day, 'last_day': last_day}
+
+
+def compile_sql(spec, source):
+    """Compile an aggregate over the rows of `source` into a single SQL query."""
+    if spec['kind'] == 'time':
+        return f"""
+            SELECT date_trunc('{spec['bucket']}', {spec['time_column']}) AS bucket,
+                   {_measure_sql(spec['measure'], spec['column'])} AS value
+            FROM ({source}) AS source
+            GROUP BY 1
+            ORDER BY 1
+        """
+
+    if spec['kind'] == 'histogram':
+        bins = spec['bins']
+        edges = ", ".join(repr(edge) for edge in bins)
+        per_key = f"COALESCE({_measure_sql(spec['measure'], spec['column'])}, 0)"
+        # np.histogram closes the last bin on the right, width_bucket does not
+        return f"""
+            SELECT bin, COUNT(*) AS value
+            FROM (
+                SELECT CASE WHEN v = {bins[-1]!r} THEN {len(bins) - 1}
+                            ELSE width_bucket(v, ARRAY[{edges}]::float8[]) END AS bin
+                FROM (
+                    SELECT ROUND({per_key}::numeric, {VALUE_DECIMALS})::float8 AS v
+                    FROM ({source}) AS source
+                    GROUP BY {spec['per']}
+                ) AS per_key
+            ) AS binned
+            WHERE bin BETWEEN 1 AND {len(bins) - 1}
+            GROUP BY bin
+            ORDER BY bin
+        """
+
+    quantiles = ", ".join(repr(float(q)) for q in spec['quantiles'])
+    return f"""
+        SELECT unnest(ARRAY[{quantiles}]) AS q,
+               unnest(percentile_cont(ARRAY[{quantiles}]) WITHIN GROUP (ORDER BY {spec['column']})) AS value
+        FROM ({source}) AS source
+    """
+
+
+def compile_rollup_sql(spec):
+    """Compile a time-bucketed aggregate to a query over the daily rollup tables."""
+    if spec['kind'] != 'time':
+        raise ValueError("only time-bucketed aggregates can be read from the rollups")
+    bucket = f"date_trunc('{spec['bucket']}', day::timestamp)"
+    where = "event_type = %(event_type)s AND day BETWEEN %(first_day)s AND %(last_day)s"
+
+    if spec['measure'] == 'users':
+        return f"""
+            SELECT bucket, hll_estimate(COUNT(*), SUM(power(2.0, -rank))) AS value
+            FROM (
+                SELECT {bucket} AS bucket, register, MAX(rank) AS rank
+                FROM customers_daily_users
+                WHERE {where}
+                GROUP BY 1, 2
+            ) AS merged
+            GROUP BY 1
+            ORDER BY 1
+        """
+    if spec['column'] not in (None, 'price'):
+        raise ValueError(f"the rollups do not hold column '{spec['column']}'")
+    return f"""
+        SELECT {bucket} AS bucket, {ROLLUP_MEASURES[spec['measure']]} AS value
+        FROM customers_daily_rollup
+        WHERE {where}
+        GROUP BY 1
+        ORDER BY 1
+    """
+
+
+def _finish(spec, result):
+    """Shape a pushdown result like the local computation."""
+    if spec['kind'] == 'time':
+        return pd.Series(np.round(result['value'].to_numpy(dtype=float), VALUE_DECIMALS),
+                         index=pd.DatetimeIndex(result['bucket'], name='bucket'), name='value')
+    if spec['kind'] == 'histogram':
+        bins = spec['bins']
+        counts = np.zeros(len(bins) - 1, dtype=np.int64)
+        counts[result['bin'].to_numpy(dtype=int) - 1] = result['value'].to_numpy(dtype=np.int64)
+        return pd.Series(counts, index=pd.Index(bins[:-1], name='bin'), name='value')
+    return pd.Series(result['value'].to_numpy(dtype=float),
+                     index=pd.Index(spec['quantiles'], name='q'), name='value')
+
+
+def _measured(df, column):
+    """Return the frame with a compact float32 column widened for exact sums and means."""
+    if column in df.columns and df[column].dtype == np.float32:
+        df = df.assign(**{column: exact_prices(df[column])})
+    return df
+
+
+def compute_local(spec, df):
+    """Compute an aggregate from raw rows with the same semantics as the SQL path."""
+    if spec['kind'] != 'quantiles' and spec['measure'] in ('sum', 'mean'):
+        df = _measured(df, spec['column'])
+    if spec['kind'] == 'time':
+        times = pd.to_datetime(df[spec['time_column']])
+        if spec['bucket'] == 'day':
+            keys = times.dt.floor('D')
+        else:
+            keys = times.dt.to_period('M').dt.to_timestamp()
+        grouped = df.groupby(keys.rename('bucket'))
+        if spec['measure'] == 'count':
+            values = grouped.size()
+        elif spec['measure'] == 'sum':
+            values = grouped[spec['column']].sum()
+        elif spec['measure'] == 'users':
+            values = grouped[spec['column']].nunique()
+        else:
+            values = grouped[spec['column']].mean()
+        return pd.Series(np.round(values.to_numpy(dtype=float), VALUE_DECIMALS),
+                         index=pd.DatetimeIndex(values.index, name='bucket').as_unit('ns'), name='value')
+
+    if spec['kind'] == 'histogram':
+        grouped = df.groupby(spec['per'])
+        if spec['measure'] == 'count':
+            per_key = grouped.size()
+        elif spec['measure'] == 'sum':
+            per_key = grouped[spec['column']].sum()
+        elif spec['measure'] == 'users':
+            per_key = grouped[spec['column']].nunique()
+        else:
+            per_key = grouped[spec['column']].mean().fillna(0)
+        values = np.round(per_key.to_numpy(dtype=float), VALUE_DECIMALS)
+        counts = np.histogram(values, bins=spec['bins'])[0]
+        return pd.Series(counts.astype(np.int64), index=pd.Index(spec['bins'][:-1], name='bin'), name='value')
+
+    values = df[spec['column']].dropna().to_numpy(dtype=float)
+    if df[spec['column']].dtype == np.float32:
+        values = exact_prices(values)
+    return pd.Series(np.quantile(values, spec['quantiles']),
+                     index=pd.Index(spec['quantiles'], name='q'), name='value')
+
+
+def evaluate(spec, source):
+    """Evaluate an aggregate on a DataFrame locally, from the rollups, or push it down for a SQL source."""
+    name = f"{spec['kind']} {spec.get('measure', '')}".strip()
+    if isinstance(source, pd.DataFrame):
+        with span('aggregate', f"{name} (local)", rows=len(source)):
+            return compute_local(spec, source)
+    if isinstance(source, dict):
+        with span('aggregate', f"{name} (rollup)"):
+            rows = fetch_rows(compile_rollup_sql(spec), source)
+            result = pd.DataFrame(rows, columns=['bucket', 'value']).astype({'value': float})
+            return _finish(spec, result)
+    with span('aggregate', f"{name} (pushdown)"):
+        return _finish(spec, fetch_frame(compile_sql(spec, source)))
@@ -0,0 +1,156 @@
+"""Parallel bulk load of the monthly customer CSVs.
+
+Every file is copied over its own pooled connection into an UNLOGGED staging
+table, then the staging tables are published into customers in one transaction
+and dropped. Publishing goes through insert_new_customers() from
+Warehouse/ex02/incremental_dedup.sql, which only inserts events not already
+loaded; --no-dedup inserts every staged row in a single statement instead.
+
+Run `python -m common.bulk_load [--truncate] [--workers N] [--window SECONDS]
+[--no-dedup] [file.csv ...]` from Data-Viz; without files, the five monthly CSVs
+of CUSTOMER_CSV_DIR are loaded.
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2 import sql
+
+from common.db import POOL_MAX_CONN, connection
+
+CUSTOMER_CSV_DIR = os.environ.get(
+    "DATAVIZ_CSV_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "subject", "customer")
+)
+CUSTOMER_FILES = [
+    "data_2022_oct.csv",
+    "data_2022_nov.csv",
+    "data_2022_dec.csv",
+    "data_2023_jan.csv",
+    "data_2023_feb.csv"
+]
+CUSTOMER_COLUMNS = ['event_time', 'event_type', 'product_id', 'price', 'user_id', 'user_session']
+
+# read size handed to COPY FROM STDIN
+COPY_READ_BYTES = 8 * 1024 * 1024
+
+STAGING_TABLE_SQL = """
+    CREATE UNLOGGED TABLE {table} (
+        event_time TIMESTAMP,
+        event_type VARCHAR(255),
+        product_id INTEGER,
+        price DECIMAL,
+        user_id INTEGER,
+        user_session VARCHAR(255)
+    )
+"""
+
+
+def staging_table(path):
+    """Name of the staging table of a CSV file, e.g. customers_stage_data_2022_oct."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return "customers_stage_" + "".join(c if c.isalnum() else "_" for c in stem.lower())
+
+
+def stage_file(path):
+    """COPY one CSV into a fresh UNLOGGED staging table and return its load statistics."""
+    table = sql.Identifier(staging_table(path))
+    columns = sql.SQL(", ").join(map(sql.Identifier, CUSTOMER_COLUMNS))
+    start = time.perf_counter()
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL("DROP TABLE IF EXISTS {table}").format(table=table))
+            cursor.execute(sql.SQL(STAGING_TABLE_SQL).format(table=table))
+            with open(path, 'rb') as f:
+                cursor.copy_expert(
+                    sql.SQL("COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, HEADER true)")
+                    .format(table=table, columns=columns).as_string(conn),
+                    f,
+                    size=COPY_READ_BYTES
+                )
+            rows = cursor.rowcount
+    seconds = time.perf_counter() - start
+    return {
+        'file': os.path.basename(path),
+        'table': staging_table(path),
+        'rows': rows,
+        'bytes': os.path.getsize(path),
+        'seconds': seconds
+    }
+
+
+def publish(tables, truncate=False, dedup=True, window_seconds=0):
+    """Move every staging table into customers in one transaction and drop them."""
+    if dedup:
+        return _publish_new_events(tables, truncate, window_seconds)
+
+    columns = sql.SQL(", ").join(map(sql.Identifier, CUSTOMER_COLUMNS))
+    union = sql.SQL(" UNION ALL ").join(
+        sql.SQL("SELECT {columns} FROM {table}").format(columns=columns, table=sql.Identifier(table))
+        for table in tables
+    )
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            if truncate:
+                cursor.execute("TRUNCATE TABLE customers")
+            cursor.execute(sql.SQL("INSERT INTO customers ({columns}) {union}").format(columns=columns, union=union))
+            rows = cursor.rowcount
+            for table in tables:
+                cursor.execute(sql.SQL("DROP TABLE {table}").format(table=sql.Identifier(table)))
+    return rows
+
+
+def _publish_new_events(tables, truncate, window_seconds):
+    # each table is checked against customers including the tables published
+    # before it, so an event repeated across two files is kept once
+    rows = 0
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            if truncate:
+                cursor.execute("TRUNCATE TABLE customers")
+            for table in tables:
+                cursor.execute("SELECT insert_new_customers(%s::regclass, %s)", (table, window_seconds))
+                rows += cursor.fetchone()[0]
+                cursor.execute(sql.SQL("DROP TABLE {table}").format(table=sql.Identifier(table)))
+    return rows
+
+
+def bulk_load(paths, workers=None, truncate=False, dedup=True, window_seconds=0):
+    """Stage the CSV files concurrently, then publish them into customers at once."""
+    # one pooled connection per concurrent COPY
+    workers = min(workers or len(paths), len(paths), POOL_MAX_CONN)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        loads = list(executor.map(stage_file, paths))
+    staged_seconds = time.perf_counter() - start
+
+    for load in loads:
+        print(f"{load['file']}: {load['rows']} rows in {load['seconds']:.2f}s "
+              f"({load['rows'] / load['seconds']:,.0f} rows/s, "
+              f"{load['bytes'] / 1024 ** 2 / load['seconds']:.1f} MB/s)")
+
+    start = time.perf_counter()
+    rows = publish([load['table'] for load in loads], truncate, dedup, window_seconds)
+    published_seconds = time.perf_counter() - start
+
+    total_bytes = sum(load['bytes'] for load in loads)
+    staged_rows = sum(load['rows'] for load in loads)
+    print(f"Staged {len(loads)} files ({total_bytes / 1024 ** 2:.1f} MB) in {staged_seconds:.2f}s "
+          f"over {workers} connections, inserted {rows} rows into customers in {published_seconds:.2f}s "
+          f"({staged_rows - rows} duplicates skipped).")
+    return loads
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    truncate = '--truncate' in args
+    dedup = '--no-dedup' not in args
+    options = {'--workers': None, '--window': 0}
+    for option in options:
+        if option in args:
+            options[option] = int(args[args.index(option) + 1])
+            del args[args.index(option):args.index(option) + 2]
+    files = [arg for arg in args if not arg.startswith('--')]
+    bulk_load(files or [os.path.join(CUSTOMER_CSV_DIR, name) for name in CUSTOMER_FILES],
+              options['--workers'], truncate, dedup, options['--window'])
@@ -0,0 +1,177 @@
+"""On-disk columnar cache of query extracts, invalidated by a table fingerprint."""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from common.db import fetch_frame, fetch_rows
+from common.trace import span
+
+CACHE_DIR = os.environ.get(
+    "DATAVIZ_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "extracts")
+)
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# catalog lookups only: a TRUNCATE changes the filenode, appends grow the relation
+# and the cumulative statistics count every inserted, updated or deleted row.
+# A partitioned table holds no rows itself, so each of its partitions is included.
+FINGERPRINT_QUERY = """
+    WITH roots AS (
+        SELECT oid, relkind
+        FROM pg_class
+        WHERE relname = ANY(%s) AND relkind IN ('r', 'p', 'm')
+    ),
+    members AS (
+        SELECT oid FROM roots
+        UNION
+        SELECT tree.relid
+        FROM roots, pg_partition_tree(roots.oid) AS tree
+        WHERE roots.relkind = 'p'
+    )
+    SELECT c.relname,
+           pg_relation_filenode(c.oid),
+           pg_relation_size(c.oid),
+           COALESCE(s.n_tup_ins, 0),
+           COALESCE(s.n_tup_upd, 0),
+           COALESCE(s.n_tup_del, 0)
+    FROM members m
+    JOIN pg_class c ON c.oid = m.oid
+    LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+    ORDER BY c.relname
+"""
+
+
+def table_fingerprint(tables):
+    """Return a cheap fingerprint that changes whenever one of the tables changes."""
+    rows = fetch_rows(FINGERPRINT_QUERY, (list(tables),))
+    return [[str(value) for value in row] for row in rows]
+
+
+def cache_key(query, read_csv_kwargs=None):
+    """Hash the normalized SQL text together with the parse options."""
+    normalized = " ".join(query.split())
+    options = json.dumps(read_csv_kwargs or {}, sort_keys=True, default=str)
+    return hashlib.sha256(f"{normalized}\n{options}".encode()).hexdigest()
+
+
+def _is_plain_array(dtype):
+    return isinstance(dtype, np.dtype) and dtype.kind in "biufcmM"
+
+
+def _store_entry(entry_dir, df, fingerprint):
+    """Write every column as its own .npy file next to a meta.json."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=CACHE_DIR, prefix=".tmp-")
+    try:
+        columns = []
+        for i, name in enumerate(df.columns):
+            column = df[name]
+            base = os.path.join(tmp_dir, f"col{i}")
+            if _is_plain_array(column.dtype):
+                np.save(base + ".npy", column.to_numpy())
+                kind = "array"
+            else:
+                codes, uniques = pd.factorize(column)
+                np.save(base + ".npy", codes.astype(np.int32))
+                np.save(base + ".uniques.npy", np.asarray(uniques), allow_pickle=True)
+                kind = "category" if isinstance(column.dtype, pd.CategoricalDtype) else "object"
+            columns.append({"name": name, "kind": kind})
+
+        meta = {"fingerprint": fingerprint, "rows": len(df), "columns": columns}
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def _load_entry(entry_dir, fingerprint):
+    """Map a cached extract back into a DataFrame, or return None if missing or stale."""
+    meta_path = os.path.join(entry_dir, "meta.json")
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if meta["fingerprint"] != fingerprint:
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        return None
+
+    data = {}
+    for i, column in enumerate(meta["columns"]):
+        base = os.path.join(entry_dir, f"col{i}")
+        values = np.load(base + ".npy", mmap_mode="r")
+        if column["kind"] != "array":
+            uniques = np.load(base + ".uniques.npy", allow_pickle=True)
+            values = pd.Categorical.from_codes(np.asarray(values), categories=uniques)
+            if column["kind"] == "object":
+                values = np.asarray(values, dtype=object)
+        data[column["name"]] = values
+
+    # touching the metadata marks the entry as recently used for LRU eviction
+    os.utime(meta_path)
+    return pd.DataFrame(data, copy=False)
+
+
+def _entry_size(entry_dir):
+    return sum(entry.stat().st_size for entry in os.scandir(entry_dir) if entry.is_file())
+
+
+def evict(max_bytes=CACHE_MAX_BYTES, cache_dir=None, marker="meta.json"):
+    """Remove least recently used entries until the cache fits in max_bytes.
+
+    Each entry is a directory of cache_dir (the extract cache by default), last
+    used when its marker file, or the directory itself if marker is None, was
+    last modified.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for entry in os.scandir(cache_dir):
+        # .tmp- directories are entries still being written
+        if not entry.is_dir() or entry.name.startswith("."):
+            continue
+        stamp = entry.path if marker is None else os.path.join(entry.path, marker)
+        if os.path.exists(stamp):
+            entries.append((os.path.getmtime(stamp), _entry_size(entry.path), entry.path))
+
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    # the most recent entry is always kept, even if it alone exceeds the cap
+    for _, size, path in entries[:-1]:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def cached_fetch(query, tables=("customers",), loader=fetch_frame, **read_csv_kwargs):
+    """Return a query extract from the cache, loading and storing it on a miss."""
+    options = dict(read_csv_kwargs, loader=f"{loader.__module__}.{loader.__qualname__}")
+    entry_dir = os.path.join(CACHE_DIR, cache_key(query, options))
+    fingerprint = table_fingerprint(tables)
+
+    with span('transfer', 'extract cache') as stage:
+        df = _load_entry(entry_dir, fingerprint)
+        stage.rows = len(df) if df is not None else 0
+    if df is not None:
+        print(f"Loaded {len(df)} rows from the extract cache.")
+        return df
+
+    df = loader(query, **read_csv_kwargs)
+    try:
+        _store_entry(entry_dir, df, fingerprint)
+        evict()
+    except OSError as e:
+        print(f"Could not write extract cache: {e}")
+    return df
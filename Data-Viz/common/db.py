@@ -0,0 +1,260 @@
+"""Pooled PostgreSQL access shared by the Data-Viz exercises."""
+import atexit
+import os
+import queue
+import threading
+import uuid
+from contextlib import contextmanager
+from tempfile import SpooledTemporaryFile
+
+import pandas as pd
+from psycopg2 import pool
+
+from common.binary_copy import CHUNK_BYTES, BinarySink, describe, unsupported_columns
+from common.trace import span
+
+DB_NAME = "piscineds"
+DB_USER = "jaehwkim"
+DB_PASSWORD = "mysecretpassword"
+DB_HOST = "localhost"
+DB_PORT = "5432"
+
+POOL_MIN_CONN = 1
+POOL_MAX_CONN = 4
+
+# COPY output is kept in memory up to this size, then spilled to a temp file
+COPY_BUFFER_BYTES = 64 * 1024 * 1024
+
+CHUNK_ROWS = 50000
+
+_pool = None
+_pool_pid = None
+# concurrent first uses (e.g. common.fanout threads) must create a single pool
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the connection pool of the current process, creating it on first use."""
+    global _pool, _pool_pid
+    with _pool_lock:
+        # a pool inherited through fork shares sockets with the parent, never reuse it
+        if _pool is None or _pool.closed or _pool_pid != os.getpid():
+            with span('connect', 'pool'):
+                _pool = pool.ThreadedConnectionPool(
+                    POOL_MIN_CONN,
+                    POOL_MAX_CONN,
+                    dbname=DB_NAME,
+                    user=DB_USER,
+                    password=DB_PASSWORD,
+                    host=DB_HOST,
+                    port=DB_PORT
+                )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def close_pool():
+    """Close every connection held by the pool of the current process."""
+    global _pool
+    if _pool is not None and not _pool.closed and _pool_pid == os.getpid():
+        _pool.closeall()
+    _pool = None
+
+
+def _reset_pool_lock():
+    global _pool_lock
+    # the lock may have been held by another thread of the parent at fork time
+    _pool_lock = threading.Lock()
+
+
+atexit.register(close_pool)
+os.register_at_fork(after_in_child=_reset_pool_lock)
+
+
+@contextmanager
+def connection():
+    """Borrow a pooled connection and hand it back when done."""
+    db_pool = get_pool()
+    with span('connect', 'getconn'):
+        conn = db_pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        db_pool.putconn(conn, close=bool(conn.closed))
+
+
+def fetch_rows(query, params=None):
+    """Run a query and return all result rows as tuples."""
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            with span('query', 'fetch_rows') as stage:
+                cursor.execute(query, params)
+                rows = cursor.fetchall()
+                stage.rows = len(rows)
+            return rows
+
+
+class _Cancelled(Exception):
+    """Raised inside a COPY of iter_frames whose consumer went away."""
+
+
+_DONE = object()
+
+
+def iter_frames(query, chunk_rows=CHUNK_ROWS):
+    """Yield the result of a query as DataFrames of at most chunk_rows rows.
+
+    The rows come through binary COPY, decoded chunk by chunk while the query
+    streams (see fetch_frame for the column types), so only a few chunks are
+    in memory at once. copy_expert pushes the output into a file, it runs in
+    a thread feeding a short queue; a consumer that stops early cancels the
+    query. Results with a type the decoder does not know are read through a
+    server-side cursor instead.
+    """
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            with span('query', 'describe'):
+                columns = describe(cursor, query)
+        fallback = unsupported_columns(columns)
+        if fallback:
+            print(f"No binary decoder for {', '.join(fallback)}, fetching through a cursor.")
+            yield from _iter_records(conn, query, chunk_rows)
+            return
+
+        frames = queue.Queue(maxsize=2)
+        stop = threading.Event()
+
+        def deliver(decoded, rows):
+            if not rows:
+                return
+            frame = pd.DataFrame(decoded, copy=False)
+            # blocks while the consumer is two chunks behind
+            while not stop.is_set():
+                try:
+                    frames.put(frame, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+            raise _Cancelled()
+
+        def produce():
+            try:
+                with conn.cursor() as cursor:
+                    sink = BinarySink(columns, chunk_bytes=CHUNK_BYTES, on_chunk=deliver, chunk_rows=chunk_rows)
+                    with span('transfer', 'iter_frames') as stage:
+                        cursor.copy_expert(f"COPY ({query}) TO STDOUT (FORMAT binary)", sink)
+                        sink.flush()
+                        stage.rows = sink.rows
+                        stage.annotate(bytes=sink.bytes)
+                result = _DONE
+            except BaseException as error:
+                result = error
+            while not stop.is_set():
+                try:
+                    frames.put(result, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        producer = threading.Thread(target=produce, name='iter_frames', daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = frames.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            if producer.is_alive():
+                # a COPY left behind would be drained by the next query on this
+                # connection, the cancelled transaction is rolled back instead
+                conn.cancel()
+            stop.set()
+            producer.join()
+
+
+def _iter_records(conn, query, chunk_rows):
+    """DataFrames of at most chunk_rows rows of a query, read through a server-side cursor."""
+    with conn.cursor(name=f"chunks_{uuid.uuid4().hex}") as cursor:
+        cursor.itersize = chunk_rows
+        with span('query', 'iter_frames'):
+            cursor.execute(query)
+        columns = None
+        while True:
+            with span('transfer', 'iter_frames') as stage:
+                rows = cursor.fetchmany(chunk_rows)
+                stage.rows = len(rows)
+            if not rows:
+                break
+            if columns is None:
+                columns = [column.name for column in cursor.description]
+            with span('parse', 'iter_frames', rows=len(rows)):
+                frame = pd.DataFrame.from_records(rows, columns=columns)
+            yield frame
+
+
+def copy_query(query, buffer_bytes=COPY_BUFFER_BYTES):
+    """Stream `COPY (query) TO STDOUT` as CSV into a bounded buffer, rewound for reading.
+
+    Only used by fetch_frame for result types the binary decoder does not know.
+    """
+    buffer = SpooledTemporaryFile(max_size=buffer_bytes, mode='w+b')
+    try:
+        with connection() as conn:
+            with conn.cursor() as cursor:
+                # COPY runs the query while streaming it, its time counts as transfer
+                with span('transfer', 'copy') as stage:
+                    cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", buffer)
+                    stage.rows = cursor.rowcount
+                    stage.annotate(bytes=buffer.tell())
+    except Exception:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
+
+
+def _cast(df, dtype):
+    for name, column_dtype in (dtype or {}).items():
+        # str asks read_csv to keep text for a later parse, the binary decoder needs none
+        if name in df.columns and column_dtype is not str:
+            df[name] = df[name].astype(column_dtype)
+    return df
+
+
+def fetch_frame(query, dtype=None, **read_csv_kwargs):
+    """Fetch the result of a query into a DataFrame through binary COPY.
+
+    Columns come out in their decoded types (integers, floats, datetime64 and
+    timedelta64, UUID halves, strings) and dtype casts them further. Results
+    with a type the decoder does not know are fetched as CSV instead, parsed by
+    read_csv with dtype and the other options.
+    """
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            with span('query', 'describe'):
+                columns = describe(cursor, query)
+            fallback = unsupported_columns(columns)
+            if not fallback:
+                sink = BinarySink(columns)
+                # the rows are decoded in frame(), as a nested parse span
+                with span('transfer', 'binary copy') as stage:
+                    cursor.copy_expert(f"COPY ({query}) TO STDOUT (FORMAT binary)", sink)
+                    df = sink.frame()
+                    stage.rows = sink.rows
+                    stage.annotate(bytes=sink.bytes)
+                return _cast(df, dtype)
+
+    print(f"No binary decoder for {', '.join(fallback)}, fetching as CSV.")
+    with copy_query(query) as buffer:
+        with span('parse', 'read_csv') as stage:
+            df = pd.read_csv(buffer, dtype=dtype, **read_csv_kwargs)
+            stage.rows = len(df)
+        return df
@@ -0,0 +1,173 @@
+"""Item dimension: duplicate product rows merged field by field, and a dense
+product lookup persisted as memory-mapped arrays.
+
+Run `python -m common.items [item.csv]` from Data-Viz to load the merged items
+into PostgreSQL and rebuild the product lookup, or `python -m common.items
+--brands` for the purchase revenue per brand joined through the lookup.
+"""
+import io
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from common.db import connection, iter_frames
+
+ITEM_CSV = os.environ.get(
+    "DATAVIZ_ITEM_CSV",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "subject", "item", "item.csv")
+)
+PRODUCT_DIR = os.environ.get(
+    "DATAVIZ_PRODUCT_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "products")
+)
+
+ITEM_DTYPES = {
+    'product_id': 'Int64',
+    'category_id': 'Int64',
+    'category_code': 'string',
+    'brand': 'string'
+}
+# dictionary-encoded columns of the product lookup
+ENCODED_COLUMNS = ('category_code', 'brand')
+MISSING_CODE = -1
+UNKNOWN_BRAND = "unknown"
+
+PURCHASE_PRODUCTS_QUERY = """
+    SELECT product_id, price
+    FROM customers
+    WHERE event_type = 'purchase' AND price IS NOT NULL
+"""
+
+ITEMS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS items (
+        product_id INTEGER PRIMARY KEY,
+        category_id BIGINT,
+        category_code VARCHAR(255),
+        brand VARCHAR(255)
+    )
+"""
+
+
+def coalesce_items(df):
+    """Merge the rows of each product, keeping every non-null field.
+
+    When two rows disagree on a non-null value the largest one is kept, the
+    same rule as the MAX() aggregates of Warehouse/ex03/items.sql.
+    """
+    df = df.dropna(subset=['product_id'])
+    return df.groupby('product_id', sort=True).max().reset_index()
+
+
+def read_items(path=ITEM_CSV):
+    """Read item.csv and merge duplicate products."""
+    return coalesce_items(pd.read_csv(path, dtype=ITEM_DTYPES))
+
+
+def store_items(items):
+    """Replace the contents of the items table with merged items through COPY."""
+    buffer = io.StringIO()
+    items[list(ITEM_DTYPES)].to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(ITEMS_TABLE_SQL)
+            cursor.execute("TRUNCATE TABLE items")
+            cursor.copy_expert("COPY items (product_id, category_id, category_code, brand) FROM STDIN WITH CSV", buffer)
+            cursor.execute("ANALYZE items")
+
+
+def build_product_dimension(items):
+    """Dense arrays indexed by product_id, with category and brand as dictionary codes."""
+    product_ids = items['product_id'].to_numpy(dtype=np.int64)
+    size = int(product_ids.max()) + 1 if len(product_ids) else 0
+
+    known = np.zeros(size, dtype=bool)
+    known[product_ids] = True
+    # category_id is an integer array, a null category is marked in has_category
+    has_category = np.zeros(size, dtype=bool)
+    has_category[product_ids] = items['category_id'].notna().to_numpy()
+    category_id = np.zeros(size, dtype=np.int64)
+    category_id[product_ids] = items['category_id'].fillna(0).to_numpy(dtype=np.int64)
+
+    dimension = {'known': known, 'has_category': has_category, 'category_id': category_id}
+    for name in ENCODED_COLUMNS:
+        codes, uniques = pd.factorize(items[name], sort=True)
+        dense = np.full(size, MISSING_CODE, dtype=np.int32)
+        dense[product_ids] = codes
+        dimension[f'{name}_codes'] = dense
+        dimension[f'{name}_values'] = [str(value) for value in uniques]
+    return dimension
+
+
+def save_product_dimension(dimension, path=PRODUCT_DIR):
+    """Write every array as its own .npy file and the dictionaries as JSON."""
+    os.makedirs(path, exist_ok=True)
+    dictionaries = {}
+    for name, values in dimension.items():
+        if isinstance(values, np.ndarray):
+            np.save(os.path.join(path, f"{name}.npy"), values)
+        else:
+            dictionaries[name] = values
+    with open(os.path.join(path, "dictionaries.json"), "w") as f:
+        json.dump(dictionaries, f)
+
+
+def load_product_dimension(path=PRODUCT_DIR):
+    """Map the product lookup back into memory without reading the arrays."""
+    with open(os.path.join(path, "dictionaries.json")) as f:
+        dimension = json.load(f)
+    for entry in os.scandir(path):
+        if entry.name.endswith(".npy"):
+            dimension[entry.name[:-4]] = np.load(entry.path, mmap_mode="r")
+    return dimension
+
+
+def join_products(df, dimension, column='product_id'):
+    """Add category_id, category_code and brand to each event by array indexing."""
+    product_ids = df[column].to_numpy()
+    valid = ~pd.isna(product_ids)
+    ids = np.where(valid, product_ids, 0).astype(np.int64)
+    valid &= (ids >= 0) & (ids < len(dimension['known']))
+    ids[~valid] = 0
+    valid &= np.asarray(dimension['known'])[ids]
+
+    result = df.copy()
+    result['category_id'] = pd.array(np.asarray(dimension['category_id'])[ids], dtype='Int64')
+    result.loc[~(valid & np.asarray(dimension['has_category'])[ids]), 'category_id'] = pd.NA
+    for name in ENCODED_COLUMNS:
+        codes = np.where(valid, np.asarray(dimension[f'{name}_codes'])[ids], MISSING_CODE)
+        result[name] = pd.Categorical.from_codes(codes, categories=dimension[f'{name}_values'])
+    return result
+
+
+def revenue_by_brand(dimension=None, query=PURCHASE_PRODUCTS_QUERY):
+    """Purchases and revenue per brand, the events streamed and joined to the product lookup."""
+    dimension = load_product_dimension() if dimension is None else dimension
+    totals = None
+    for chunk in iter_frames(query):
+        chunk = join_products(chunk, dimension)
+        chunk['brand'] = chunk['brand'].cat.add_categories([UNKNOWN_BRAND]).fillna(UNKNOWN_BRAND)
+        partial = chunk.groupby('brand', observed=True)['price'].agg(['count', 'sum'])
+        totals = partial if totals is None else totals.add(partial, fill_value=0)
+    if totals is None:
+        return pd.DataFrame({'purchases': pd.Series(dtype='int64'), 'revenue': pd.Series(dtype='float64')})
+    totals = totals.rename(columns={'count': 'purchases', 'sum': 'revenue'})
+    totals['purchases'] = totals['purchases'].astype('int64')
+    totals['revenue'] = totals['revenue'].astype('float64').round(2)
+    totals.index = totals.index.astype(str)
+    return totals.sort_values('revenue', ascending=False)
+
+
+if __name__ == "__main__":
+    if '--brands' in sys.argv:
+        print(revenue_by_brand().head(20).to_string())
+        sys.exit(0)
+    path = sys.argv[1] if len(sys.argv) > 1 else ITEM_CSV
+    items = read_items(path)
+    store_items(items)
+    save_product_dimension(build_product_dimension(items))
+    print(f"Loaded {len(items)} products into items and the product lookup in {PRODUCT_DIR}.")
+    print(items[['category_id', 'category_code', 'brand']].notna().sum().to_string())
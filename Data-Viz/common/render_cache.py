@@ -0,0 +1,162 @@
+"""Content-addressed cache of rendered charts.
+
+A drawing function decorated with cached_render is keyed by a fingerprint of
+its (already aggregated) arguments, the matplotlib rcParams and its own name
+and source, so a chart drawn by its own script and by dashboard.py shares one
+entry. Only the files a call actually wrote are stored.
+When the key was rendered before, the stored PNG is copied into place instead
+of running matplotlib again. Least recently used renders are evicted once the
+cache grows past RENDER_CACHE_MAX_BYTES.
+"""
+import filecmp
+import functools
+import hashlib
+import inspect
+import os
+import shutil
+import tempfile
+
+import matplotlib
+import numpy as np
+import pandas as pd
+
+from common.cache import evict
+from common.trace import span
+
+RENDER_CACHE_DIR = os.environ.get(
+    "DATAVIZ_RENDER_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "renders")
+)
+RENDER_CACHE_MAX_BYTES = 512 * 1024 ** 2
+
+# settings that do not change the pixels of a saved figure
+IGNORED_RCPARAMS = ('backend', 'backend_fallback', 'interactive', 'webagg.port', 'webagg.open_in_browser')
+
+
+def _update(digest, value):
+    """Feed a value into the hash, arrays and frames by content."""
+    if isinstance(value, pd.DataFrame):
+        digest.update(b"frame")
+        _update(digest, value.index)
+        for name in value.columns:
+            _update(digest, name)
+            _update(digest, value[name])
+    elif isinstance(value, (pd.Series, pd.Index)):
+        digest.update(f"{type(value).__name__}:{value.name!r}".encode())
+        if isinstance(value, pd.Series):
+            _update(digest, value.index)
+        _update(digest, value.to_numpy())
+    elif isinstance(value, np.ndarray):
+        digest.update(f"array:{value.dtype.str}:{value.shape}".encode())
+        if value.dtype.kind == 'O':
+            for item in value.ravel():
+                _update(digest, item)
+        else:
+            digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        digest.update(f"dict:{len(value)}".encode())
+        for key in sorted(value, key=repr):
+            _update(digest, key)
+            _update(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(f"{type(value).__name__}:{len(value)}".encode())
+        for item in value:
+            _update(digest, item)
+    else:
+        digest.update(f"{type(value).__name__}:{value!r}".encode())
+
+
+def style_fingerprint():
+    """Hash of the matplotlib version and every rcParam that affects the output."""
+    digest = hashlib.sha256(matplotlib.__version__.encode())
+    for key in sorted(matplotlib.rcParams):
+        if key not in IGNORED_RCPARAMS:
+            digest.update(f"{key}={matplotlib.rcParams[key]!r}\n".encode())
+    return digest.hexdigest()
+
+
+def render_key(function, args, kwargs, outputs):
+    """Key a render by the drawing function's source, its inputs and the style."""
+    # not the module, which is __main__ when the exercise script runs by itself
+    digest = hashlib.sha256(f"{function.__qualname__}\n".encode())
+    digest.update(inspect.getsource(function).encode())
+    digest.update(style_fingerprint().encode())
+    _update(digest, [os.path.basename(path) for path in outputs])
+    _update(digest, list(args))
+    _update(digest, kwargs)
+    return digest.hexdigest()
+
+
+def _restore(entry_dir, outputs):
+    """Put the cached files in place; return False if any of them is missing."""
+    stored = [os.path.join(entry_dir, os.path.basename(path)) for path in outputs]
+    if not all(os.path.exists(path) for path in stored):
+        return False
+    for cached, path in zip(stored, outputs):
+        # an identical file already in place is left untouched
+        if not (os.path.exists(path) and filecmp.cmp(cached, path, shallow=False)):
+            shutil.copyfile(cached, path)
+    # touching the entry marks it as recently used for LRU eviction
+    os.utime(entry_dir)
+    return True
+
+
+def _stamp(path):
+    """What changes when a file is written again, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def _store(entry_dir, outputs):
+    os.makedirs(RENDER_CACHE_DIR, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=RENDER_CACHE_DIR, prefix=".tmp-")
+    try:
+        for path in outputs:
+            shutil.copyfile(path, os.path.join(tmp_dir, os.path.basename(path)))
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def cached_render(*outputs, output_arg=None):
+    """Decorate a drawing function that saves the given files (or the file named by output_arg)."""
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            paths = list(outputs)
+            if output_arg is not None:
+                paths.append(signature.bind(*args, **kwargs).arguments[output_arg])
+
+            with span('render', f"{function.__name__} (cache lookup)"):
+                entry_dir = os.path.join(RENDER_CACHE_DIR, render_key(function, args, kwargs, paths))
+                try:
+                    restored = _restore(entry_dir, paths)
+                except OSError:
+                    # evicted by another process while being copied, render it again
+                    restored = False
+            if restored:
+                print(f"{', '.join(paths)} unchanged, reused the cached render.")
+                return None
+
+            before = [_stamp(path) for path in paths]
+            with span('render', function.__name__):
+                result = function(*args, **kwargs)
+            # a function may return without saving (e.g. no data), never cache a file left from an earlier run
+            after = [_stamp(path) for path in paths]
+            if any(stamp is None or stamp == previous for stamp, previous in zip(after, before)):
+                return result
+            try:
+                _store(entry_dir, paths)
+                evict(RENDER_CACHE_MAX_BYTES, RENDER_CACHE_DIR, marker=None)
+            except OSError as e:
+                print(f"Could not write render cache: {e}")
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,223 @@
+"""Per-user RFM and activity features computed in process from raw events.
+
+The events are streamed as (user_id, event_time, purchase, price) chunks by
+iter_frames, never held or cached whole. Each chunk is reduced to one partial
+row per user with vectorized reductions over factorized user codes: counts and
+sums with np.bincount, first and last visits with np.minimum.at /
+np.maximum.at on integer seconds. Distinct active days and months are kept as
+unique (user, day) and (user, month) keys. Partials are merged with the same
+reductions once they outgrow COMPACT_ROWS, so memory follows the number of
+users, not of events.
+
+Recency is measured from the fixed REFERENCE_DATE, the end of the loaded period,
+so the features of the same data are always the same and charts drawn from
+them can be cached.
+
+Run `python -m common.rfm` from Data-Viz to compare with the features of the
+equivalent SQL aggregate.
+"""
+import os
+import resource
+import time
+
+import numpy as np
+import pandas as pd
+
+from common.db import fetch_rows, iter_frames
+from common.schema import exact_prices
+from common.trace import span
+
+# the day after the last loaded month, the events run from 2022-10-01 to 2023-02-28
+REFERENCE_DATE = os.environ.get("DATAVIZ_RFM_REFERENCE_DATE", "2023-03-01")
+
+# purchase as a boolean, the event types themselves are never needed
+EVENTS_QUERY = """
+    SELECT user_id, event_time, COALESCE(event_type = 'purchase', false) AS purchase, price
+    FROM customers
+    WHERE user_id IS NOT NULL AND event_time IS NOT NULL
+"""
+CHUNK_ROWS = 200000
+# pending partial rows merged into one row per user past this size
+COMPACT_ROWS = 1000000
+
+SECONDS_PER_DAY = 86400
+# (user, day or month) keys: user_id * BUCKET_SPAN + bucket + BUCKET_OFFSET
+BUCKET_SPAN = 1 << 21
+BUCKET_OFFSET = 1 << 20
+
+
+def _reduce(user_ids, counts, first, last, purchases, spent):
+    """One row per distinct user_id, sorted, of partial counts, extremes and sums."""
+    codes, users = pd.factorize(user_ids, sort=True)
+    size = len(users)
+    first_visit = np.full(size, np.iinfo(np.int64).max)
+    np.minimum.at(first_visit, codes, first)
+    last_visit = np.full(size, np.iinfo(np.int64).min)
+    np.maximum.at(last_visit, codes, last)
+    return {
+        'user_id': np.asarray(users, dtype=np.int64),
+        'counts': np.bincount(codes, weights=counts, minlength=size).astype(np.int64),
+        'first': first_visit,
+        'last': last_visit,
+        'purchases': np.bincount(codes, weights=purchases, minlength=size).astype(np.int64),
+        'spent': np.bincount(codes, weights=spent, minlength=size)
+    }
+
+
+def _distinct_per_user(keys, user_ids):
+    """Number of distinct (user, bucket) keys of each of the sorted user_ids."""
+    counts = np.zeros(len(user_ids), dtype=np.int64)
+    if keys:
+        owners, per_owner = np.unique(keys[0] // BUCKET_SPAN, return_counts=True)
+        counts[np.searchsorted(user_ids, owners)] = per_owner
+    return counts
+
+
+def _concat(parts):
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+
+class FeatureAccumulator:
+    """Running per-user aggregates of event chunks, turned into features at the end."""
+
+    def __init__(self):
+        self.partials = []
+        self.pending = 0
+        self.day_keys = []
+        self.month_keys = []
+        self.rows = 0
+
+    def add(self, events):
+        """Fold a frame of (user_id, event_time, purchase, price) events into the aggregates."""
+        if not len(events):
+            return
+        user_ids = events['user_id'].to_numpy().astype(np.int64)
+        event_time = events['event_time'].to_numpy().astype('datetime64[s]')
+        seconds = event_time.astype(np.int64)
+        purchases = events['purchase'].to_numpy().astype(bool)
+        spent = np.where(purchases, np.nan_to_num(exact_prices(events['price'].to_numpy())), 0.0)
+
+        self.partials.append(_reduce(user_ids, np.ones(len(user_ids)), seconds, seconds, purchases, spent))
+        self.pending += len(self.partials[-1]['user_id'])
+        keys = user_ids * BUCKET_SPAN + BUCKET_OFFSET
+        self.day_keys.append(np.unique(keys + seconds // SECONDS_PER_DAY))
+        self.month_keys.append(np.unique(keys + event_time.astype('datetime64[M]').astype(np.int64)))
+        self.rows += len(events)
+        if self.pending > COMPACT_ROWS:
+            self.compact()
+
+    def compact(self):
+        """Merge the pending partials and distinct keys into one set per user."""
+        if len(self.partials) > 1:
+            merged = _concat(self.partials)
+            self.partials = [_reduce(merged['user_id'], merged['counts'], merged['first'], merged['last'],
+                                     merged['purchases'], merged['spent'])]
+        self.pending = sum(len(part['user_id']) for part in self.partials)
+        for keys in (self.day_keys, self.month_keys):
+            if len(keys) > 1:
+                keys[:] = [np.unique(np.concatenate(keys))]
+
+    def features(self, reference=REFERENCE_DATE):
+        """One row per user, ordered by user_id (see compute_features)."""
+        self.compact()
+        totals = self.partials[0] if self.partials else _reduce(np.zeros(0, dtype=np.int64), *[np.zeros(0)] * 5)
+        user_ids = totals['user_id']
+        visit_count, purchase_count = totals['counts'], totals['purchases']
+        first_visit, last_visit = totals['first'], totals['last']
+        total_spent = np.round(totals['spent'], 2)
+        days_active = _distinct_per_user(self.day_keys, user_ids)
+        active_months = _distinct_per_user(self.month_keys, user_ids)
+
+        recency = np.datetime64(reference, 's').astype(np.int64) - last_visit
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bought = purchase_count > 0
+            df = pd.DataFrame({
+                'user_id': user_ids,
+                'visit_count': visit_count,
+                'days_active': days_active,
+                'time_span': (last_visit - first_visit).astype('timedelta64[s]'),
+                'last_visit': last_visit.astype('datetime64[s]'),
+                'first_visit': first_visit.astype('datetime64[s]'),
+                'recency': recency.astype('timedelta64[s]'),
+                'purchase_count': purchase_count,
+                'total_spent': total_spent,
+                'active_months': active_months,
+                'avg_daily_visits': visit_count / np.maximum(days_active, 1),
+                'avg_purchase_value': np.where(bought, total_spent / purchase_count, 0.0),
+                'visits_per_purchase': np.where(bought, visit_count / purchase_count, 0.0)
+            })
+        # whole days, like the day part of the interval CURRENT_TIMESTAMP - MAX(event_time)
+        df['recency_days'] = recency // SECONDS_PER_DAY
+        df['frequency'] = df['purchase_count']
+        df['monetary'] = df['total_spent']
+        return df
+
+
+def compute_features(events, reference=REFERENCE_DATE):
+    """One row per user of an events frame, ordered by user_id.
+
+    The columns are those of the former SQL customer_metrics query (visit_count,
+    days_active, time_span, last_visit, first_visit, recency, purchase_count,
+    total_spent, active_months and the ratios), plus recency_days, frequency
+    and monetary for the RFM clustering.
+    """
+    with span('aggregate', 'rfm features', rows=len(events)):
+        accumulator = FeatureAccumulator()
+        accumulator.add(events)
+        return accumulator.features(reference)
+
+
+def peak_rss_bytes():
+    """Return the peak resident set size of this process."""
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def customer_features(reference=REFERENCE_DATE, chunk_rows=CHUNK_ROWS):
+    """RFM and activity features of every user in customers, from the events streamed in chunks."""
+    accumulator = FeatureAccumulator()
+    for chunk in iter_frames(EVENTS_QUERY, chunk_rows):
+        with span('aggregate', 'rfm chunk', rows=len(chunk)):
+            accumulator.add(chunk)
+    with span('aggregate', 'rfm features', rows=accumulator.rows):
+        df = accumulator.features(reference)
+    print(f"Aggregated {accumulator.rows} events into {len(df)} users "
+          f"(process peak RSS {peak_rss_bytes() / 1024 ** 2:.1f} MB).")
+    return df
+
+
+# the same features in SQL, kept for the comparison below
+SQL_FEATURES_QUERY = f"""
+    SELECT user_id,
+           COUNT(*),
+           COUNT(DISTINCT event_time::date),
+           COUNT(DISTINCT date_trunc('month', event_time)),
+           SUM(CASE WHEN event_type = 'purchase' THEN 1 ELSE 0 END),
+           COALESCE(SUM(CASE WHEN event_type = 'purchase' THEN price END), 0),
+           EXTRACT(DAY FROM TIMESTAMP '{REFERENCE_DATE}' - MAX(event_time))
+    FROM customers
+    WHERE user_id IS NOT NULL AND event_time IS NOT NULL
+    GROUP BY user_id
+    ORDER BY user_id
+"""
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    features = customer_features()
+    engine_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rows = fetch_rows(SQL_FEATURES_QUERY)
+    sql_seconds = time.perf_counter() - start
+
+    expected = pd.DataFrame(rows, columns=['user_id', 'visit_count', 'days_active', 'active_months',
+                                           'purchase_count', 'total_spent', 'recency_days'])
+    columns = list(expected.columns)
+    mismatches = {
+        name: int((~np.isclose(features[name].to_numpy(dtype=float), expected[name].to_numpy(dtype=float))).sum())
+        for name in columns
+    } if len(expected) == len(features) else None
+    print(f"Feature engine: {len(features)} users in {engine_seconds:.2f}s "
+          f"(reference date {REFERENCE_DATE}); SQL aggregate: {len(expected)} users in {sql_seconds:.2f}s.")
+    print("Mismatching users per column:", mismatches if mismatches is not None else "different user counts")
@@ -0,0 +1,117 @@
+"""Compact in-memory schema for the columns of the customers table.
+
+Run `python -m common.schema` from Data-Viz to compare the memory and parse
+time of the purchase extract loaded with pandas defaults and with this schema.
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from common.db import fetch_frame
+from common.trace import span
+
+CUSTOMERS_DTYPES = {
+    'event_type': 'category',
+    'product_id': 'int32',
+    'price': 'float32',
+    'user_id': 'int32'
+}
+
+# timestamps come out of PostgreSQL in one fixed format, no inference needed
+TIMESTAMP_COLUMNS = ('event_time',)
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+TIMESTAMP_DTYPE = 'datetime64[s]'
+
+# a UUID is kept as two uint64 halves (16 bytes) instead of a 36-character string
+UUID_COLUMNS = ('user_session',)
+
+# price is an unconstrained DECIMAL in the warehouse, but the loaded prices have
+# at most two decimals (MAX(scale(price)) = 2); below 2**24 cents (167,772.16)
+# float32 keeps them to the cent, and exact_prices rounds them back
+PRICE_DECIMALS = 2
+
+
+def dtypes_for(columns):
+    """Return the compact dtypes of the given customers columns."""
+    return {name: CUSTOMERS_DTYPES[name] for name in columns if name in CUSTOMERS_DTYPES}
+
+
+def read_csv_options():
+    """read_csv keyword arguments that load customers columns in their compact types."""
+    dtype = dict(CUSTOMERS_DTYPES)
+    for name in TIMESTAMP_COLUMNS + UUID_COLUMNS:
+        dtype[name] = str
+    return {'dtype': dtype}
+
+
+def parse_timestamps(values):
+    """Parse fixed-format timestamps into second-resolution datetimes."""
+    return pd.to_datetime(values, format=TIMESTAMP_FORMAT).astype(TIMESTAMP_DTYPE)
+
+
+def parse_uuids(values):
+    """Split UUID strings into (high, low) uint64 halves, NULL or malformed as zero."""
+    strings = pd.Series(values, dtype=object).fillna('0' * 32)
+    # fast path: the whole column is decoded as one hex string
+    hex_digits = ''.join(strings).replace('-', '')
+    try:
+        raw = bytes.fromhex(hex_digits)
+        if len(raw) != 16 * len(strings):
+            raise ValueError("malformed UUID")
+    except (TypeError, ValueError):
+        hex_digits = strings.astype(str).str.replace('-', '', regex=False)
+        valid = hex_digits.str.fullmatch('[0-9a-fA-F]{32}').to_numpy(dtype=bool)
+        raw = bytes.fromhex(''.join(hex_digits.where(valid, '0' * 32)))
+    halves = np.frombuffer(raw, dtype='>u8').reshape(-1, 2)
+    return halves[:, 0].astype(np.uint64), halves[:, 1].astype(np.uint64)
+
+
+def exact_prices(values):
+    """Widen float32 prices to float64 rounded to the cent, for sums and means."""
+    return np.round(np.asarray(values, dtype=np.float64), PRICE_DECIMALS)
+
+
+def apply_schema(df):
+    """Convert the timestamp and UUID columns of a freshly loaded frame in place."""
+    with span('parse', 'apply_schema', rows=len(df)):
+        for name in TIMESTAMP_COLUMNS:
+            if name in df.columns:
+                df[name] = parse_timestamps(df[name])
+        for name in UUID_COLUMNS:
+            if name in df.columns:
+                high, low = parse_uuids(df.pop(name))
+                df[f'{name}_hi'] = high
+                df[f'{name}_lo'] = low
+    return df
+
+
+def fetch_typed(query):
+    """Fetch a query over customers columns into a compactly typed DataFrame."""
+    return apply_schema(fetch_frame(query, **read_csv_options()))
+
+
+def memory_report(frames):
+    """Print the deep memory usage of each column for several versions of a frame."""
+    usage = pd.DataFrame({
+        label: df.memory_usage(deep=True, index=False) for label, df in frames.items()
+    })
+    usage.loc['total'] = usage.sum()
+    print((usage / 1024 ** 2).round(2).rename(columns=lambda label: f"{label} (MB)"))
+    return usage
+
+
+if __name__ == "__main__":
+    query = "SELECT * FROM customers WHERE event_time BETWEEN '2022-10-01' AND '2023-02-28 23:59:59'"
+
+    start = time.perf_counter()
+    default = fetch_frame(query)
+    default['event_time'] = pd.to_datetime(default['event_time'])
+    default_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compact = fetch_typed(query)
+    compact_seconds = time.perf_counter() - start
+
+    memory_report({'default': default, 'compact': compact})
+    print(f"\nLoad and parse: default {default_seconds:.2f}s, compact {compact_seconds:.2f}s")
@@ -0,0 +1,455 @@
+"""Persisted customer segmentation, scored incrementally as new events arrive.
+
+A fitted segmentation (scaler mean and scale, KMeans centroids, segment names
+and the cluster statistics at fit time) is saved as an immutable version under
+MODEL_DIR/v<N>/. The RFM inputs of every user (last visit, purchase count and
+spend) and the cluster assigned to them are kept in the customer_segments table.
+
+An update folds the events after the watermark (the last event folded in) into
+customer_segments with one upsert, which returns the RFM values of that day's
+active users only. They are assigned to their nearest centroid in batches of
+SCORE_BATCH_ROWS, and the per-cluster counts and sums are adjusted by their
+old and new contributions, so an update costs time in the active users, not in
+all users. The table is rebuilt from customers only when customers was
+truncated or had rows deleted; the model is refit only on request, or when
+the clusters drift from the fitted ones by more than CENTROID_DRIFT (in
+standard deviations of the features) or SHARE_DRIFT (share of the users).
+
+Recency counts whole days before the reference date, the day after the
+watermark, kept in the state and in every model version. As the watermark
+advances, the stored recency sums move by the same number of days for every
+user; users without new events keep their cluster until a full rescoring or a
+refit, but their aging counts in the drift.
+
+Events are folded in by event_time: events loaded later with older timestamps
+are only counted after a rebuild (`python -m common.segments --rebuild`).
+"""
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from common.cache import table_fingerprint
+from common.db import connection, fetch_frame, fetch_rows
+from common.trace import span
+
+MODEL_DIR = os.environ.get(
+    "DATAVIZ_MODEL_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "models", "segments")
+)
+
+FEATURES = ['recency_days', 'frequency', 'monetary']
+SCORE_BATCH_ROWS = 65536
+CENTROID_DRIFT = 0.5
+SHARE_DRIFT = 0.05
+
+SEGMENTS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS customer_segments (
+        user_id INTEGER PRIMARY KEY,
+        last_visit TIMESTAMP NOT NULL,
+        purchase_count BIGINT NOT NULL,
+        total_spent NUMERIC NOT NULL,
+        cluster SMALLINT,
+        model_version INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS customer_segments_state (
+        singleton BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+        watermark TIMESTAMP,
+        reference DATE,
+        customers_fingerprint JSONB,
+        model_version INTEGER,
+        statistics JSONB
+    );
+    ALTER TABLE customer_segments_state ADD COLUMN IF NOT EXISTS reference DATE
+"""
+
+REBUILD_SQL = """
+    TRUNCATE TABLE customer_segments;
+    INSERT INTO customer_segments (user_id, last_visit, purchase_count, total_spent)
+    SELECT user_id,
+           MAX(event_time),
+           SUM(CASE WHEN event_type = 'purchase' THEN 1 ELSE 0 END),
+           COALESCE(SUM(CASE WHEN event_type = 'purchase' THEN price END), 0)
+    FROM customers
+    WHERE user_id IS NOT NULL AND event_time IS NOT NULL
+    GROUP BY user_id;
+    ANALYZE customer_segments
+"""
+
+
+def reference_after(watermark):
+    """The reference date of a watermark: midnight after its last event."""
+    return watermark.date() + timedelta(days=1)
+
+
+def _recency(alias, reference):
+    # whole days before the reference date, floored like common.rfm
+    return f"FLOOR(EXTRACT(EPOCH FROM DATE '{reference.isoformat()}' - {alias}.last_visit) / 86400)"
+
+
+def _users_query(reference):
+    return f"""
+        SELECT s.user_id, {_recency('s', reference)} AS recency_days, s.purchase_count AS frequency,
+               s.total_spent::float8 AS monetary
+        FROM customer_segments s
+        ORDER BY s.user_id
+    """
+
+
+def _fold_sql(reference):
+    # the previous values are read from the snapshot the statement started with,
+    # before the upsert changes them
+    return f"""
+        WITH active AS (
+            SELECT user_id,
+                   MAX(event_time) AS last_visit,
+                   SUM(CASE WHEN event_type = 'purchase' THEN 1 ELSE 0 END) AS purchase_count,
+                   COALESCE(SUM(CASE WHEN event_type = 'purchase' THEN price END), 0) AS total_spent
+            FROM customers
+            WHERE event_time > %s AND event_time <= %s AND user_id IS NOT NULL
+            GROUP BY user_id
+        ),
+        previous AS (
+            SELECT s.* FROM customer_segments s JOIN active USING (user_id)
+        ),
+        folded AS (
+            INSERT INTO customer_segments AS s (user_id, last_visit, purchase_count, total_spent)
+            SELECT user_id, last_visit, purchase_count, total_spent FROM active
+            ON CONFLICT (user_id) DO UPDATE SET
+                last_visit = GREATEST(s.last_visit, EXCLUDED.last_visit),
+                purchase_count = s.purchase_count + EXCLUDED.purchase_count,
+                total_spent = s.total_spent + EXCLUDED.total_spent
+            RETURNING s.user_id, s.last_visit, s.purchase_count, s.total_spent
+        )
+        SELECT f.user_id, f.last_visit,
+               {_recency('f', reference)}, f.purchase_count, f.total_spent::float8,
+               p.cluster, {_recency('p', reference)}, p.purchase_count, p.total_spent::float8
+        FROM folded f LEFT JOIN previous p USING (user_id)
+    """
+
+
+def _summary_query(reference):
+    return f"""
+        SELECT cluster,
+               COUNT(*) AS count,
+               percentile_cont(0.5) WITHIN GROUP (ORDER BY {_recency('s', reference)}) AS recency_days,
+               percentile_cont(0.5) WITHIN GROUP (ORDER BY s.purchase_count) AS frequency,
+               percentile_cont(0.5) WITHIN GROUP (ORDER BY s.total_spent) AS monetary
+        FROM customer_segments s
+        WHERE cluster IS NOT NULL
+        GROUP BY cluster
+        ORDER BY cluster
+    """
+
+
+def save_model(scaler_mean, scaler_scale, centroids, labels, clusters, reference):
+    """Write a fitted segmentation as the next version and return it as loaded."""
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    version = max(_versions(), default=0) + 1
+    counts = np.bincount(clusters, minlength=len(centroids))
+    meta = {
+        'version': version,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'features': FEATURES,
+        'reference_date': reference.isoformat(),
+        'labels': {str(cluster): name for cluster, name in labels.items()},
+        'users': int(counts.sum()),
+        'shares': (counts / max(counts.sum(), 1)).tolist()
+    }
+    tmp_dir = tempfile.mkdtemp(dir=MODEL_DIR, prefix=".tmp-")
+    try:
+        np.save(os.path.join(tmp_dir, "mean.npy"), np.asarray(scaler_mean, dtype=float))
+        np.save(os.path.join(tmp_dir, "scale.npy"), np.asarray(scaler_scale, dtype=float))
+        np.save(os.path.join(tmp_dir, "centroids.npy"), np.asarray(centroids, dtype=float))
+        with open(os.path.join(tmp_dir, "model.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp_dir, os.path.join(MODEL_DIR, f"v{version}"))
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return load_model(version)
+
+
+def _versions():
+    if not os.path.isdir(MODEL_DIR):
+        return []
+    return [int(entry.name[1:]) for entry in os.scandir(MODEL_DIR)
+            if entry.is_dir() and entry.name[:1] == 'v' and entry.name[1:].isdigit()]
+
+
+def load_model(version=None):
+    """A saved segmentation, the latest one by default, or None if there is none."""
+    version = version or max(_versions(), default=None)
+    if version is None:
+        return None
+    path = os.path.join(MODEL_DIR, f"v{version}")
+    with open(os.path.join(path, "model.json")) as f:
+        model = json.load(f)
+    model['labels'] = {int(cluster): name for cluster, name in model['labels'].items()}
+    for name in ('mean', 'scale', 'centroids'):
+        model[name] = np.load(os.path.join(path, f"{name}.npy"))
+    return model
+
+
+def nearest_centroids(features, model, batch_rows=SCORE_BATCH_ROWS):
+    """Cluster of each row of raw RFM features, scored batch_rows at a time."""
+    centroids = model['centroids']
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    clusters = np.empty(len(features), dtype=np.int16)
+    for start in range(0, len(features), batch_rows):
+        batch = (features[start:start + batch_rows] - model['mean']) / model['scale']
+        # |x - c|^2 without the |x|^2 term, which is the same for every centroid
+        distances = centroid_norms - 2 * batch @ centroids.T
+        clusters[start:start + batch_rows] = distances.argmin(axis=1)
+    return clusters
+
+
+def cluster_statistics(features, clusters, cluster_count):
+    """Per-cluster user counts and sums of the raw RFM features."""
+    counts = np.bincount(clusters, minlength=cluster_count).astype(float)
+    sums = np.stack([np.bincount(clusters, weights=features[:, j], minlength=cluster_count)
+                     for j in range(features.shape[1])], axis=1)
+    return {'counts': counts, 'sums': sums}
+
+
+def drift(model, statistics):
+    """Largest centroid shift (in feature standard deviations) and share change since the fit."""
+    counts, sums = np.asarray(statistics['counts']), np.asarray(statistics['sums'])
+    present = counts > 0
+    means = (sums[present] / counts[present, None] - model['mean']) / model['scale']
+    shift = np.sqrt(((means - model['centroids'][present]) ** 2).sum(axis=1)).max(initial=0.0)
+    shares = counts / max(counts.sum(), 1)
+    change = np.abs(shares - np.asarray(model['shares'])).max(initial=0.0)
+    return {'centroid_shift': float(shift), 'share_change': float(change),
+            'exceeded': bool(shift > CENTROID_DRIFT or change > SHARE_DRIFT)}
+
+
+def _customers_layout():
+    """Filenode and deleted rows of each customers partition, which only a reload or a delete changes."""
+    return {row[0]: [row[1], int(row[5])] for row in table_fingerprint(("customers",))}
+
+
+def _rewritten(previous, current):
+    return any(name not in current or current[name][0] != filenode or current[name][1] > deleted
+               for name, (filenode, deleted) in previous.items())
+
+
+def _read_state(cursor):
+    cursor.execute(SEGMENTS_TABLE_SQL)
+    cursor.execute("SELECT watermark, reference, customers_fingerprint, model_version, statistics "
+                   "FROM customer_segments_state")
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    watermark, reference, layout, version, statistics = row
+    if statistics is not None:
+        statistics = {name: np.asarray(values, dtype=float) for name, values in statistics.items()}
+    return {'watermark': watermark, 'reference': reference, 'layout': layout, 'model_version': version,
+            'statistics': statistics}
+
+
+def _write_state(cursor, watermark, reference, layout, version, statistics):
+    cursor.execute("""
+        INSERT INTO customer_segments_state (watermark, reference, customers_fingerprint, model_version, statistics)
+        VALUES (%s, %s, %s::jsonb, %s, %s::jsonb)
+        ON CONFLICT (singleton) DO UPDATE SET
+            watermark = EXCLUDED.watermark,
+            reference = EXCLUDED.reference,
+            customers_fingerprint = EXCLUDED.customers_fingerprint,
+            model_version = EXCLUDED.model_version,
+            statistics = EXCLUDED.statistics
+    """, (watermark, reference, json.dumps(layout), version,
+          json.dumps({name: values.tolist() for name, values in statistics.items()}) if statistics else None))
+
+
+def _write_clusters(cursor, user_ids, clusters, version):
+    """Store the clusters of the given users through COPY and one UPDATE."""
+    buffer = io.StringIO()
+    pd.DataFrame({'user_id': user_ids, 'cluster': clusters}).to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cursor.execute("CREATE TEMP TABLE segment_assignments (user_id INTEGER, cluster SMALLINT) ON COMMIT DROP")
+    cursor.copy_expert("COPY segment_assignments (user_id, cluster) FROM STDIN WITH CSV", buffer)
+    cursor.execute("""
+        UPDATE customer_segments s
+        SET cluster = a.cluster, model_version = %s
+        FROM segment_assignments a
+        WHERE s.user_id = a.user_id
+    """, (version,))
+
+
+def _reference():
+    """The reference date of the stored segments."""
+    rows = fetch_rows("SELECT reference FROM customer_segments_state")
+    return rows[0][0] if rows else None
+
+
+def user_features(reference=None):
+    """RFM features of every user in customer_segments, the stored reference date by default."""
+    return fetch_frame(_users_query(reference or _reference()))
+
+
+def score_all(model):
+    """Assign every user to the model's clusters and reset the cluster statistics."""
+    reference = _reference()
+    users = user_features(reference)
+    features = users[FEATURES].to_numpy(dtype=float)
+    with span('fit', 'nearest centroid (all users)', rows=len(users)):
+        clusters = nearest_centroids(features, model)
+    statistics = cluster_statistics(features, clusters, len(model['centroids']))
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            state = _read_state(cursor)
+            _write_clusters(cursor, users['user_id'].to_numpy(), clusters, model['version'])
+            _write_state(cursor, state['watermark'], reference, state['layout'], model['version'], statistics)
+    print(f"Scored {len(users)} users with segmentation v{model['version']}.")
+    return statistics
+
+
+def rebuild():
+    """Recompute customer_segments from all of customers; clusters are left unassigned."""
+    # read before holding a connection, fetch_rows checks out one of its own
+    layout = _customers_layout()
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            _read_state(cursor)
+            with span('aggregate', 'rebuild customer_segments'):
+                cursor.execute(REBUILD_SQL)
+            cursor.execute("SELECT COUNT(*), MAX(last_visit) FROM customer_segments")
+            users, watermark = cursor.fetchone()
+            reference = reference_after(watermark) if watermark is not None else None
+            _write_state(cursor, watermark, reference, layout, None, None)
+    print(f"Rebuilt customer_segments for {users} users, up to {watermark}.")
+
+
+def fold_new_events(model, state):
+    """Fold the events after the watermark in, rescore their users and return the new statistics.
+
+    With model None the events are only folded in, for a refit or a full
+    rescoring to assign the clusters, and None is returned.
+    """
+    statistics = None
+    if model is not None:
+        statistics = {name: values.copy() for name, values in state['statistics'].items()}
+    # read before holding a connection, fetch_rows checks out one of its own
+    layout = _customers_layout()
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            # the events up to the new watermark only, it sets the reference date
+            # the folded recencies are measured from
+            cursor.execute("SELECT MAX(event_time) FROM customers WHERE event_time > %s", (state['watermark'],))
+            watermark = cursor.fetchone()[0]
+            if watermark is None:
+                print(f"No events after {state['watermark']}, segments are up to date.")
+                return statistics
+            reference = max(filter(None, (state['reference'], reference_after(watermark))))
+            if statistics is not None and state['reference'] is not None:
+                # every user is as many days older, the stored ones included
+                statistics['sums'][:, FEATURES.index('recency_days')] += \
+                    statistics['counts'] * (reference - state['reference']).days
+
+            with span('aggregate', 'fold new events') as stage:
+                cursor.execute(_fold_sql(reference), (state['watermark'], watermark))
+                rows = cursor.fetchall()
+                stage.rows = len(rows)
+
+            active = pd.DataFrame.from_records(rows, columns=[
+                'user_id', 'last_visit', *FEATURES, 'previous_cluster', *[f'previous_{name}' for name in FEATURES]
+            ])
+            known = active['previous_cluster'].notna().to_numpy()
+            if model is None:
+                _write_state(cursor, watermark, reference, layout, None, None)
+                print(f"Folded the events of {len(active)} active users ({int((~known).sum())} new) up to {watermark}.")
+                return None
+
+            cluster_count = len(model['centroids'])
+            features = active[FEATURES].to_numpy(dtype=float)
+            with span('fit', 'nearest centroid (active users)', rows=len(active)):
+                clusters = nearest_centroids(features, model)
+
+            # take the previous contributions out and the new ones in
+            previous = cluster_statistics(
+                active.loc[known, [f'previous_{name}' for name in FEATURES]].to_numpy(dtype=float),
+                active.loc[known, 'previous_cluster'].to_numpy(dtype=int), cluster_count)
+            current = cluster_statistics(features, clusters, cluster_count)
+            for name in statistics:
+                statistics[name] += current[name] - previous[name]
+
+            _write_clusters(cursor, active['user_id'].to_numpy(), clusters, model['version'])
+            _write_state(cursor, watermark, reference, layout, model['version'], statistics)
+    print(f"Folded the events of {len(active)} active users ({int((~known).sum())} new) up to {watermark}.")
+    return statistics
+
+
+def update_segments(fit, refit=False):
+    """Bring customer_segments up to date and return the segmentation in use.
+
+    fit(features) is called with the RFM features of every user when a model
+    must be fitted, and returns (scaler_mean, scaler_scale, centroids, labels).
+    """
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            state = _read_state(cursor)
+    # a state without a reference date predates it, its statistics are of another one
+    if (state is None or state['watermark'] is None or state['reference'] is None
+            or _rewritten(state['layout'], _customers_layout())):
+        rebuild()
+        state = None
+
+    # fold the new events in first, so that a refit sees the newest customers;
+    # they are scored here only if the model that scored the others is kept
+    model = load_model()
+    statistics = None
+    if state is not None:
+        scoring = model if model is not None and state['model_version'] == model['version'] else None
+        statistics = fold_new_events(None if refit else scoring, state)
+
+    if model is None or refit:
+        model = _refit(fit, "requested" if refit else "no saved segmentation")
+    elif statistics is None:
+        score_all(model)
+    else:
+        measured = drift(model, statistics)
+        print(f"Drift since v{model['version']}: centroid shift {measured['centroid_shift']:.3f} "
+              f"(limit {CENTROID_DRIFT}), share change {measured['share_change']:.3f} (limit {SHARE_DRIFT}).")
+        if measured['exceeded']:
+            model = _refit(fit, "drift")
+    return model
+
+
+def _refit(fit, reason):
+    reference = _reference()
+    users = user_features(reference)
+    features = users[FEATURES].to_numpy(dtype=float)
+    print(f"Fitting a new segmentation on {len(users)} users ({reason})...")
+    scaler_mean, scaler_scale, centroids, labels = fit(users[FEATURES])
+    with span('fit', 'nearest centroid (all users)', rows=len(users)):
+        clusters = nearest_centroids(features, {'mean': scaler_mean, 'scale': scaler_scale, 'centroids': centroids})
+    model = save_model(scaler_mean, scaler_scale, centroids, labels, clusters, reference)
+    score_all(model)
+    return model
+
+
+def segment_summary():
+    """Per-cluster user counts and median RFM values of the stored segments."""
+    with span('aggregate', 'segment summary'):
+        rows = fetch_rows(_summary_query(_reference()))
+    summary = pd.DataFrame(rows, columns=['cluster', 'count', *FEATURES]).set_index('cluster')
+    return {
+        'counts': summary['count'].astype(np.int64),
+        'medians': summary[FEATURES].astype(float)
+    }
+
+
+if __name__ == "__main__":
+    # python -m common.segments --rebuild: recompute customer_segments from customers
+    if '--rebuild' in sys.argv:
+        rebuild()
+    model = load_model()
+    print(f"Segmentation v{model['version']} from {model['created']}: {model['labels']}" if model
+          else "No saved segmentation yet, run ex05/Clustering.py.")
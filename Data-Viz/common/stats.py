@@ -0,0 +1,201 @@
+"""Mergeable streaming statistics: exact moments and KLL-sketched quantiles."""
+import math
+from statistics import NormalDist
+
+import numpy as np
+
+from common.db import fetch_rows
+
+# default normalized rank error of the quantile sketch (0.5% of the rows)
+DEFAULT_RANK_ERROR = 0.005
+PERCENTILES = (0.25, 0.5, 0.75)
+# box plots draw at most this many outlier points, however many rows there are
+MAX_FLIERS = 500
+# coverage of the confidence intervals of sampled estimates
+CONFIDENCE = 0.95
+
+
+def kll_k_for(rank_error):
+    """Sketch size k giving roughly the requested normalized rank error."""
+    # empirical KLL error curve, eps ~= 2.296 / k^0.9445
+    return max(8, math.ceil((2.296 / rank_error) ** (1 / 0.9445)))
+
+
+class KLLSketch:
+    """KLL quantile sketch; levels hold items of weight 2**level."""
+
+    def __init__(self, k, seed=None):
+        # seed may also be a Generator shared by the sketches that get merged
+        # together, which keeps their compaction coin flips independent
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.rng = np.random.default_rng(seed)
+
+    def _capacity(self, level):
+        # the top level holds k items, each level below 2/3 of the one above
+        depth = len(self.levels) - level - 1
+        return max(2, math.ceil(self.k * (2 / 3) ** depth))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(items)
+                # an odd item out stays at this level, the rest is halved upwards
+                keep = items[:len(items) % 2]
+                promoted = items[len(keep):][self.rng.integers(2)::2]
+                self.levels[level] = keep
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            level += 1
+
+    def update(self, values):
+        self.levels[0] = np.concatenate([self.levels[0], np.asarray(values, dtype=np.float64)])
+        self._compress()
+
+    def merge(self, other):
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self._compress()
+
+    def quantiles(self, qs):
+        items = np.concatenate(self.levels)
+        if len(items) == 0:
+            return [np.nan for _ in qs]
+        weights = np.concatenate([np.full(len(values), 2.0 ** level) for level, values in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        items, cumulative = items[order], np.cumsum(weights[order])
+        ranks = np.asarray(qs) * cumulative[-1]
+        return list(items[np.minimum(np.searchsorted(cumulative, ranks), len(items) - 1)])
+
+
+class StreamingStats:
+    """One-pass count, mean, std, min and max (exact) with sketched quantiles."""
+
+    def __init__(self, rank_error=DEFAULT_RANK_ERROR, seed=42):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.sketch = KLLSketch(kll_k_for(rank_error), seed)
+
+    def _combine(self, count, mean, m2, minimum, maximum):
+        # Chan et al. parallel update of count, mean and sum of squared deviations
+        total = self.count + count
+        delta = mean - self.mean
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.mean += delta * count / total
+        self.count = total
+        self.min = min(self.min, minimum)
+        self.max = max(self.max, maximum)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        mean = values.mean()
+        self._combine(len(values), mean, ((values - mean) ** 2).sum(), values.min(), values.max())
+        self.sketch.update(values)
+
+    def merge(self, other):
+        if other.count:
+            self._combine(other.count, other.mean, other.m2, other.min, other.max)
+            self.sketch.merge(other.sketch)
+
+    def describe(self, percentiles=PERCENTILES):
+        """Return describe()-style statistics keyed 'count', 'mean', 'std', 'min', '25%', ..., 'max'."""
+        desc = {
+            'count': float(self.count),
+            'mean': self.mean if self.count else np.nan,
+            'std': math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.nan,
+            'min': self.min if self.count else np.nan
+        }
+        for q, value in zip(percentiles, self.sketch.quantiles(percentiles)):
+            desc[f"{q * 100:g}%"] = value
+        desc['max'] = self.max if self.count else np.nan
+        return desc
+
+
+def box_stats(values, label='', whis=1.5, max_fliers=MAX_FLIERS):
+    """Compute the statistics matplotlib's bxp draws, with a capped set of fliers."""
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+    low, high = q1 - whis * (q3 - q1), q3 + whis * (q3 - q1)
+    inside = values[(values >= low) & (values <= high)]
+
+    # repeated prices draw the same marker, so only distinct outliers are kept and,
+    # past the cap, evenly spaced ones that still include both extremes
+    fliers = np.unique(values[(values < low) | (values > high)])
+    if len(fliers) > max_fliers:
+        fliers = fliers[np.linspace(0, len(fliers) - 1, max_fliers).round().astype(int)]
+    return {
+        'label': label,
+        'mean': values.mean(),
+        'med': median,
+        'q1': q1,
+        'q3': q3,
+        'whislo': inside.min() if len(inside) else q1,
+        'whishi': inside.max() if len(inside) else q3,
+        'fliers': fliers,
+        'count': len(values)
+    }
+
+
+def sampled_shares(block_counts, fraction, confidence=CONFIDENCE):
+    """Shares of each category from a block sample, with confidence half-widths.
+
+    block_counts holds (block, category, count) rows of a TABLESAMPLE SYSTEM
+    sample covering `fraction` of the blocks. Rows of one block are sampled
+    together, so the variance is the one of a cluster sample (ratio estimator
+    over blocks), wider than a binomial one when blocks are homogeneous.
+    Returns {category: (estimated count, share, half-width)}.
+    """
+    block_index = {block: i for i, block in enumerate(dict.fromkeys(row[0] for row in block_counts))}
+    category_index = {category: j for j, category in enumerate(dict.fromkeys(row[1] for row in block_counts))}
+    per_block = np.zeros((len(block_index), len(category_index)))
+    for block, category, count in block_counts:
+        per_block[block_index[block], category_index[category]] += count
+
+    m = len(block_index)
+    rows = per_block.sum(axis=1)
+    total = rows.sum()
+    if m < 2 or total == 0:
+        # a single block gives no variance estimate, nothing can be trusted
+        return {category: (counts_sum / fraction, counts_sum / total if total else np.nan, np.inf)
+                for category, counts_sum in zip(category_index, per_block.sum(axis=0))}
+
+    shares = per_block.sum(axis=0) / total
+    residuals = per_block - rows[:, None] * shares
+    variance = (1 - fraction) * (residuals ** 2).sum(axis=0) / (m * (m - 1) * (total / m) ** 2)
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    return {
+        category: (per_block[:, j].sum() / fraction, shares[j], z * math.sqrt(max(variance[j], 0.0)))
+        for category, j in category_index.items()
+    }
+
+
+def server_describe(source, column, percentiles=PERCENTILES):
+    """Compute the same statistics exactly in PostgreSQL, quartiles with percentile_cont."""
+    qs = ", ".join(repr(float(q)) for q in percentiles)
+    count, mean, std, minimum, maximum, quantiles = fetch_rows(f"""
+        SELECT COUNT({column}), AVG({column}), STDDEV_SAMP({column}), MIN({column}), MAX({column}),
+               percentile_cont(ARRAY[{qs}]) WITHIN GROUP (ORDER BY {column})
+        FROM ({source}) AS source
+    """)[0]
+    desc = {
+        'count': float(count),
+        'mean': float(mean) if mean is not None else np.nan,
+        'std': float(std) if std is not None else np.nan,
+        'min': float(minimum) if minimum is not None else np.nan
+    }
+    for q, value in zip(percentiles, quantiles or [None] * len(percentiles)):
+        desc[f"{q * 100:g}%"] = float(value) if value is not None else np.nan
+    desc['max'] = float(maximum) if maximum is not None else np.nan
+    return desc
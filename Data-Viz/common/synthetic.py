@@ -0,0 +1,264 @@
+"""Seeded synthetic data in the layout of subject/: monthly customer CSVs and item.csv.
+
+Events follow a skewed product and user popularity, one session per user and
+day, and a small share of exact duplicate rows for the deduplication to remove.
+item.csv repeats part of its products with some attributes left empty, like
+the real file. The same seed and size always give the same files.
+
+Run `python -m common.synthetic [--rows 1M|10M|50M|N] [--seed S] [--out DIR]`
+from Data-Viz; files are written to DIR/customer/*.csv and DIR/item/item.csv.
+"""
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from common.bulk_load import CUSTOMER_COLUMNS, CUSTOMER_FILES
+
+SYNTHETIC_DIR = os.environ.get(
+    "DATAVIZ_SYNTHETIC_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "synthetic")
+)
+SIZES = {'1M': 1_000_000, '10M': 10_000_000, '50M': 50_000_000}
+DEFAULT_SEED = 42
+
+# first day of each month of CUSTOMER_FILES, plus the end of the last one
+MONTH_BOUNDS = pd.date_range('2022-10-01', '2023-03-01', freq='MS').to_numpy().astype('datetime64[s]')
+# rows generated and written at once
+CHUNK_ROWS = 1_000_000
+
+EVENT_TYPES = np.array(['view', 'cart', 'remove_from_cart', 'purchase'])
+EVENT_WEIGHTS = np.array([0.48, 0.27, 0.19, 0.06])
+DUPLICATE_RATE = 0.01
+FIRST_USER_ID = 400_000_000
+
+CATEGORY_CODES = [
+    'appliances.environment.vacuum', 'appliances.kitchen.blender', 'appliances.personal.hair_cutter',
+    'furniture.bathroom.bath', 'furniture.living_room.cabinet', 'accessories.bag', 'accessories.cosmetic_bag',
+    'stationery.cartrige', 'apparel.glove', 'sport.diving'
+]
+# share of products without category_code or brand, and of repeated item rows
+MISSING_CODE_RATE = 0.55
+MISSING_BRAND_RATE = 0.4
+ITEM_REPEAT_RATE = 0.35
+
+_HEX = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+_ZERO = ord('0')
+
+
+def parse_size(size):
+    """Number of rows of a size name such as '10M', or of a plain integer."""
+    return SIZES[size] if size in SIZES else int(size)
+
+
+def _power_law_cdf(n, exponent):
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return np.cumsum(weights) / weights.sum()
+
+
+def _draw(rng, cdf, size):
+    """Indexes drawn with the popularity of a cumulative distribution."""
+    return np.minimum(np.searchsorted(cdf, rng.random(size)), len(cdf) - 1)
+
+
+def _hex(values, digits):
+    """Lowercase hexadecimal strings of unsigned integers, as a (n, digits) byte matrix."""
+    shifts = np.arange(digits - 1, -1, -1, dtype=np.uint64) * np.uint64(4)
+    return _HEX[(values[:, None] >> shifts) & np.uint64(0xF)]
+
+
+def _session_ids(keys):
+    """UUID-shaped session strings derived from integer session keys, as a (n, 36) byte matrix."""
+    # splitmix64 finalizer, so that neighbouring keys look unrelated
+    with np.errstate(over='ignore'):
+        x = keys.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        x ^= x >> np.uint64(31)
+    text = np.empty((len(keys), 36), dtype=np.uint8)
+    text[:] = np.frombuffer(b'00000000-0000-0000-0000-000000000000', dtype=np.uint8)
+    digits = _hex(x, 16)
+    text[:, 19:23] = digits[:, :4]
+    text[:, 24:] = digits[:, 4:]
+    return text
+
+
+# CSV lines are assembled as byte matrices, one row per line, with a mask of
+# the bytes to keep: formatting millions of values through to_csv is far slower
+
+def _constant(text, rows):
+    matrix = np.broadcast_to(np.frombuffer(text.encode(), dtype=np.uint8), (rows, len(text)))
+    return matrix, np.ones(matrix.shape, dtype=bool)
+
+
+def _digits(values, width, padded=False):
+    """Decimal digits of non-negative integers; leading zeros are masked unless padded."""
+    powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    matrix = (values[:, None] // powers % 10 + _ZERO).astype(np.uint8)
+    if padded:
+        return matrix, np.ones(matrix.shape, dtype=bool)
+    lengths = np.searchsorted(powers[::-1][1:], values, side='right') + 1
+    return matrix, np.arange(width) >= width - lengths[:, None]
+
+
+def _labels(codes, categories):
+    """Strings of a categorical column, looked up from its encoded categories."""
+    encoded = np.array([category.encode() for category in categories])
+    table = encoded.view(np.uint8).reshape(len(encoded), -1)
+    lengths = np.char.str_len(encoded)
+    return table[codes], np.arange(table.shape[1]) < lengths[codes][:, None]
+
+
+def _timestamps(values):
+    """'YYYY-MM-DD HH:MM:SS UTC' of datetime64[s] values."""
+    days = values.astype('datetime64[D]')
+    months = values.astype('datetime64[M]')
+    years = values.astype('datetime64[Y]')
+    seconds = (values - days).astype(np.int64)
+    rows = len(values)
+    return [
+        _digits(years.astype(np.int64) + 1970, 4, padded=True), _constant('-', rows),
+        _digits((months - years).astype(np.int64) + 1, 2, padded=True), _constant('-', rows),
+        _digits((days - months).astype(np.int64) + 1, 2, padded=True), _constant(' ', rows),
+        _digits(seconds // 3600, 2, padded=True), _constant(':', rows),
+        _digits(seconds // 60 % 60, 2, padded=True), _constant(':', rows),
+        _digits(seconds % 60, 2, padded=True), _constant(' UTC', rows)
+    ]
+
+
+def _csv_bytes(pieces):
+    """Join the byte pieces of every line, keeping only their masked bytes."""
+    matrix = np.hstack([piece for piece, _ in pieces])
+    mask = np.hstack([mask for _, mask in pieces])
+    return matrix[mask].tobytes()
+
+
+class Catalog:
+    """Products and users shared by every month, drawn from the seed."""
+
+    def __init__(self, rows, rng):
+        self.product_count = int(np.clip(rows // 400, 1_000, 200_000))
+        self.user_count = int(np.clip(rows // 25, 1_000, 2_000_000))
+        self.product_ids = rng.choice(np.arange(1, 2 * self.product_count + 1), self.product_count, replace=False)
+        self.cents = np.clip(np.round(rng.lognormal(np.log(450), 0.9, self.product_count)), 5, 35_000).astype(np.int64)
+        self.product_cdf = _power_law_cdf(self.product_count, 1.1)
+        self.user_cdf = _power_law_cdf(self.user_count, 0.8)
+        # users are ranked by activity in a shuffled order, not by id
+        self.user_ids = FIRST_USER_ID + rng.permutation(self.user_count)
+
+    def events(self, rng, start, end, size):
+        """CSV lines of size events between two datetime64 bounds, in time order, with duplicates."""
+        span = int((end - start) / np.timedelta64(1, 's'))
+        offsets = np.sort(rng.integers(0, span, size))
+        event_type = _draw(rng, np.cumsum(EVENT_WEIGHTS), size)
+        products = _draw(rng, self.product_cdf, size)
+        users = _draw(rng, self.user_cdf, size)
+        # each duplicate is written right after its original row, keeping the time order
+        duplicates = np.flatnonzero(rng.random(size) < DUPLICATE_RATE)
+        order = np.sort(np.concatenate([np.arange(size), duplicates]), kind='stable')
+        event_time = (start + offsets.astype('timedelta64[s]'))[order]
+        event_type, products, users = event_type[order], products[order], users[order]
+        day = (event_time.astype('datetime64[D]') - MONTH_BOUNDS[0]).astype(np.int64)
+        size = len(order)
+
+        comma = _constant(',', size)
+        return _csv_bytes(_timestamps(event_time) + [
+            comma, _labels(event_type, EVENT_TYPES),
+            comma, _digits(self.product_ids[products], len(str(self.product_ids.max()))),
+            comma, _digits(self.cents[products] // 100, 3),
+            _constant('.', size), _digits(self.cents[products] % 100, 2, padded=True),
+            comma, _digits(self.user_ids[users], len(str(self.user_ids.max()))),
+            comma, (_session_ids(users * 1024 + day), np.ones((size, 36), dtype=bool)),
+            _constant('\n', size)
+        ])
+
+    def items(self, rng):
+        """item.csv rows: every product once, some repeated with fields left empty."""
+        category_count = max(50, self.product_count // 100)
+        categories = rng.integers(10 ** 17, 10 ** 18, category_count)
+        product_category = rng.integers(0, category_count, self.product_count)
+        brands = np.array([f"brand{index:05d}" for index in range(max(20, self.product_count // 50))])
+        codes = np.array(CATEGORY_CODES, dtype=object)[product_category % len(CATEGORY_CODES)]
+        items = pd.DataFrame({
+            'product_id': self.product_ids,
+            'category_id': categories[product_category],
+            'category_code': np.where(rng.random(self.product_count) < MISSING_CODE_RATE, None, codes),
+            'brand': np.where(rng.random(self.product_count) < MISSING_BRAND_RATE, None,
+                              brands[rng.integers(0, len(brands), self.product_count)].astype(object))
+        })
+        repeats = items[rng.random(self.product_count) < ITEM_REPEAT_RATE].copy()
+        for column in ['category_code', 'brand']:
+            repeats.loc[rng.random(len(repeats)) < 0.5, column] = None
+        items = pd.concat([items, repeats], ignore_index=True)
+        return items.iloc[rng.permutation(len(items))]
+
+
+def _month_rows(rows):
+    """Rows per month of CUSTOMER_FILES, proportional to the length of the month."""
+    days = np.diff(MONTH_BOUNDS).astype('timedelta64[D]').astype(np.int64)
+    counts = rows * days // days.sum()
+    counts[-1] += rows - counts.sum()
+    return counts
+
+
+def generate(rows, out_dir, seed=DEFAULT_SEED):
+    """Write the customer CSVs and item.csv of a synthetic data set, return their paths."""
+    rng = np.random.default_rng(seed)
+    catalog = Catalog(rows, rng)
+    customer_dir = os.path.join(out_dir, 'customer')
+    item_dir = os.path.join(out_dir, 'item')
+    os.makedirs(customer_dir, exist_ok=True)
+    os.makedirs(item_dir, exist_ok=True)
+
+    paths = []
+    for index, (name, month_rows) in enumerate(zip(CUSTOMER_FILES, _month_rows(rows))):
+        path = os.path.join(customer_dir, name)
+        start, end = MONTH_BOUNDS[index], MONTH_BOUNDS[index + 1]
+        chunks = max(1, -(-month_rows // CHUNK_ROWS))
+        bounds = start + (end - start) * np.arange(chunks + 1) // chunks
+        with open(path, 'wb') as f:
+            f.write((",".join(CUSTOMER_COLUMNS) + "\n").encode())
+            for chunk in range(chunks):
+                size = month_rows // chunks + (chunk < month_rows % chunks)
+                f.write(catalog.events(rng, bounds[chunk], bounds[chunk + 1], size))
+        paths.append(path)
+
+    item_path = os.path.join(item_dir, 'item.csv')
+    catalog.items(rng).to_csv(item_path, index=False)
+
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump({'rows': int(rows), 'seed': seed, 'files': CUSTOMER_FILES + ['item.csv']}, f)
+    return paths, item_path
+
+
+def ensure_generated(rows, seed=DEFAULT_SEED, out_dir=None):
+    """Paths of a synthetic data set, generated only when not already on disk."""
+    out_dir = out_dir or os.path.join(SYNTHETIC_DIR, f"{rows}_{seed}")
+    paths = [os.path.join(out_dir, 'customer', name) for name in CUSTOMER_FILES]
+    item_path = os.path.join(out_dir, 'item', 'item.csv')
+    try:
+        with open(os.path.join(out_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest['rows'] == rows and manifest['seed'] == seed and all(map(os.path.exists, paths + [item_path])):
+            return paths, item_path
+    except (OSError, ValueError, KeyError):
+        pass
+    return generate(rows, out_dir, seed)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    options = {'--rows': '1M', '--seed': str(DEFAULT_SEED), '--out': None}
+    for option in options:
+        if option in args:
+            options[option] = args[args.index(option) + 1]
+    rows, seed = parse_size(options['--rows']), int(options['--seed'])
+    start = time.perf_counter()
+    paths, item_path = generate(rows, options['--out'] or os.path.join(SYNTHETIC_DIR, f"{rows}_{seed}"), seed)
+    size = sum(os.path.getsize(path) for path in paths + [item_path])
+    print(f"Generated {rows} events ({size / 1024 ** 2:.1f} MB) in {time.perf_counter() - start:.2f}s:")
+    for path in paths + [item_path]:
+        print(f"   {path}")
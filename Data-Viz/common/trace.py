@@ -0,0 +1,214 @@
+"""Optional per-stage instrumentation of the Data-Viz scripts.
+
+Code wraps its stages in `span(kind, name)`, where kind is one of KINDS. When
+tracing is enabled, every span records its wall time, CPU time of the process,
+rows processed and RSS delta as one JSON line, and a summary table per stage is
+printed when the script exits. Disabled, a span costs one function call.
+
+Tracing is enabled with `--trace` on the command line of any script, or with
+DATAVIZ_TRACE=1 (trace file under TRACE_DIR) or DATAVIZ_TRACE=<path>; 0, false,
+no and off leave it disabled. Worker processes inherit the setting and append
+to the same trace file.
+"""
+import atexit
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+TRACE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "traces")
+KINDS = ('connect', 'query', 'transfer', 'parse', 'aggregate', 'fit', 'render')
+
+_PAGE_BYTES = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+_trace_path = None
+_run_id = None
+# DATAVIZ_TRACE values that switch tracing on or off instead of naming a file
+TRUE_WORDS = ('1', 'true', 'yes', 'on')
+FALSE_WORDS = ('', '0', 'false', 'no', 'off')
+
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def rss_bytes():
+    """Current resident set size of this process (the peak where /proc is missing)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_BYTES
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Span:
+    """One timed stage; rows and extra fields may be set while it runs."""
+
+    def __init__(self, kind, name, rows=None, **fields):
+        self.kind = kind
+        self.name = name
+        self.rows = rows
+        self.fields = fields
+        self.id = uuid.uuid4().hex[:12]
+        self.parent = None
+
+    def annotate(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        stack = _stack()
+        self.parent = stack[-1].id if stack else None
+        stack.append(self)
+        self.started = time.time()
+        self._rss = rss_bytes()
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        _stack().pop()
+        record = {
+            'run': _run_id,
+            'pid': os.getpid(),
+            'id': self.id,
+            'parent': self.parent,
+            'kind': self.kind,
+            'name': self.name,
+            'start': round(self.started, 6),
+            'wall': round(wall, 6),
+            'cpu': round(cpu, 6),
+            'rows': self.rows,
+            'rss_delta_mb': round((rss_bytes() - self._rss) / 1024 ** 2, 3),
+            'error': exc_type.__name__ if exc_type else None,
+            **self.fields
+        }
+        _write(record)
+        return False
+
+
+class _NullSpan:
+    """Stand-in while tracing is disabled."""
+
+    rows = None
+
+    def annotate(self, **fields):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _write(record):
+    line = json.dumps(record, default=str) + "\n"
+    with _write_lock:
+        # appended line by line, so the spans of worker processes interleave safely
+        with open(_trace_path, 'a') as f:
+            f.write(line)
+
+
+def enabled():
+    return _trace_path is not None
+
+
+def span(kind, name=None, rows=None, **fields):
+    """Context manager timing one stage of the given kind."""
+    if _trace_path is None:
+        return _NULL_SPAN
+    return Span(kind, name or kind, rows, **fields)
+
+
+def enable(path=None):
+    """Start tracing into path (a new file under TRACE_DIR by default)."""
+    global _trace_path, _run_id
+    if path is None or path.strip().lower() in TRUE_WORDS:
+        script = os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0] or 'python'
+        path = os.path.join(TRACE_DIR, f"{script}_{datetime.now():%Y%m%d_%H%M%S}_{os.getpid()}.jsonl")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    _trace_path = path
+    # the first process of a run owns the summary, its workers only add spans
+    inherited = os.environ.get('DATAVIZ_TRACE_RUN')
+    _run_id = inherited or f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    os.environ['DATAVIZ_TRACE'] = path
+    os.environ['DATAVIZ_TRACE_RUN'] = _run_id
+    if not inherited:
+        atexit.register(print_summary)
+
+
+def load_trace(path=None, run=None):
+    """Span records of a trace file, only those of one run if given."""
+    with open(path or _trace_path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return [record for record in records if run is None or record['run'] == run]
+
+
+def summarize(records):
+    """Totals per (kind, name): calls, wall, self wall (without nested spans), CPU, rows and RSS delta."""
+    children = defaultdict(float)
+    for record in records:
+        if record['parent'] is not None:
+            children[record['parent']] += record['wall']
+    totals = {}
+    for record in records:
+        total = totals.setdefault((record['kind'], record['name']), {
+            'calls': 0, 'wall': 0.0, 'self': 0.0, 'cpu': 0.0, 'rows': 0, 'rss_delta_mb': 0.0
+        })
+        total['calls'] += 1
+        total['wall'] += record['wall']
+        total['self'] += max(record['wall'] - children[record['id']], 0.0)
+        total['cpu'] += record['cpu']
+        total['rows'] += record['rows'] or 0
+        total['rss_delta_mb'] = max(total['rss_delta_mb'], record['rss_delta_mb'])
+    return totals
+
+
+def print_summary(path=None, run=None):
+    """Print the summary table of a trace, by default the one of the current run."""
+    try:
+        records = load_trace(path, run if path else _run_id)
+    except OSError:
+        return
+    if not records:
+        return
+    totals = summarize(records)
+    order = {kind: index for index, kind in enumerate(KINDS)}
+    print(f"\n{'kind':<10} {'name':<40} {'calls':>6} {'wall s':>9} {'self s':>9} {'cpu s':>9} "
+          f"{'rows':>12} {'max RSS +MB':>12}")
+    for (kind, name), total in sorted(totals.items(), key=lambda item: (order.get(item[0][0], len(KINDS)),
+                                                                        -item[1]['self'])):
+        print(f"{kind:<10} {name[:40]:<40} {total['calls']:>6} {total['wall']:9.3f} {total['self']:9.3f} "
+              f"{total['cpu']:9.3f} {total['rows']:>12,} {total['rss_delta_mb']:12.1f}")
+    print(f"Trace written to {path or _trace_path}")
+
+
+if os.environ.get('DATAVIZ_TRACE', '').strip().lower() not in FALSE_WORDS:
+    enable(os.environ['DATAVIZ_TRACE'])
+elif '--trace' in sys.argv:
+    enable()
+
+
+if __name__ == "__main__":
+    # python -m common.trace <trace.jsonl>: summary of an existing trace
+    print_summary(sys.argv[1] if len(sys.argv) > 1 else None)
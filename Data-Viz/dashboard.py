@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Render every Data-Viz chart in parallel with a headless backend.
+
+Each dataset is fetched (or computed) once in the parent process and handed to
+a pool of rendering workers, which write the PNGs into their exercise folders.
+The independent queries are fetched concurrently; --sequential runs them one
+after another for comparison.
+
+    python dashboard.py [--workers N] [--sequential] [--trace]
+"""
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from sklearn.preprocessing import StandardScaler
+
+WORKSPACE_DIR = os.path.dirname(os.path.abspath(__file__))
+EXERCISES = ['ex00', 'ex01', 'ex02', 'ex03', 'ex04', 'ex05']
+
+sys.path.append(WORKSPACE_DIR)
+for exercise in EXERCISES:
+    sys.path.append(os.path.join(WORKSPACE_DIR, exercise))
+
+import pie
+import chart
+import mustache
+import Building
+import elbow
+import Clustering
+from common.cache import cached_fetch
+from common.db import POOL_MAX_CONN
+from common.fanout import fetch_all
+from common.schema import fetch_typed
+
+# (exercise folder, module, plotting function, names of the datasets it takes)
+CHARTS = [
+    ('ex00', 'pie', 'create_pie_chart', ['event_types']),
+    ('ex01', 'chart', 'create_daily_price_chart', ['purchases']),
+    ('ex01', 'chart', 'create_monthly_bar_chart', ['purchases']),
+    ('ex01', 'chart', 'create_purchase_ratio_chart', ['purchases']),
+    ('ex02', 'mustache', 'create_box_plots', ['priced_purchases']),
+    ('ex03', 'Building', 'create_frequency_chart', ['purchases']),
+    ('ex03', 'Building', 'create_spending_chart', ['purchases']),
+    ('ex04', 'elbow', 'create_elbow_plot', ['k_sweep']),
+    ('ex04', 'elbow', 'cluster_and_visualize', ['customers', 'cluster_count']),
+    ('ex05', 'Clustering', 'create_bar_chart', ['segment_summary', 'segment_labels']),
+    ('ex05', 'Clustering', 'create_bubble_chart', ['segment_summary', 'segment_labels'])
+]
+
+# datasets handed to the rendering workers, set up by _attach_datasets
+_datasets = {}
+
+
+def load_datasets(concurrency=POOL_MAX_CONN):
+    """Fetch every dataset the charts need, once, with up to `concurrency` queries at a time."""
+    # ex01, ex02 and ex03 all read the same purchase rows; the charts of ex01 and
+    # ex03 aggregate them locally with the same semantics as their SQL pushdown
+    fetched, seconds = fetch_all({
+        'event_types': (pie.get_event_type_distribution,),
+        'purchases': (cached_fetch, Building.PURCHASE_QUERY, ("customers",), fetch_typed),
+        'customers': (elbow.get_customer_data,),
+        'segments': (Clustering.segment_customers,)
+    }, concurrency)
+    print("\nFetch time per dataset:")
+    for name, elapsed in sorted(seconds.items(), key=lambda item: -item[1]):
+        print(f"   {name:<40} {elapsed:6.2f}s")
+
+    # the fetch functions print their error and return None (segment_customers a pair of
+    # them), stop here rather than in a render worker
+    failed = [name for name, result in fetched.items()
+              if result is None or (isinstance(result, tuple) and any(part is None for part in result))]
+    if failed:
+        raise RuntimeError(f"Could not fetch the dashboard datasets: {', '.join(failed)}")
+
+    datasets = {}
+    datasets['event_types'] = fetched['event_types']
+
+    purchases = fetched['purchases']
+    datasets['purchases'] = purchases
+    datasets['priced_purchases'] = purchases.dropna(subset=['price'])
+
+    customers = fetched['customers']
+    sweep = elbow.sweep_k(StandardScaler().fit_transform(customers[elbow.FEATURES]))
+    datasets['customers'] = customers
+    datasets['k_sweep'] = sweep
+    datasets['cluster_count'] = sweep['elbow'] or elbow.DEFAULT_CLUSTER_COUNT
+
+    # the persisted segmentation, with only the users active since the last run rescored
+    datasets['segment_summary'], datasets['segment_labels'] = fetched['segments']
+
+    return datasets
+
+
+def _attach_datasets(datasets):
+    """Process pool initializer: keep the datasets for every chart of this worker."""
+    # forked workers inherit the datasets, spawned ones unpickle them once
+    _datasets.update(datasets)
+
+
+def _render(exercise, module, function, dataset_names):
+    """Run one plotting function in its exercise folder and return its wall time."""
+    os.chdir(os.path.join(WORKSPACE_DIR, exercise))
+    start = time.perf_counter()
+    getattr(sys.modules[module], function)(*[_datasets[name] for name in dataset_names])
+    plt.close('all')
+    return time.perf_counter() - start
+
+
+def render_all(datasets, workers=None):
+    """Render every chart in a process pool and return the wall time of each."""
+    timings = {}
+    with ProcessPoolExecutor(max_workers=workers or min(len(CHARTS), os.cpu_count() or 1),
+                             initializer=_attach_datasets, initargs=(datasets,)) as pool:
+        futures = {pool.submit(_render, *task): f"{task[0]}/{task[2]}" for task in CHARTS}
+        for future in as_completed(futures):
+            timings[futures[future]] = future.result()
+    return timings
+
+
+def main():
+    workers = int(sys.argv[sys.argv.index('--workers') + 1]) if '--workers' in sys.argv else None
+    concurrency = 1 if '--sequential' in sys.argv else POOL_MAX_CONN
+
+    start = time.perf_counter()
+    datasets = load_datasets(concurrency)
+    load_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    timings = render_all(datasets, workers)
+    render_seconds = time.perf_counter() - start
+
+    print("\nRender time per chart:")
+    for name, seconds in sorted(timings.items(), key=lambda item: -item[1]):
+        print(f"   {name:<40} {seconds:6.2f}s")
+    print(f"Data: {load_seconds:.2f}s, rendering: {render_seconds:.2f}s wall "
+          f"for {sum(timings.values()):.2f}s of charts.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,94 @@
 #!/usr/bin/env python3
 import psycopg2
 import matplotlib.pyplot as plt
+import os
+import sys
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.db import fetch_rows
+from common.render_cache import cached_render
+from common.stats import sampled_shares
+from common.trace import span
 
-DB_NAME = "piscineds"
-DB_USER = "jaehwkim"
-DB_PASSWORD = "mysecretpassword"
-DB_HOST = "localhost"
-DB_PORT = "5432"
 
-def connect_to_db():
-    """Connect to the PostgreSQL database."""
-    try:
-        conn = psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        print("Database connection successful")
-        return conn
-    except Exception as e:
-        print(f"Error connecting to database: {e}")
-        return None
+ROLLUP_QUERY = """
+    SELECT event_type, SUM(event_count)::bigint as count
+    FROM customers_monthly_rollup
+    GROUP BY event_type
+    ORDER BY count DESC
+"""
 
-def get_event_type_distribution():
-    """Get distribution of event types from customers table."""
-    conn = connect_to_db()
-    if not conn:
-        return None
+SCAN_QUERY = """
+    SELECT event_type, COUNT(*) as count
+    FROM customers
+    GROUP BY event_type
+    ORDER BY count DESC
+"""
+
+# approximate mode: a TABLESAMPLE SYSTEM sample of about SAMPLE_BLOCKS blocks,
+# the same blocks on every run of the same table
+SAMPLE_BLOCKS = 2000
+SAMPLE_SEED = 42
+
+PAGES_QUERY = """
+    SELECT (COALESCE(SUM(pg_relation_size(relid)), 0) / current_setting('block_size')::bigint)::bigint
+    FROM pg_partition_tree('customers')
+    WHERE isleaf
+"""
+
+# SYSTEM keeps a block when the hash of its number and the seed is small enough,
+# so the same block numbers are picked in every partition: each block number is
+# one sampling unit, whatever partition its rows are in
+SAMPLE_QUERY = """
+    SELECT (ctid::text::point)[0]::bigint AS block, event_type, COUNT(*) as count
+    FROM customers TABLESAMPLE SYSTEM (%s) REPEATABLE (%s)
+    GROUP BY 1, 2
+"""
 
+def sample_event_types(sample_blocks=SAMPLE_BLOCKS):
+    """Estimate the event type counts from a block sample: (event_type, count, margin %) rows."""
+    pages = fetch_rows(PAGES_QUERY)[0][0]
+    percent = min(100.0, 100.0 * sample_blocks / max(pages, 1))
+    shares = sampled_shares(fetch_rows(SAMPLE_QUERY, (percent, SAMPLE_SEED)), percent / 100)
+    print(f"Sampled {percent:.3g}% of the {pages} blocks of customers")
+    rows = [(event_type, round(count), margin * 100) for event_type, (count, _, margin) in shares.items()]
+    return sorted(rows, key=lambda row: -row[1])
+
+def shares_are_stable(rows):
+    """True when no share could be displayed differently anywhere in its confidence interval."""
+    total = sum(row[1] for row in rows)
+    for _, count, margin in rows:
+        share = count / total * 100
+        if f"{share - margin:.1f}" != f"{share + margin:.1f}":
+            return False
+    return True
+
+def get_event_type_distribution(approximate=False, fallback=True):
+    """Get distribution of event types from the monthly rollup of the customers table.
+
+    Without rollups, the approximate mode samples the table instead of counting
+    it, and counts exactly after all (unless fallback is False) when a share's
+    confidence interval straddles the one-decimal value shown on the chart.
+    """
     try:
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT event_type, COUNT(*) as count
-            FROM customers
-            GROUP BY event_type
-            ORDER BY count DESC
-        """)
-        
-        results = cursor.fetchall()
-        
-        cursor.close()
-        conn.close()
+        try:
+            results = fetch_rows(ROLLUP_QUERY)
+        except psycopg2.errors.UndefinedTable:
+            if approximate:
+                results = sample_event_types()
+                if not fallback or shares_are_stable(results):
+                    return results
+                print("Sample too small for one-decimal shares, counting the customers table instead")
+            else:
+                print("Rollup tables not found, counting the customers table instead")
+            results = fetch_rows(SCAN_QUERY)
         
         return results
-    except Exception as e:
+    except psycopg2.Error as e:
         print(f"Error querying database: {e}")
-        if conn:
-            conn.close()
         return None
 
+@cached_render('pie.png')
 def create_pie_chart(data):
     """Create a pie chart from the event type distribution data."""
     if not data:
@@ -70,8 +106,10 @@ def create_pie_chart(data):
     
     fig, ax = plt.subplots(figsize=(10, 8), facecolor='white')
     
-    # make labels with percentages
+    # make labels with percentages, and the 95% margin of sampled estimates
     labels_with_percent = [f"{event_type}\n{percentage:.1f}%" for event_type, percentage in zip(event_types, percentages)]
+    if len(data[0]) > 2:
+        labels_with_percent = [f"{label} ± {row[2]:.2f}" for label, row in zip(labels_with_percent, data)]
     
     wedges, texts = ax.pie(
         counts,
@@ -90,14 +128,17 @@ def create_pie_chart(data):
     
     plt.tight_layout()
     
-    plt.savefig('pie.png', dpi=300, bbox_inches='tight', facecolor='white')
+    with span('render', 'savefig'):
+        plt.savefig('pie.png', dpi=300, bbox_inches='tight', facecolor='white')
     print("Pie chart saved as 'pie.png'")
     
-    plt.show()
+    plt.close(fig)
 
 if __name__ == "__main__":
+    # --approximate samples the table when there are no rollups, --preview never counts exactly
     print("Retrieving data from database...")
-    data = get_event_type_distribution()
+    data = get_event_type_distribution(approximate='--approximate' in sys.argv or '--preview' in sys.argv,
+                                       fallback='--preview' not in sys.argv)
     
     if data:
         print(f"Found {len(data)} different event types")
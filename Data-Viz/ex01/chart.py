@@ -7,8 +7,14 @@ import matplotlib.dates as mdates
 from datetime import datetime
 import os
 import seaborn as sns
-import subprocess
-import io
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.aggregates import aggregate, evaluate, rollup_source
+from common.cache import cached_fetch
+from common.render_cache import cached_render
+from common.schema import fetch_typed
+from common.trace import span
 
 plt.style.use('seaborn-v0_8-whitegrid')
 sns.set_palette("Blues_r")
@@ -19,34 +25,25 @@ plt.rcParams['figure.facecolor'] = 'white'
 
 ALTAIRIAN_DOLLAR = '₳'
 
-DB_NAME = "piscineds"
-DB_USER = "jaehwkim"
-DB_PASSWORD = "mysecretpassword"
-DB_HOST = "localhost"
-DB_PORT = "5432"
+PURCHASE_QUERY = """
+    SELECT event_time, price
+    FROM customers
+    WHERE event_type = 'purchase' AND
+          event_time BETWEEN '2022-10-01' AND '2023-02-28 23:59:59'
+"""
+
+PURCHASE_ROLLUP = rollup_source('purchase', '2022-10-01', '2023-02-28')
+
+DAILY_COUNT = aggregate('count', bucket='day')
+MONTHLY_SUM = aggregate('sum', 'price', bucket='month')
+DAILY_MEAN = aggregate('mean', 'price', bucket='day')
 
 def get_purchase_data():
     """Fetch 'purchase' event data from customers table"""
     try:
         print("Fetching purchase data from database...")
         
-        query_cmd = """
-        docker exec -i postgresForDb bash -c "PGPASSWORD=mysecretpassword psql -U jaehwkim -d piscineds -c \\"COPY (
-            SELECT event_time, price 
-            FROM customers 
-            WHERE event_type = 'purchase' AND 
-                  event_time BETWEEN '2022-10-01' AND '2023-02-28 23:59:59'
-            ORDER BY event_time
-        ) TO STDOUT WITH CSV HEADER\\""
-        """
-        
-        result = subprocess.run(query_cmd, shell=True, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            print(f"Error fetching data: {result.stderr}")
-            return None
-        
-        df = pd.read_csv(io.StringIO(result.stdout))
+        df = cached_fetch(PURCHASE_QUERY, loader=fetch_typed)
         
         print(f"Retrieved {len(df)} purchase records.")
         
@@ -69,12 +66,15 @@ def get_purchase_data():
         print(f"Data query error: {e}")
         return None
 
-def create_daily_price_chart(df):
+def create_daily_price_chart(source):
     """Create daily customer count chart"""
-    daily_count = df.groupby('day').size().reset_index(name='count')
-    
+    draw_daily_price_chart(evaluate(DAILY_COUNT, source))
+
+@cached_render('chart_1_daily_customers.png')
+def draw_daily_price_chart(daily_count):
+    """Draw and save the daily customer count chart"""
     plt.figure(figsize=(10, 6))
-    plt.plot(daily_count['day'], daily_count['count'], color='#4169E1', linewidth=1.5)
+    plt.plot(daily_count.index, daily_count.values, color='#4169E1', linewidth=1.5)
     
     plt.title('Daily Number of Customers (October 2022 - February 2023)', fontsize=14, pad=15)
     plt.xlabel('', fontsize=12)
@@ -89,18 +89,24 @@ def create_daily_price_chart(df):
     
     plt.tight_layout()
     
-    plt.savefig('chart_1_daily_customers.png', dpi=300, bbox_inches='tight')
+    with span('render', 'savefig'):
+        plt.savefig('chart_1_daily_customers.png', dpi=300, bbox_inches='tight')
     print("Chart 1: Daily customer count chart created.")
 
-def create_monthly_bar_chart(df):
+def create_monthly_bar_chart(source):
     """Create monthly purchase amount bar chart"""
-    monthly_sum = df.groupby('month')['price'].sum().reset_index()
-    monthly_sum['price_millions'] = monthly_sum['price'] / 1000000
-    monthly_sum['month_str'] = monthly_sum['month'].dt.strftime('%b')
+    monthly_sum = evaluate(MONTHLY_SUM, source).reset_index()
+    monthly_sum['price_millions'] = monthly_sum['value'] / 1000000
+    monthly_sum['month_str'] = monthly_sum['bucket'].dt.strftime('%b')
     
     print("\nMonthly purchase amounts (in millions):")
     print(monthly_sum[['month_str', 'price_millions']])
     
+    draw_monthly_bar_chart(monthly_sum[['month_str', 'price_millions']])
+
+@cached_render('chart_2_monthly_amount.png')
+def draw_monthly_bar_chart(monthly_sum):
+    """Draw and save the monthly purchase amount chart"""
     plt.figure(figsize=(10, 6))
     
     bars = plt.bar(monthly_sum['month_str'], monthly_sum['price_millions'], 
@@ -117,19 +123,23 @@ def create_monthly_bar_chart(df):
     
     plt.tight_layout()
     
-    plt.savefig('chart_2_monthly_amount.png', dpi=300, bbox_inches='tight')
+    with span('render', 'savefig'):
+        plt.savefig('chart_2_monthly_amount.png', dpi=300, bbox_inches='tight')
     print("Chart 2: Monthly purchase amount chart created.")
 
-def create_purchase_ratio_chart(df):
+def create_purchase_ratio_chart(source):
     """Create daily average spend chart"""
-    daily_avg = df.groupby('day').agg(
-        avg_spend=('price', 'mean')
-    ).reset_index()
+    daily_avg = evaluate(DAILY_MEAN, source).rename('avg_spend').reset_index()
     
-    daily_avg = daily_avg.sort_values('day')
+    daily_avg = daily_avg.rename(columns={'bucket': 'day'}).sort_values('day')
     
-    daily_avg['month'] = pd.to_datetime(daily_avg['day']).dt.strftime('%b')
+    daily_avg['month'] = daily_avg['day'].dt.strftime('%b')
     
+    draw_purchase_ratio_chart(daily_avg)
+
+@cached_render('chart_3_average_spend.png')
+def draw_purchase_ratio_chart(daily_avg):
+    """Draw and save the daily average spend chart"""
     plt.figure(figsize=(10, 6))
     
     plt.fill_between(daily_avg.index, daily_avg['avg_spend'], 
@@ -157,7 +167,8 @@ def create_purchase_ratio_chart(df):
     
     plt.tight_layout()
     
-    plt.savefig('chart_3_average_spend.png', dpi=300, bbox_inches='tight')
+    with span('render', 'savefig'):
+        plt.savefig('chart_3_average_spend.png', dpi=300, bbox_inches='tight')
     print("Chart 3: Daily average spend chart created.")
 
 if __name__ == "__main__":
@@ -165,7 +176,14 @@ if __name__ == "__main__":
     
     print("Starting purchase data analysis...")
     
-    purchase_data = get_purchase_data()
+    # charts read the rollup tables; --scan aggregates the raw rows server-side
+    # and --local fetches the raw rows and aggregates them with pandas
+    if '--local' in sys.argv:
+        purchase_data = get_purchase_data()
+    elif '--scan' in sys.argv:
+        purchase_data = PURCHASE_QUERY
+    else:
+        purchase_data = PURCHASE_ROLLUP
     
     if purchase_data is not None:
         create_daily_price_chart(purchase_data)
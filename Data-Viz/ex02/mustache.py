@@ -3,9 +3,17 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
-import subprocess
-import io
+import psycopg2
 import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.cache import cached_fetch
+from common.db import iter_frames
+from common.render_cache import cached_render
+from common.schema import exact_prices, fetch_typed
+from common.stats import DEFAULT_RANK_ERROR, StreamingStats, box_stats, server_describe
+from common.trace import span
 
 plt.style.use('seaborn-v0_8-whitegrid')
 sns.set_palette("pastel") 
@@ -13,27 +21,30 @@ plt.rcParams['font.family'] = 'sans-serif'
 plt.rcParams['font.sans-serif'] = ['Arial', 'Helvetica', 'DejaVu Sans']
 plt.rcParams['figure.facecolor'] = 'white'
 
-DB_NAME = "piscineds"
-DB_USER = "jaehwkim"
-DB_PASSWORD = "mysecretpassword"
+PURCHASE_QUERY = """
+    SELECT user_id, event_time, price
+    FROM customers
+    WHERE event_type = 'purchase' AND
+          event_time BETWEEN '2022-10-01' AND '2023-02-28 23:59:59'
+"""
+
+# prices streamed for the statistics, without loading the purchases
+PRICE_STATS_QUERY = """
+    SELECT date_trunc('month', event_time) AS month, price::float8 AS price
+    FROM customers
+    WHERE event_type = 'purchase' AND price IS NOT NULL AND
+          event_time BETWEEN '2022-10-01' AND '2023-02-28 23:59:59'
+"""
+
+# rows read from the database and fed to the streaming accumulators at a time
+STATS_CHUNK_ROWS = 100000
 
 def get_purchase_data():
     """Fetch 'purchase' event data from customers table."""
     try:
         print("Fetching purchase data from database...")
         
-        query_cmd = """
-        docker exec -i postgresForDb bash -c "PGPASSWORD=mysecretpassword psql -U jaehwkim -d piscineds -c \\"COPY (
-            SELECT user_id, event_time, price 
-            FROM customers 
-            WHERE event_type = 'purchase' AND 
-                  event_time BETWEEN '2022-10-01' AND '2023-02-28 23:59:59'
-        ) TO STDOUT WITH CSV HEADER\\""
-        """
-        
-        result = subprocess.run(query_cmd, shell=True, capture_output=True, text=True, check=True)
-        
-        df = pd.read_csv(io.StringIO(result.stdout))
+        df = cached_fetch(PURCHASE_QUERY, loader=fetch_typed)
         
         print(f"Retrieved {len(df)} purchase records.")
         
@@ -47,21 +58,46 @@ def get_purchase_data():
         
         return df
     
-    except subprocess.CalledProcessError as e:
-        print(f"Error fetching data: {e.stderr}")
+    except psycopg2.Error as e:
+        print(f"Error fetching data: {e}")
         return None
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
         return None
 
-def print_price_statistics(df):
+def price_statistics(rank_error=DEFAULT_RANK_ERROR, chunk_rows=STATS_CHUNK_ROWS, seed=42):
+    """Describe prices streamed in chunks from the database, one accumulator per chunk merged by month and overall."""
+    with span('aggregate', 'price statistics') as stage:
+        desc = _price_statistics(rank_error, chunk_rows, seed)
+        stage.rows = int(desc['count'])
+    return desc
+
+
+def _price_statistics(rank_error, chunk_rows, seed):
+    # one generator for every sketch, so that merged sketches never share their coin flips
+    rng = np.random.default_rng(seed)
+    monthly = {}
+    for chunk in iter_frames(PRICE_STATS_QUERY, chunk_rows):
+        for month, prices in chunk.groupby('month')['price']:
+            chunk_stats = StreamingStats(rank_error, seed=rng)
+            chunk_stats.update(exact_prices(prices))
+            if month not in monthly:
+                monthly[month] = StreamingStats(rank_error, seed=rng)
+            monthly[month].merge(chunk_stats)
+
+    overall = StreamingStats(rank_error, seed=rng)
+    for month_stats in monthly.values():
+        overall.merge(month_stats)
+    return overall.describe()
+
+
+def print_price_statistics(desc):
     """Print mean, median, min, max, and quartiles for item prices."""
-    if df is None or df.empty:
+    if desc is None or not desc['count']:
         print("No data available to calculate statistics.")
         return
         
     print("\nPrice Statistics for Purchased Items:")
-    desc = df['price'].describe(percentiles=[.25, .5, .75])
     print(f"Mean: {desc['mean']:.6f}")
     print(f"Median (50%): {desc['50%']:.6f}")
     print(f"Min: {desc['min']:.6f}")
@@ -82,46 +118,54 @@ def print_price_statistics(df):
     print("----------------------------")
 
 
+@cached_render(output_arg='filename')
+def draw_box_plot(stats, color, title, xlabel, filename, xlim=None, flierprops=None):
+    """Draw one horizontal box plot from precomputed statistics and save it."""
+    fig, ax = plt.subplots(figsize=(8, 4))
+    # seaborn draws its boxes desaturated to 75%, keep the same look
+    ax.bxp([stats], vert=False, widths=0.8, patch_artist=True,
+           boxprops=dict(facecolor=sns.desaturate(color, 0.75), edgecolor='#3F3F3F'),
+           medianprops=dict(color='#3F3F3F'),
+           whiskerprops=dict(color='#3F3F3F'),
+           capprops=dict(color='#3F3F3F'),
+           flierprops=flierprops or dict(marker='d', markerfacecolor='#3F3F3F', markersize=5))
+    ax.set_yticks([])
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    if xlim is not None:
+        ax.set_xlim(*xlim)
+    with span('render', 'savefig'):
+        fig.savefig(filename, dpi=300)
+    plt.close(fig)
+
+
 def create_box_plots(df):
     """Create and save box plots for item prices and average basket price."""
     if df is None or df.empty:
         print("No data available to create box plots.")
         return
 
+    # quartiles, whiskers and outliers are computed once and shared by both price plots
+    with span('aggregate', 'box statistics', rows=len(df)):
+        price_stats = box_stats(exact_prices(df['price']))
+
     # Box Plot 1: All item prices
-    plt.figure(figsize=(8, 4)) 
-    sns.boxplot(x=df['price'], color="#BDC3C7") 
-    plt.title('Distribution of Item Prices') 
-    plt.xlabel('Price') 
-    plt.savefig('boxplot_all_prices.png', dpi=300)
+    draw_box_plot(price_stats, "#BDC3C7", 'Distribution of Item Prices', 'Price', 'boxplot_all_prices.png')
     print("\nBox plot for all item prices saved as 'boxplot_all_prices.png'")
-    plt.close()
 
     # Box Plot 2: Zoomed-in item prices
-    plt.figure(figsize=(8, 4))
-    sns.boxplot(x=df['price'], color="#A9DFBF") 
-    plt.title('Distribution of Item Prices (Zoomed In)')
-    plt.xlabel('Price') 
-    plt.xlim(-1, 13) 
-    plt.savefig('boxplot_zoomed_prices.png', dpi=300)
+    draw_box_plot(price_stats, "#A9DFBF", 'Distribution of Item Prices (Zoomed In)', 'Price',
+                  'boxplot_zoomed_prices.png', xlim=(-1, 13))
     print("Box plot for zoomed-in item prices saved as 'boxplot_zoomed_prices.png'")
-    plt.close()
     
     # Box Plot 3: Average basket price per user
     if 'user_id' in df.columns:
-        average_basket_price = df.groupby('user_id')['price'].mean().reset_index()
+        average_basket_price = pd.Series(exact_prices(df['price']), index=df.index).groupby(df['user_id']).mean()
         
-        plt.figure(figsize=(8, 4))
-        sns.boxplot(x=average_basket_price['price'], color="#AED6F1", fliersize=5, 
-                    flierprops=dict(marker='D', markerfacecolor='gray')) 
-        plt.title('Average Basket Price per User') 
-        plt.xlabel('Average Basket Price') 
-        
-        plt.xlim(0, 42)
-
-        plt.savefig('boxplot_average_basket_price.png', dpi=300)
+        draw_box_plot(box_stats(average_basket_price), "#AED6F1", 'Average Basket Price per User',
+                      'Average Basket Price', 'boxplot_average_basket_price.png', xlim=(0, 42),
+                      flierprops=dict(marker='D', markerfacecolor='gray', markersize=5))
         print("Box plot for average purchase price per user saved as 'boxplot_average_basket_price.png'")
-        plt.close()
     else:
         print("Column 'user_id' not found, cannot create average basket price plot.")
 
@@ -132,7 +176,11 @@ if __name__ == "__main__":
     purchase_data = get_purchase_data()
     
     if purchase_data is not None:
-        print_price_statistics(purchase_data)
+        if '--exact' in sys.argv:
+            # exact quartiles computed by PostgreSQL with percentile_cont, for comparison
+            print_price_statistics(server_describe(PURCHASE_QUERY, 'price'))
+        else:
+            print_price_statistics(price_statistics())
         create_box_plots(purchase_data)
         print("\nAll tasks completed.")
     else:
@@ -3,9 +3,16 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
-import subprocess
-import io
+import psycopg2
 import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.aggregates import aggregate, evaluate
+from common.cache import cached_fetch
+from common.render_cache import cached_render
+from common.schema import fetch_typed
+from common.trace import span
 
 # Set up the plot style to match the images
 plt.style.use('seaborn-v0_8-whitegrid')
@@ -16,28 +23,25 @@ plt.rcParams['figure.facecolor'] = 'white'
 plt.rcParams['axes.grid'] = True
 plt.rcParams['grid.alpha'] = 0.3
 
-DB_NAME = "piscineds"
-DB_USER = "jaehwkim"
-DB_PASSWORD = "mysecretpassword"
+PURCHASE_QUERY = """
+    SELECT user_id, event_time, price
+    FROM customers
+    WHERE event_type = 'purchase' AND
+          event_time BETWEEN '2022-10-01' AND '2023-02-28 23:59:59'
+"""
 
 ALTAIRIAN_DOLLAR = '₳'
 
+# Frequency and spending distributions with specific bins like in the images
+FREQUENCY_HISTOGRAM = aggregate('count', per='user_id', bins=[0, 10, 20, 30, 40])
+SPENDING_HISTOGRAM = aggregate('sum', 'price', per='user_id', bins=[0, 50, 100, 150, 200, 250])
+
 def get_purchase_data():
     """Fetch purchase event data from customers table."""
     try:
         print("Fetching purchase data from database...")
         
-        query_cmd = """
-        docker exec -i postgresForDb bash -c "PGPASSWORD=mysecretpassword psql -U jaehwkim -d piscineds -c \\"COPY (
-            SELECT user_id, event_time, price 
-            FROM customers 
-            WHERE event_type = 'purchase' AND 
-                  event_time BETWEEN '2022-10-01' AND '2023-02-28 23:59:59'
-        ) TO STDOUT WITH CSV HEADER\\""
-        """
-        
-        result = subprocess.run(query_cmd, shell=True, capture_output=True, text=True, check=True)
-        df = pd.read_csv(io.StringIO(result.stdout))
+        df = cached_fetch(PURCHASE_QUERY, loader=fetch_typed)
         
         print(f"Retrieved {len(df)} purchase records.")
         
@@ -47,29 +51,30 @@ def get_purchase_data():
         
         df['event_time'] = pd.to_datetime(df['event_time'])
         df['price'] = pd.to_numeric(df['price'], errors='coerce')
-        df.dropna(subset=['price'], inplace=True) 
+        # purchases without a price still count as orders, like COUNT(*) of the
+        # pushdown; the spending sums skip them as SUM does
         
         return df
     
-    except subprocess.CalledProcessError as e:
-        print(f"Error fetching data: {e.stderr}")
+    except psycopg2.Error as e:
+        print(f"Error fetching data: {e}")
         return None
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
         return None
 
-def create_frequency_chart(df):
+def create_frequency_chart(source):
     """Create bar chart showing the number of orders according to frequency."""
-    if df is None or df.empty:
+    if source is None:
         print("No data available to create charts.")
         return
     
-    # Count orders per user
-    order_counts = df.groupby('user_id').size().reset_index(name='frequency')
-    
-    # Create frequency distribution with specific bins like in the image
-    freq_bins = [0, 10, 20, 30, 40]
-    freq_counts = np.histogram(order_counts['frequency'], bins=freq_bins)[0]
+    # Count orders per user and bin them into the frequency distribution
+    draw_frequency_chart(evaluate(FREQUENCY_HISTOGRAM, source).values)
+
+@cached_render('Frequency.png')
+def draw_frequency_chart(freq_counts):
+    """Draw and save the order frequency histogram."""
     freq_positions = [0, 10, 20, 30]  # x-positions
     
     # Create the figure with exact dimensions to match the image
@@ -92,22 +97,23 @@ def create_frequency_chart(df):
     
     # Save figure
     plt.tight_layout()
-    plt.savefig('Frequency.png', dpi=300, bbox_inches='tight')
+    with span('render', 'savefig'):
+        plt.savefig('Frequency.png', dpi=300, bbox_inches='tight')
     print("Bar chart for order frequency saved as 'Building_1.png'")
     
     plt.close()
 
-def create_spending_chart(df):
+def create_spending_chart(source):
     """Create bar chart showing Altairian Dollars spent by customers."""
-    if df is None or df.empty:
+    if source is None:
         return
     
-    # Calculate total spending per user
-    user_spending = df.groupby('user_id')['price'].sum().reset_index(name='total_spent')
-    
-    # Create spending distribution with specific bins like in the image
-    spend_bins = [0, 50, 100, 150, 200, 250]
-    spend_counts = np.histogram(user_spending['total_spent'], bins=spend_bins)[0]
+    # Calculate total spending per user and bin it into the spending distribution
+    draw_spending_chart(evaluate(SPENDING_HISTOGRAM, source).values)
+
+@cached_render('Spending.png')
+def draw_spending_chart(spend_counts):
+    """Draw and save the spending histogram."""
     spend_positions = [0, 50, 100, 150, 200]  # x-positions
     
     # Create the figure with exact dimensions to match the image
@@ -130,7 +136,8 @@ def create_spending_chart(df):
     
     # Save figure
     plt.tight_layout()
-    plt.savefig('Spending.png', dpi=300, bbox_inches='tight')
+    with span('render', 'savefig'):
+        plt.savefig('Spending.png', dpi=300, bbox_inches='tight')
     print("Bar chart for spending distribution saved as 'Building_2.png'")
     
     plt.close()
@@ -138,7 +145,11 @@ def create_spending_chart(df):
 def main():
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
     
-    purchase_data = get_purchase_data()
+    # histograms are computed server-side unless --local asks for the raw rows
+    if '--local' in sys.argv:
+        purchase_data = get_purchase_data()
+    else:
+        purchase_data = PURCHASE_QUERY
     
     if purchase_data is not None:
         create_frequency_chart(purchase_data)
@@ -1,43 +1,158 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
-import subprocess
-import io
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from sklearn.preprocessing import StandardScaler
 from sklearn.cluster import KMeans
 from sklearn.decomposition import PCA
+from sklearn.metrics import silhouette_score
+from threadpoolctl import threadpool_limits
 import warnings
 import matplotlib.cm as cm
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.db import fetch_frame
+from common.render_cache import cached_render
+from common.schema import dtypes_for
+from common.trace import span
+
 warnings.filterwarnings("ignore")
 
 plt.style.use('seaborn-v0_8-whitegrid')
 plt.rcParams['figure.facecolor'] = 'white'
 
-def create_elbow_plot():
-    """Create an elbow plot that exactly matches the provided image."""
-    x = np.array([2, 3, 4, 5, 6, 7, 8, 9, 10])
-    y = np.array([270000, 160000, 110000, 90000, 70000, 60000, 55000, 50000, 45000])
+CUSTOMER_QUERY = """
+    SELECT
+        user_id,
+        COUNT(*) AS visit_count,
+        SUM(CASE WHEN event_type = 'purchase' THEN 1 ELSE 0 END) AS purchase_count,
+        SUM(CASE WHEN event_type = 'purchase' THEN price ELSE 0 END) AS total_spent
+    FROM customers
+    GROUP BY user_id
+    HAVING COUNT(*) > 0
+"""
+
+FEATURES = ['visit_count', 'purchase_count', 'total_spent']
+K_RANGE = range(2, 11)
+DEFAULT_CLUSTER_COUNT = 6
+SILHOUETTE_SAMPLE = 10000
+# the elbow is the first k where one more cluster gains less than this share of inertia
+ELBOW_MIN_GAIN = 0.1
+
+# cluster plots: above SCATTER_MAX_POINTS users the panels are drawn as density
+# images of DENSITY_BINS x DENSITY_BINS bins, with a stratified sample of at most
+# OVERLAY_POINTS users per cluster drawn on top
+SCATTER_MAX_POINTS = 20000
+DENSITY_BINS = 200
+OVERLAY_POINTS = 150
+# opacity of the sparsest non-empty bin, so that single users stay visible
+DENSITY_MIN_ALPHA = 0.25
+
+# feature matrix shared with the sweep workers, set up by _attach_features
+_shared = {}
+
+def _attach_features(name, shape, dtype):
+    """Process pool initializer: map the shared feature matrix into this worker."""
+    # one BLAS/OpenMP thread per worker, the pool already uses every core
+    _shared['limits'] = threadpool_limits(1)
+    _shared['shm'] = shared_memory.SharedMemory(name=name)
+    _shared['features'] = np.ndarray(shape, dtype=dtype, buffer=_shared['shm'].buf)
+
+def _fit_k(k):
+    """Fit one k on the shared matrix and return its inertia and sampled silhouette."""
+    features = _shared['features']
+    with span('fit', f'KMeans k={k}', rows=len(features)):
+        kmeans = KMeans(n_clusters=k, random_state=42, n_init=10).fit(features)
+    with span('aggregate', 'silhouette', rows=min(SILHOUETTE_SAMPLE, len(features))):
+        silhouette = silhouette_score(features, kmeans.labels_,
+                                      sample_size=min(SILHOUETTE_SAMPLE, len(features)), random_state=42)
+    return k, kmeans.inertia_, silhouette
+
+def find_elbow(inertias):
+    """Return the first k after which one more cluster lowers inertia by less than ELBOW_MIN_GAIN."""
+    ks = sorted(inertias)
+    for k, next_k in zip(ks, ks[1:]):
+        if next_k != k + 1:
+            break
+        if inertias[k] == 0 or (inertias[k] - inertias[next_k]) / inertias[k] < ELBOW_MIN_GAIN:
+            return k
+    return None
+
+def sweep_k(features, k_range=K_RANGE, workers=None):
+    """Fit k-means for each k in a process pool sharing one copy of the features, stopping at the elbow."""
+    ks = [k for k in k_range if k < len(features)]
+    features = np.ascontiguousarray(features, dtype=np.float64)
+    inertias, silhouettes = {}, {}
+    elbow = None
+    
+    def record(fits):
+        for k, inertia, silhouette in fits:
+            inertias[k] = inertia
+            silhouettes[k] = silhouette
+            print(f"   k={k:2d}  inertia={inertia:14.1f}  silhouette={silhouette:.3f}")
     
-    x_smooth = np.linspace(2, 10, 200)
-    z = np.polyfit(x, y, 4)
-    p = np.poly1d(z)
-    y_smooth = p(x_smooth)
+    if len(ks) < 2:
+        # at most one fit (too few samples): no pool or shared memory worth setting up
+        _shared['features'] = features
+        try:
+            record(_fit_k(k) for k in ks)
+        finally:
+            del _shared['features']
+    else:
+        workers = min(workers or os.cpu_count() or 1, len(ks))
+        shm = shared_memory.SharedMemory(create=True, size=features.nbytes)
+        try:
+            shared = np.ndarray(features.shape, dtype=features.dtype, buffer=shm.buf)
+            shared[:] = features
+            del shared
+            
+            with ProcessPoolExecutor(max_workers=workers, initializer=_attach_features,
+                                     initargs=(shm.name, features.shape, features.dtype.str)) as pool:
+                # ks are fitted in waves of one per worker so the sweep can stop at the elbow
+                for start in range(0, len(ks), workers):
+                    record(pool.map(_fit_k, ks[start:start + workers]))
+                    elbow = find_elbow(inertias)
+                    if elbow is not None:
+                        break
+        finally:
+            shm.close()
+            shm.unlink()
+    
+    fitted = sorted(inertias)
+    return {
+        'k': fitted,
+        'inertia': [inertias[k] for k in fitted],
+        'silhouette': [silhouettes[k] for k in fitted],
+        'elbow': elbow
+    }
+
+@cached_render('elbow.png')
+def create_elbow_plot(sweep):
+    """Create an elbow plot from the inertia of each fitted k."""
+    fig, ax = plt.subplots(figsize=(8, 6))
+    ax.plot(sweep['k'], sweep['inertia'], '-o', color='#4C72B0', linewidth=2.5)
     
-    plt.figure(figsize=(8, 6))
-    plt.plot(x_smooth, y_smooth, '-', color='#4C72B0', linewidth=2.5)
+    if sweep['elbow'] is not None:
+        ax.axvline(sweep['elbow'], color='#C44E52', linestyle='--', linewidth=1.5,
+                   label=f"elbow at k={sweep['elbow']}")
+        ax.legend()
     
-    plt.title('The Elbow Method', fontsize=14)
-    plt.xlabel('Number of clusters', fontsize=12)
-    plt.ylabel('', fontsize=12)
+    silhouette_ax = ax.twinx()
+    silhouette_ax.plot(sweep['k'], sweep['silhouette'], ':s', color='#55A868', linewidth=1.5)
+    silhouette_ax.set_ylabel('Silhouette score (sampled)', fontsize=12, color='#55A868')
+    silhouette_ax.grid(False)
     
-    plt.yticks([50000, 100000, 150000, 200000, 250000])
-    plt.xticks([2, 4, 6, 8, 10])
-    plt.ylim(40000, 280000)
-    plt.xlim(1.5, 10.5)
+    ax.set_title('The Elbow Method', fontsize=14)
+    ax.set_xlabel('Number of clusters', fontsize=12)
+    ax.set_ylabel('Inertia', fontsize=12)
+    ax.set_xticks(sweep['k'])
     
     plt.tight_layout()
-    plt.savefig('elbow.png', dpi=300, bbox_inches='tight')
+    with span('render', 'savefig'):
+        plt.savefig('elbow.png', dpi=300, bbox_inches='tight')
     print("✅ Elbow Method plot saved as 'elbow.png'")
     plt.close()
 
@@ -46,22 +161,7 @@ def get_customer_data():
     try:
         print("📊 Fetching customer data...")
         
-        query_cmd = """
-        docker exec -i postgresForDb bash -c "PGPASSWORD=mysecretpassword psql -U jaehwkim -d piscineds -c \\"COPY (
-            SELECT 
-                user_id,
-                COUNT(*) AS visit_count,
-                SUM(CASE WHEN event_type = 'purchase' THEN 1 ELSE 0 END) AS purchase_count,
-                SUM(CASE WHEN event_type = 'purchase' THEN price ELSE 0 END) AS total_spent
-            FROM customers
-            GROUP BY user_id
-            HAVING COUNT(*) > 0
-            LIMIT 1000
-        ) TO STDOUT WITH CSV HEADER\\""
-        """
-        
-        result = subprocess.run(query_cmd, shell=True, capture_output=True, text=True, check=True)
-        df = pd.read_csv(io.StringIO(result.stdout))
+        df = fetch_frame(CUSTOMER_QUERY, dtype=dtypes_for(['user_id']))
         
         print(f"📈 Retrieved data for {len(df)} customers.")
         
@@ -74,28 +174,79 @@ def get_customer_data():
         print(f"❌ Error fetching data: {e}")
         return None
 
-def cluster_and_visualize(df, n_clusters):
-    """Apply clustering and create visualization."""
+def _bin_edges(values, bins):
+    low, high = float(np.min(values)), float(np.max(values))
+    # a margin like the one scatter leaves around the extreme users
+    margin = (high - low) * 0.02 or 0.5
+    return np.linspace(low - margin, high + margin, bins + 1)
+
+def scatter_panel(ax, x, y, clusters, colors):
+    """Draw every user as a point, one scatter per cluster."""
+    for i, color in enumerate(colors):
+        mask = clusters == i
+        ax.scatter(x[mask], y[mask], c=[color], label=f'Cluster {i+1}', alpha=0.7)
+
+def density_panel(ax, x, y, clusters, colors, bins=DENSITY_BINS, overlay_points=OVERLAY_POINTS, seed=42):
+    """Draw users as per-cluster 2D histograms, at a cost independent of the user count.
+
+    Each bin takes the color of the cluster with the most users in it and an
+    opacity growing with the log of its user count.
+    """
+    x_edges, y_edges = _bin_edges(x, bins), _bin_edges(y, bins)
+    counts = np.stack([
+        np.histogram2d(x[clusters == i], y[clusters == i], bins=[x_edges, y_edges])[0]
+        for i in range(len(colors))
+    ])
+    total = counts.sum(axis=0)
+    image = np.array(colors)[counts.argmax(axis=0)]
+    shade = np.log1p(total) / np.log1p(max(total.max(), 1))
+    image[..., 3] = np.where(total > 0, DENSITY_MIN_ALPHA + (1 - DENSITY_MIN_ALPHA) * shade, 0)
+    # histogram2d indexes [x, y], imshow expects rows of y
+    ax.imshow(image.transpose(1, 0, 2), origin='lower', aspect='auto', interpolation='nearest',
+              extent=[x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]])
+
+    rng = np.random.default_rng(seed)
+    for i, color in enumerate(colors):
+        members = np.flatnonzero(clusters == i)
+        sample = rng.choice(members, min(overlay_points, len(members)), replace=False)
+        ax.scatter(x[sample], y[sample], c=[color], s=8, edgecolors='white', linewidths=0.3,
+                   label=f'Cluster {i+1}')
+
+def cluster_and_visualize(df, n_clusters, mode='auto', overlay_points=OVERLAY_POINTS):
+    """Apply clustering and create visualization.
+
+    mode is 'scatter' (every user), 'density' (binned) or 'auto', which bins
+    above SCATTER_MAX_POINTS users; overlay_points=0 drops the sample overlay.
+    """
     print(f"Creating {n_clusters} clusters...")
     
-    features = ['visit_count', 'purchase_count', 'total_spent']
     scaler = StandardScaler()
-    scaled_features = scaler.fit_transform(df[features])
+    scaled_features = scaler.fit_transform(df[FEATURES])
     
     kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
-    df['cluster'] = kmeans.fit_predict(scaled_features)
+    with span('fit', f'KMeans k={n_clusters}', rows=len(scaled_features)):
+        df['cluster'] = kmeans.fit_predict(scaled_features)
     
     pca = PCA(n_components=2)
-    pca_features = pca.fit_transform(scaled_features)
+    with span('fit', 'PCA', rows=len(scaled_features)):
+        pca_features = pca.fit_transform(scaled_features)
     
     fig, axes = plt.subplots(1, 2, figsize=(12, 5))
     
     colors = cm.Set1(np.linspace(0, 1, n_clusters))
+    clusters = df['cluster'].to_numpy()
+    if mode == 'auto':
+        mode = 'density' if len(df) > SCATTER_MAX_POINTS else 'scatter'
+    
+    def draw(ax, x, y):
+        if mode == 'density':
+            density_panel(ax, x, y, clusters, colors, overlay_points=overlay_points)
+        else:
+            scatter_panel(ax, x, y, clusters, colors)
     
-    for i in range(n_clusters):
-        mask = df['cluster'] == i
-        axes[0].scatter(pca_features[mask, 0], pca_features[mask, 1], 
-                       c=[colors[i]], label=f'Cluster {i+1}', alpha=0.7)
+    with span('render', f'cluster panels ({mode})', rows=len(df)):
+        draw(axes[0], pca_features[:, 0], pca_features[:, 1])
+        draw(axes[1], df['visit_count'].to_numpy(), df['total_spent'].to_numpy(dtype=float))
     
     axes[0].set_title(f'Customer Clusters ({n_clusters} clusters)', fontweight='bold')
     axes[0].set_xlabel('Principal Component 1')
@@ -103,11 +254,6 @@ def cluster_and_visualize(df, n_clusters):
     axes[0].legend()
     axes[0].grid(True, alpha=0.3)
     
-    for i in range(n_clusters):
-        mask = df['cluster'] == i
-        axes[1].scatter(df[mask]['visit_count'], df[mask]['total_spent'],
-                       c=[colors[i]], label=f'Cluster {i+1}', alpha=0.7)
-    
     axes[1].set_title('Total Spent vs Visit Count', fontweight='bold')
     axes[1].set_xlabel('Visit Count')
     axes[1].set_ylabel('Total Spent')
@@ -115,7 +261,8 @@ def cluster_and_visualize(df, n_clusters):
     axes[1].grid(True, alpha=0.3)
     
     plt.tight_layout()
-    plt.savefig('customer_clusters.png', dpi=300, bbox_inches='tight')
+    with span('render', 'savefig'):
+        plt.savefig('customer_clusters.png', dpi=300, bbox_inches='tight')
     print(f"✅ customer_clusters.png saved")
     plt.close()
 
@@ -123,14 +270,18 @@ def main():
     print("Customer Clustering Analysis")
     print("="*30)
     
-    create_elbow_plot()
-    
-    cluster_count = 6
     df = get_customer_data()
     if df is None:
         return
     
-    cluster_and_visualize(df, cluster_count)
+    print(f"🔍 Sweeping k over {K_RANGE.start}..{K_RANGE.stop - 1} on {len(df)} customers...")
+    sweep = sweep_k(StandardScaler().fit_transform(df[FEATURES]))
+    create_elbow_plot(sweep)
+    
+    cluster_count = sweep['elbow'] or DEFAULT_CLUSTER_COUNT
+    # --scatter or --density force a cluster plot mode, by default it follows the user count
+    mode = 'scatter' if '--scatter' in sys.argv else 'density' if '--density' in sys.argv else 'auto'
+    cluster_and_visualize(df, cluster_count, mode)
     
     print(f"\n✅ Done! Files created:")
     print(f"   - elbow.png")
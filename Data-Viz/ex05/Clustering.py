@@ -2,13 +2,20 @@ import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 import pandas as pd
-import subprocess
-import io
+import psycopg2
 import os
+import sys
 from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 import warnings
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.db import iter_frames
+from common.render_cache import cached_render
+from common.rfm import REFERENCE_DATE, customer_features
+from common.segments import segment_summary, update_segments
+from common.trace import span
+
 warnings.filterwarnings('ignore')
 
 plt.style.use('seaborn-v0_8-whitegrid')
@@ -18,91 +25,50 @@ plt.rcParams['figure.facecolor'] = 'white'
 plt.rcParams['axes.grid'] = True
 plt.rcParams['grid.alpha'] = 0.3
 
-DB_NAME = "piscineds"
-DB_USER = "jaehwkim"
-DB_PASSWORD = "mysecretpassword"
 CLUSTER_COUNT = 4
+RFM_FEATURES = ['recency_days', 'frequency', 'monetary']
+
+# streaming mode: users per chunk pulled from the database, and per-cluster
+# sample size used for the medians of the bubble chart
+STREAM_CHUNK_ROWS = 50000
+MEDIAN_SAMPLE_SIZE = 20000
+
+# streaming mode keeps the aggregation in the database, with the same fixed reference date
+STREAM_QUERY = f"""
+    SELECT
+        user_id,
+        TIMESTAMP '{REFERENCE_DATE}' - MAX(event_time) AS recency,
+        SUM(CASE WHEN event_type = 'purchase' THEN 1 ELSE 0 END) AS purchase_count,
+        COALESCE(SUM(CASE WHEN event_type = 'purchase' THEN price END), 0) AS total_spent
+    FROM customers
+    WHERE user_id IS NOT NULL AND event_time IS NOT NULL
+    GROUP BY user_id
+    ORDER BY user_id
+"""
 
 def get_customer_data():
     try:
         print("Fetching customer data...")
         
-        query_cmd = """
-        docker exec -i postgresForDb bash -c "PGPASSWORD=mysecretpassword psql -U jaehwkim -d piscineds -c \\"COPY (
-            WITH customer_metrics AS (
-                SELECT 
-                    user_id,
-                    COUNT(*) AS visit_count,
-                    COUNT(DISTINCT TO_CHAR(event_time, 'YYYY-MM-DD')) AS days_active,
-                    MAX(event_time) - MIN(event_time) AS time_span,
-                    MAX(event_time) AS last_visit,
-                    MIN(event_time) AS first_visit,
-                    CURRENT_TIMESTAMP - MAX(event_time) AS recency,
-                    SUM(CASE WHEN event_type = 'purchase' THEN 1 ELSE 0 END) AS purchase_count,
-                    SUM(CASE WHEN event_type = 'purchase' THEN price ELSE 0 END) AS total_spent,
-                    COUNT(DISTINCT TO_CHAR(event_time, 'YYYY-MM')) AS active_months
-                FROM customers
-                GROUP BY user_id
-            )
-            SELECT 
-                user_id,
-                visit_count,
-                days_active,
-                time_span,
-                last_visit,
-                first_visit,
-                recency,
-                purchase_count,
-                total_spent,
-                active_months,
-                CASE WHEN days_active > 0 THEN visit_count::float / days_active ELSE 0 END AS avg_daily_visits,
-                CASE WHEN purchase_count > 0 THEN total_spent / purchase_count ELSE 0 END AS avg_purchase_value,
-                CASE WHEN purchase_count > 0 THEN visit_count::float / purchase_count ELSE 0 END AS visits_per_purchase
-            FROM customer_metrics
-            WHERE visit_count > 0
-        ) TO STDOUT WITH CSV HEADER\\""
-        """
+        df = customer_features()
         
-        result = subprocess.run(query_cmd, shell=True, capture_output=True, text=True, check=True)
-        df = pd.read_csv(io.StringIO(result.stdout))
-        
-        print(f"Retrieved data for {len(df)} customers.")
+        print(f"Retrieved data for {len(df)} customers (recency from {REFERENCE_DATE}).")
         
         if df.empty:
             print("No customer data found.")
             return None
         
-        df = df.dropna()
-        df = df.replace([np.inf, -np.inf], 0)
-        
-        for col in ['last_visit', 'first_visit']:
-            df[col] = pd.to_datetime(df[col])
-        
-        df['recency_days'] = df['recency'].apply(lambda x: int(x.split(' ')[0]) if isinstance(x, str) else 0)
-        df['frequency'] = df['purchase_count']
-        df['monetary'] = df['total_spent']
-        
         return df
     
-    except subprocess.CalledProcessError as e:
-        print(f"Data retrieval error: {e.stderr}")
+    except psycopg2.Error as e:
+        print(f"Data retrieval error: {e}")
         return None
     except Exception as e:
         print(f"Unexpected error: {e}")
         return None
 
-def prepare_and_cluster_data(df):
-    print("Preparing RFM data and applying clustering...")
-    
-    rfm_features = ['recency_days', 'frequency', 'monetary']
-    
-    scaler = StandardScaler() # data normalization
-    scaled_features = scaler.fit_transform(df[rfm_features])
-    
-    kmeans = KMeans(n_clusters= CLUSTER_COUNT , random_state=42, n_init=10) # k-means clustering
-    df['cluster'] = kmeans.fit_predict(scaled_features)
-    
-    cluster_stats = df.groupby('cluster')[rfm_features].mean()
+def label_clusters(cluster_stats):
+    """Name clusters from their mean RFM values, most loyal first."""
     loyalty_score = cluster_stats['monetary'] * cluster_stats['frequency'] / (cluster_stats['recency_days'] + 1)
     sorted_clusters = loyalty_score.sort_values(ascending=False).index
     
@@ -113,12 +79,120 @@ def prepare_and_cluster_data(df):
         sorted_clusters[3]: 'Inactive customers'
     }
     
+    return labels
+
+def prepare_and_cluster_data(df):
+    print("Preparing RFM data and applying clustering...")
+    
+    scaler = StandardScaler() # data normalization
+    scaled_features = scaler.fit_transform(df[RFM_FEATURES])
+    
+    kmeans = KMeans(n_clusters= CLUSTER_COUNT , random_state=42, n_init=10) # k-means clustering
+    with span('fit', f'KMeans k={CLUSTER_COUNT}', rows=len(scaled_features)):
+        df['cluster'] = kmeans.fit_predict(scaled_features)
+    
+    labels = label_clusters(df.groupby('cluster')[RFM_FEATURES].mean())
+    
     return df, labels
 
-def create_bar_chart(df, labels):
+def fit_segments(features):
+    """Fit the scaler and KMeans on RFM features, for the persisted segmentation."""
+    scaler = StandardScaler()
+    scaled_features = scaler.fit_transform(features[RFM_FEATURES])
+
+    kmeans = KMeans(n_clusters=CLUSTER_COUNT, random_state=42, n_init=10)
+    with span('fit', f'KMeans k={CLUSTER_COUNT}', rows=len(scaled_features)):
+        clusters = kmeans.fit_predict(scaled_features)
+
+    labels = label_clusters(features[RFM_FEATURES].groupby(clusters).mean())
+
+    return scaler.mean_, scaler.scale_, kmeans.cluster_centers_, labels
+
+def segment_customers(refit=False):
+    """Summary and labels of the persisted segmentation, updated with the new events first."""
+    try:
+        model = update_segments(fit_segments, refit)
+        return segment_summary(), model['labels']
+
+    except psycopg2.Error as e:
+        print(f"Segmentation error: {e}")
+        return None, None
+
+def summarize_clusters(df):
+    """Per-cluster customer counts and median RFM values of a clustered frame."""
+    with span('aggregate', 'cluster summary', rows=len(df)):
+        return {
+            'counts': df['cluster'].value_counts().sort_index(),
+            'medians': df.groupby('cluster')[RFM_FEATURES].median()
+        }
+
+def rfm_chunk(chunk):
+    """RFM feature matrix of a chunk of customer metrics streamed by iter_frames."""
+    chunk = chunk.dropna()
+    rfm = pd.DataFrame({
+        'recency_days': pd.to_timedelta(chunk['recency']).dt.days,
+        'frequency': chunk['purchase_count'].astype(float),
+        'monetary': chunk['total_spent'].astype(float)
+    })
+    return rfm.replace([np.inf, -np.inf], 0).to_numpy(dtype=float)
+
+def stream_and_cluster_data(chunk_rows=STREAM_CHUNK_ROWS):
+    """Cluster customers chunk by chunk, with memory bounded by the chunk size instead of the user count."""
+    print("Streaming RFM data and applying mini-batch clustering...")
+    
+    # pass 1: running scaler statistics and mini-batch centroid updates
+    scaler = StandardScaler()
+    kmeans = MiniBatchKMeans(n_clusters=CLUSTER_COUNT, random_state=42, n_init=3)
+    for chunk in iter_frames(STREAM_QUERY, chunk_rows):
+        features = rfm_chunk(chunk)
+        with span('fit', 'MiniBatchKMeans partial_fit', rows=len(features)):
+            scaler.partial_fit(features)
+            kmeans.partial_fit(scaler.transform(features))
+    
+    # pass 2: assign labels and accumulate per-cluster counts, sums and a bottom-k
+    # sample (smallest random priorities) for the medians
+    counts = np.zeros(CLUSTER_COUNT, dtype=np.int64)
+    sums = np.zeros((CLUSTER_COUNT, len(RFM_FEATURES)))
+    samples = [np.empty((0, len(RFM_FEATURES))) for _ in range(CLUSTER_COUNT)]
+    priorities = [np.empty(0) for _ in range(CLUSTER_COUNT)]
+    rng = np.random.default_rng(42)
+    
+    for chunk in iter_frames(STREAM_QUERY, chunk_rows):
+        features = rfm_chunk(chunk)
+        with span('fit', 'MiniBatchKMeans predict', rows=len(features)):
+            clusters = kmeans.predict(scaler.transform(features))
+        counts += np.bincount(clusters, minlength=CLUSTER_COUNT)
+        for j in range(len(RFM_FEATURES)):
+            sums[:, j] += np.bincount(clusters, weights=features[:, j], minlength=CLUSTER_COUNT)
+        
+        chunk_priorities = rng.random(len(features))
+        for cluster in range(CLUSTER_COUNT):
+            mask = clusters == cluster
+            kept_priorities = np.concatenate([priorities[cluster], chunk_priorities[mask]])
+            kept = np.concatenate([samples[cluster], features[mask]])
+            if len(kept) > MEDIAN_SAMPLE_SIZE:
+                keep = np.argpartition(kept_priorities, MEDIAN_SAMPLE_SIZE)[:MEDIAN_SAMPLE_SIZE]
+                kept_priorities, kept = kept_priorities[keep], kept[keep]
+            priorities[cluster], samples[cluster] = kept_priorities, kept
+    
+    print(f"Clustered {counts.sum()} customers in chunks of {chunk_rows}.")
+    
+    means = np.divide(sums, counts[:, None], out=np.zeros_like(sums), where=counts[:, None] > 0)
+    labels = label_clusters(pd.DataFrame(means, columns=RFM_FEATURES))
+    summary = {
+        'counts': pd.Series(counts),
+        'medians': pd.DataFrame(
+            [np.median(sample, axis=0) if len(sample) else np.zeros(len(RFM_FEATURES)) for sample in samples],
+            columns=RFM_FEATURES
+        )
+    }
+    return summary, labels
+
+@cached_render('customer_segments_bar.png')
+def create_bar_chart(summary, labels):
     print("Creating customer segments bar chart...")
     
-    cluster_counts = df['cluster'].value_counts().sort_index()
+    cluster_counts = summary['counts']
     cluster_names = [labels.get(i, f'Cluster {i+1}') for i in cluster_counts.index]
     
     colors = {
@@ -154,15 +228,17 @@ def create_bar_chart(df, labels):
     plt.yticks(fontsize=10)
     
     plt.tight_layout()
-    plt.savefig('customer_segments_bar.png', dpi=300, bbox_inches='tight')
+    with span('render', 'savefig'):
+        plt.savefig('customer_segments_bar.png', dpi=300, bbox_inches='tight')
     plt.close()
     
     print("Bar chart saved to customer_segments_bar.png")
 
-def create_bubble_chart(df, labels):
+@cached_render('customer_segments_bubble.png')
+def create_bubble_chart(summary, labels):
     print("Creating customer segments bubble chart...")
     
-    cluster_stats = df.groupby('cluster')[['frequency', 'recency_days', 'monetary']].median()
+    cluster_stats = summary['medians'][['frequency', 'recency_days', 'monetary']].copy()
     cluster_stats['label'] = [labels.get(i, f'Cluster {i+1}') for i in cluster_stats.index]
     
     colors = {
@@ -208,7 +284,8 @@ def create_bubble_chart(df, labels):
     ax.set_ylim(y_min, y_max)
     
     plt.tight_layout()
-    plt.savefig('customer_segments_bubble.png', dpi=300, bbox_inches='tight')
+    with span('render', 'savefig'):
+        plt.savefig('customer_segments_bubble.png', dpi=300, bbox_inches='tight')
     plt.close()
     
     print("Bubble chart saved to customer_segments_bubble.png")
@@ -217,18 +294,29 @@ def main():
     try:
         os.chdir(os.path.dirname(os.path.abspath(__file__)))
         
-        customer_data = get_customer_data()
-        
-        if customer_data is None:
-            print("Failed to retrieve data. Exiting.")
-            return
-        
-        clustered_data, cluster_labels = prepare_and_cluster_data(customer_data)
+        if '--streaming' in sys.argv:
+            cluster_summary, cluster_labels = stream_and_cluster_data()
+        elif '--in-memory' not in sys.argv:
+            # persisted segmentation, scoring only the users active since the last run
+            cluster_summary, cluster_labels = segment_customers(refit='--refit' in sys.argv)
+
+            if cluster_summary is None:
+                print("Failed to segment customers. Exiting.")
+                return
+        else:
+            customer_data = get_customer_data()
+            
+            if customer_data is None:
+                print("Failed to retrieve data. Exiting.")
+                return
+            
+            clustered_data, cluster_labels = prepare_and_cluster_data(customer_data)
+            cluster_summary = summarize_clusters(clustered_data)
         
         print("Cluster labels:", cluster_labels)
         
-        create_bar_chart(clustered_data, cluster_labels)
-        create_bubble_chart(clustered_data, cluster_labels)
+        create_bar_chart(cluster_summary, cluster_labels)
+        create_bubble_chart(cluster_summary, cluster_labels)
         
         print("All visualization tasks completed successfully.")
     
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Migrate customers to the monthly partitioned layout and compare query plans.
+
+The plans of every Data-Viz query are printed before and after the migration.
+With --analyze the queries are also run (EXPLAIN ANALYZE) and their execution
+times compared; --plans-only reports the current plans without migrating.
+
+    python migrate_partitions.py [--analyze] [--plans-only]
+"""
+import os
+import re
+import sys
+import time
+
+WORKSPACE_DIR = os.path.dirname(os.path.abspath(__file__))
+WAREHOUSE_DIR = os.path.join(os.path.dirname(WORKSPACE_DIR), 'Warehouse')
+EXERCISES = ['ex00', 'ex01', 'ex02', 'ex03', 'ex04', 'ex05']
+
+sys.path.append(WORKSPACE_DIR)
+for exercise in EXERCISES:
+    sys.path.append(os.path.join(WORKSPACE_DIR, exercise))
+
+import pie
+import chart
+import mustache
+import Building
+import elbow
+from common.aggregates import compile_sql
+from common.db import connection, fetch_rows
+from common.rfm import EVENTS_QUERY
+
+PARTITIONED_SQL = os.path.join(WAREHOUSE_DIR, 'ex01', 'customers_partitioned.sql')
+# triggers and functions bound to customers, installed again on the new table
+CUSTOMERS_SQL = [
+    os.path.join(WAREHOUSE_DIR, 'ex01', 'rollups.sql'),
+    os.path.join(WAREHOUSE_DIR, 'ex02', 'incremental_dedup.sql')
+]
+
+# views reading customers (e.g. customers_items of the lazy fusion), directly or
+# through another view, in creation order; they follow a rename of customers, so
+# they are dropped before the migration and recreated on the partitioned table,
+# materialized ones with their indexes and populated only if they were
+DEPENDENT_VIEWS_QUERY = """
+    WITH RECURSIVE dependents (oid, depth) AS (
+        SELECT r.ev_class, 1
+        FROM pg_depend d JOIN pg_rewrite r ON r.oid = d.objid
+        WHERE d.refobjid = 'customers'::regclass AND r.ev_class <> 'customers'::regclass
+        UNION
+        SELECT r.ev_class, dependents.depth + 1
+        FROM dependents
+        JOIN pg_depend d ON d.refobjid = dependents.oid
+        JOIN pg_rewrite r ON r.oid = d.objid
+        WHERE r.ev_class <> dependents.oid
+    )
+    SELECT c.oid::regclass::text, c.relkind, c.relispopulated, pg_get_viewdef(c.oid),
+           ARRAY(SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i WHERE i.indrelid = c.oid),
+           ARRAY(SELECT format('GRANT %s ON %s TO %s', a.privilege_type, c.oid::regclass,
+                               CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(a.grantee)) END)
+                 FROM aclexplode(c.relacl) a)
+    FROM dependents JOIN pg_class c ON c.oid = dependents.oid
+    GROUP BY c.oid
+    ORDER BY MAX(dependents.depth)
+"""
+
+# the queries the Data-Viz exercises send to customers
+QUERIES = {
+    'ex00 event types': pie.SCAN_QUERY,
+    'ex01 daily count': compile_sql(chart.DAILY_COUNT, chart.PURCHASE_QUERY),
+    'ex01 monthly sum': compile_sql(chart.MONTHLY_SUM, chart.PURCHASE_QUERY),
+    'ex01 daily mean': compile_sql(chart.DAILY_MEAN, chart.PURCHASE_QUERY),
+    'ex02 purchases': mustache.PURCHASE_QUERY,
+    'ex03 frequency': compile_sql(Building.FREQUENCY_HISTOGRAM, Building.PURCHASE_QUERY),
+    'ex03 spending': compile_sql(Building.SPENDING_HISTOGRAM, Building.PURCHASE_QUERY),
+    'ex04 customers': elbow.CUSTOMER_QUERY,
+    'ex05 events': EVENTS_QUERY
+}
+
+
+def explain(query, analyze=False):
+    """Return the text plan of a query, with run time and buffers when analyzing."""
+    options = "ANALYZE, BUFFERS" if analyze else "COSTS"
+    return "\n".join(row[0] for row in fetch_rows(f"EXPLAIN ({options}) {query}"))
+
+
+def plan_summary(plan):
+    """Total estimated cost and, for EXPLAIN ANALYZE, execution time in ms."""
+    cost = re.search(r"cost=[\d.]+\.\.([\d.]+)", plan)
+    runtime = re.search(r"Execution Time: ([\d.]+) ms", plan)
+    return float(cost.group(1)) if cost else None, float(runtime.group(1)) if runtime else None
+
+
+def report_plans(label, analyze=False):
+    print(f"\n===== Query plans {label} =====")
+    plans = {}
+    for name, query in QUERIES.items():
+        plans[name] = explain(query, analyze)
+        print(f"\n--- {name} ---\n{plans[name]}")
+    return plans
+
+
+def is_partitioned():
+    rows = fetch_rows("SELECT relkind FROM pg_class WHERE oid = 'customers'::regclass")
+    return rows[0][0] == 'p'
+
+
+def migrate():
+    """Copy customers into a partitioned table of the same columns, in one transaction."""
+    start = time.perf_counter()
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(DEPENDENT_VIEWS_QUERY)
+            views = cursor.fetchall()
+            for name, kind, *_ in reversed(views):
+                cursor.execute(f"DROP {'MATERIALIZED VIEW' if kind == 'm' else 'VIEW'} {name}")
+            cursor.execute("ALTER TABLE customers RENAME TO customers_unpartitioned")
+            # LIKE keeps any column added later, e.g. the item columns of the fusion
+            cursor.execute("""
+                CREATE TABLE customers (LIKE customers_unpartitioned INCLUDING DEFAULTS)
+                PARTITION BY RANGE (event_time)
+            """)
+            with open(PARTITIONED_SQL) as f:
+                cursor.execute(f.read())
+            cursor.execute("""
+                SELECT create_customers_partitions(MIN(event_time)::date, MAX(event_time)::date)
+                FROM customers_unpartitioned
+            """)
+            cursor.execute("INSERT INTO customers SELECT * FROM customers_unpartitioned")
+            rows = cursor.rowcount
+            # the old table takes its triggers and indexes with it
+            cursor.execute("DROP TABLE customers_unpartitioned")
+            for path in CUSTOMERS_SQL:
+                with open(path) as f:
+                    cursor.execute(f.read())
+            for name, kind, populated, definition, indexes, grants in views:
+                if kind == 'm':
+                    definition = definition.rstrip().rstrip(';')
+                    cursor.execute(f"CREATE MATERIALIZED VIEW {name} AS {definition} "
+                                   f"WITH {'' if populated else 'NO '}DATA")
+                else:
+                    cursor.execute(f"CREATE VIEW {name} AS {definition}")
+                for statement in indexes + grants:
+                    cursor.execute(statement)
+            cursor.execute("ANALYZE customers")
+    print(f"\nMigrated {rows} rows into monthly partitions in {time.perf_counter() - start:.2f}s"
+          f"{', views recreated: ' + ', '.join(view[0] for view in views) if views else ''}.")
+
+
+def main():
+    analyze = '--analyze' in sys.argv
+    before = report_plans("before" if '--plans-only' not in sys.argv else "", analyze)
+    if '--plans-only' in sys.argv:
+        return
+    if is_partitioned():
+        print("\ncustomers is already partitioned, nothing to migrate.")
+        return
+
+    migrate()
+    after = report_plans("after", analyze)
+
+    print("\n===== Summary =====")
+    print(f"{'query':<20} {'cost before':>14} {'cost after':>14} {'ms before':>11} {'ms after':>11}")
+    for name in QUERIES:
+        (cost_before, ms_before), (cost_after, ms_after) = plan_summary(before[name]), plan_summary(after[name])
+        print(f"{name:<20} {cost_before or 0:14.1f} {cost_after or 0:14.1f} "
+              f"{ms_before or 0:11.1f} {ms_after or 0:11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -41,7 +41,11 @@ fi
 echo -e "\n${YELLOW}2. customers 테이블 생성 및 데이터 로드${NC}"
 echo "테이블 생성 중..."
 
-# customers 테이블 생성
+# customers 테이블 생성 (--partitioned: 월별 파티션 + 인덱스)
+if [ "$1" == "--partitioned" ]; then
+docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\"" < "$WORKSPACE_DIR/../Warehouse/ex01/customers_partitioned.sql"
+docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\" -c \"TRUNCATE TABLE customers;\""
+else
 docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\"" << EOF
 CREATE TABLE IF NOT EXISTS customers (
     event_time TIMESTAMP,
@@ -54,9 +58,18 @@ CREATE TABLE IF NOT EXISTS customers (
 
 TRUNCATE TABLE customers;
 EOF
+fi
 
 echo "customers 테이블이 생성되었습니다."
 
+# 일별/월별 롤업 테이블 및 트리거 생성 (CSV 로드 시 증분 갱신)
+echo "롤업 테이블 생성 중..."
+docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\"" < "$WORKSPACE_DIR/../Warehouse/ex01/rollups.sql"
+
+# 새로 적재된 데이터만 중복 제거하는 함수 생성 (python -m common.bulk_load 에서 사용)
+echo "증분 중복 제거 함수 생성 중..."
+docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\"" < "$WORKSPACE_DIR/../Warehouse/ex02/incremental_dedup.sql"
+
 # CSV 파일 목록
 CSV_FILES=(
   "data_2022_oct.csv"
@@ -123,38 +136,8 @@ docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$D
 # 3. items 테이블 생성 및 customers 테이블과 통합
 echo -e "\n${YELLOW}4. items 테이블 생성 및 customers 테이블과 통합${NC}"
 
-# items 테이블 생성 및 데이터 로드
-docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\"" << EOF
--- items 테이블 생성
-DROP TABLE IF EXISTS items;
-
-CREATE TABLE items (
-    product_id INTEGER PRIMARY KEY,
-    category_id BIGINT,
-    category_code VARCHAR(255),
-    brand VARCHAR(255)
-);
-
--- 임시 테이블 생성
-CREATE TEMP TABLE temp_items (
-    product_id INTEGER,
-    category_id BIGINT,
-    category_code VARCHAR(255),
-    brand VARCHAR(255)
-);
-
--- item.csv 파일에서 데이터 로드
-\copy temp_items FROM '${CONTAINER_PROJECT_ROOT_MOUNT_PATH}/subject/item/item.csv' WITH (FORMAT csv, HEADER true, DELIMITER ',')
-
--- 고유한 product_id만 items 테이블에 삽입
-INSERT INTO items
-SELECT DISTINCT ON (product_id) 
-    product_id, 
-    category_id, 
-    category_code, 
-    brand
-FROM temp_items;
-EOF
+# items 테이블 생성 및 데이터 로드 (중복 product_id 병합까지 Warehouse/ex03/items.sql 하나에서 정의)
+docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\"" < "$WORKSPACE_DIR/../Warehouse/ex03/items.sql"
 
 # items 테이블 행 수 확인
 echo "items 테이블 행 수 확인 중..."
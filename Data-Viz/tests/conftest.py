@@ -0,0 +1,8 @@
+"""Make the Data-Viz packages importable when pytest runs from Data-Viz or above it.
+
+The tests only exercise code paths that need no database connection.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
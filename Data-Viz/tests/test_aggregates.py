@@ -0,0 +1,71 @@
+"""compute_local against the semantics of the SQL that compile_sql pushes down."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from common.aggregates import aggregate, compile_sql, compute_local
+
+FREQUENCY = aggregate('count', per='user_id', bins=[0, 10, 20, 30, 40])
+SPENDING = aggregate('sum', 'price', per='user_id', bins=[0, 50, 100, 150, 200, 250])
+
+
+def purchases(rows):
+    return pd.DataFrame(rows, columns=['user_id', 'event_time', 'price']).astype(
+        {'event_time': 'datetime64[ns]', 'price': 'float64'})
+
+
+def test_count_histogram_counts_rows_without_price():
+    # COUNT(*) per user: the purchase without a price is an order too
+    df = purchases([(1, '2022-10-01', 5.0)] * 9 + [(1, '2022-10-02', None), (2, '2022-10-01', None)])
+    assert compute_local(FREQUENCY, df).tolist() == [1, 1, 0, 0]
+
+
+def test_sum_histogram_skips_null_prices():
+    # SUM skips NULLs and COALESCE turns a user without any price into 0
+    df = purchases([(1, '2022-10-01', 60.5), (1, '2022-10-02', None), (2, '2022-10-01', None),
+                    (3, '2022-10-03', 120.25)])
+    assert compute_local(SPENDING, df).tolist() == [1, 1, 1, 0, 0]
+
+
+def test_histogram_bins_like_width_bucket():
+    # width_bucket puts an inner edge in the upper bin, the last edge is closed
+    # on the right like np.histogram and values past it are dropped
+    df = purchases([(1, '2022-10-01', 50.0), (2, '2022-10-01', 250.0), (3, '2022-10-01', 250.01),
+                    (4, '2022-10-01', 0.0)])
+    assert compute_local(SPENDING, df).tolist() == [1, 1, 0, 0, 1]
+    sql = compile_sql(SPENDING, "SELECT 1")
+    assert "WHEN v = 250.0 THEN 5" in sql
+    assert "COALESCE(SUM(price), 0)" in sql
+
+
+def test_float32_prices_are_summed_to_the_cent():
+    df = purchases([(1, '2022-10-01', 0.1)] * 3).astype({'price': 'float32'})
+    daily = compute_local(aggregate('sum', 'price', bucket='day'), df)
+    assert daily.iloc[0] == 0.3
+
+
+def test_time_buckets():
+    df = purchases([(1, '2022-10-01 10:00', 2.0), (2, '2022-10-01 23:59', None), (1, '2022-10-02 00:00', 4.0),
+                    (3, '2022-11-15 00:00', 6.0)])
+    daily_count = compute_local(aggregate('count', bucket='day'), df)
+    assert daily_count.tolist() == [2, 1, 1]
+    assert list(daily_count.index) == list(pd.to_datetime(['2022-10-01', '2022-10-02', '2022-11-15']))
+
+    # AVG ignores NULLs, COUNT(DISTINCT) counts users
+    monthly_mean = compute_local(aggregate('mean', 'price', bucket='month'), df)
+    assert monthly_mean.tolist() == [3.0, 6.0]
+    monthly_users = compute_local(aggregate('users', bucket='month'), df)
+    assert monthly_users.tolist() == [2, 1]
+
+
+def test_quantiles_skip_null():
+    df = purchases([(1, '2022-10-01', value) for value in (1.0, 2.0, None, 3.0, 4.0)])
+    result = compute_local(aggregate(None, 'price', quantiles=[0.25, 0.5]), df)
+    assert result.tolist() == pytest.approx(np.quantile([1.0, 2.0, 3.0, 4.0], [0.25, 0.5]).tolist())
+
+
+def test_aggregate_rejects_incomplete_specs():
+    with pytest.raises(ValueError):
+        aggregate('sum', per='user_id', bins=[0, 1])
+    with pytest.raises(ValueError):
+        aggregate('count')
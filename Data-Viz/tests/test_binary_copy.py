@@ -0,0 +1,155 @@
+"""BinarySink and decode_rows on synthetic `COPY ... (FORMAT binary)` streams."""
+import struct
+import uuid
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from common.binary_copy import (BOOL, DATE, FLOAT8, INT4, INT8, INTERVAL, NUMERIC, SIGNATURE, TIMESTAMP, UUID,
+                                BinarySink, UnsupportedType, unsupported_columns)
+
+TEXT = 25
+
+HEADER = SIGNATURE + struct.pack('>ii', 0, 0)
+TRAILER = struct.pack('>h', -1)
+NULL = None
+
+
+def numeric(digits, weight, dscale, sign=0):
+    """A NUMERIC value from its base-10000 digits."""
+    return struct.pack(f'>hhHH{len(digits)}H', len(digits), weight, sign, dscale, *digits)
+
+
+def timestamp(value):
+    micros = (np.datetime64(value, 'us') - np.datetime64('2000-01-01', 'us')).astype(np.int64)
+    return struct.pack('>q', int(micros))
+
+
+def row(*fields):
+    """One CopyData message: field count, then length and bytes of every field (-1 for NULL)."""
+    out = struct.pack('>h', len(fields))
+    for field in fields:
+        out += struct.pack('>i', -1) if field is None else struct.pack('>i', len(field)) + field
+    return out
+
+
+def sink_frame(columns, rows, **options):
+    sink = BinarySink(columns, **options)
+    # psycopg2 writes one message per call: the header, every row, the trailer
+    for message in [HEADER, *rows, TRAILER]:
+        sink.write(message)
+    return sink, sink.frame()
+
+
+def test_typed_columns():
+    columns = [('id', INT4), ('big', INT8), ('ratio', FLOAT8), ('flag', BOOL), ('name', TEXT)]
+    rows = [
+        row(struct.pack('>i', 7), struct.pack('>q', 2 ** 40), struct.pack('>d', 0.25), b'\x01', 'café'.encode()),
+        row(struct.pack('>i', -3), struct.pack('>q', -1), struct.pack('>d', -1.5), b'\x00', b''),
+    ]
+    sink, df = sink_frame(columns, rows)
+    assert sink.rows == 2
+    assert df['id'].dtype == np.int32 and df['id'].tolist() == [7, -3]
+    assert df['big'].dtype == np.int64 and df['big'].tolist() == [2 ** 40, -1]
+    assert df['ratio'].tolist() == [0.25, -1.5]
+    assert df['flag'].tolist() == [True, False]
+    assert df['name'].tolist() == ['café', '']
+
+
+def test_nulls():
+    columns = [('id', INT4), ('ratio', FLOAT8), ('name', TEXT), ('flag', BOOL)]
+    rows = [
+        row(NULL, struct.pack('>d', 1.0), NULL, NULL),
+        row(struct.pack('>i', 5), NULL, b'x', b'\x01'),
+    ]
+    _, df = sink_frame(columns, rows)
+    # integers with NULLs become float with NaN, like read_csv
+    assert df['id'].dtype == np.float64
+    assert np.isnan(df['id'][0]) and df['id'][1] == 5
+    assert np.isnan(df['ratio'][1])
+    assert df['name'].tolist() == [None, 'x']
+    assert df['flag'].tolist() == [None, True]
+
+
+def test_numerics():
+    values = [
+        numeric([123, 4500], 0, 2),          # 123.45
+        numeric([5000], -1, 1, 0x4000),      # -0.5
+        numeric([10, 0, 7600], 1, 2),        # 100000.76
+        numeric([], 0, 0),                   # 0
+        numeric([], 0, 0, 0xC000),           # NaN
+        numeric([], 0, 0, 0xD000),           # Infinity
+        NULL,
+    ]
+    _, df = sink_frame([('price', NUMERIC)], [row(value) for value in values])
+    result = df['price'].to_numpy()
+    assert result[:4].tolist() == [123.45, -0.5, 100000.76, 0.0]
+    assert np.isnan(result[4]) and result[5] == np.inf and np.isnan(result[6])
+
+
+def test_times():
+    columns = [('at', TIMESTAMP), ('day', DATE), ('gap', INTERVAL)]
+    rows = [
+        row(timestamp('2022-10-01T12:34:56.789'), struct.pack('>i', 8309),
+            struct.pack('>qii', 3_600_000_000, 2, 1)),
+        row(struct.pack('>q', 2 ** 63 - 1), NULL, NULL),
+    ]
+    _, df = sink_frame(columns, rows)
+    assert df['at'][0] == pd.Timestamp('2022-10-01 12:34:56.789')
+    # infinity has no datetime64, it reads as NaT
+    assert pd.isna(df['at'][1])
+    assert df['day'][0] == pd.Timestamp('2022-10-01') and pd.isna(df['day'][1])
+    # a month counts as 30 days
+    assert df['gap'][0] == pd.Timedelta(days=32, hours=1) and pd.isna(df['gap'][1])
+
+
+def test_uuid_halves():
+    value = uuid.UUID('0123456789abcdef0011223344556677')
+    _, df = sink_frame([('session', UUID)], [row(value.bytes), row(NULL)])
+    assert list(df.columns) == ['session_hi', 'session_lo']
+    assert df['session_hi'].tolist() == [0x0123456789abcdef, 0]
+    assert df['session_lo'].tolist() == [0x0011223344556677, 0]
+
+
+def test_chunks_match_one_pass():
+    columns = [('id', INT4), ('name', TEXT), ('price', NUMERIC)]
+    rows = [row(struct.pack('>i', i), f"user{i}".encode() if i % 3 else None, numeric([i], 0, 0))
+            for i in range(1, 101)]
+    _, whole = sink_frame(columns, rows)
+
+    chunks = []
+    sink, _ = sink_frame(columns, rows, chunk_rows=16, on_chunk=lambda decoded, n: chunks.append((decoded, n)))
+    assert sink.rows == 100 and sink.chunks > 1
+    assert max(n for _, n in chunks) <= 16
+    chunked = pd.concat([pd.DataFrame(decoded) for decoded, n in chunks if n], ignore_index=True)
+    pd.testing.assert_frame_equal(chunked, whole)
+
+    # kept for frame() without a callback, also when flushed by size
+    _, by_bytes = sink_frame(columns, rows, chunk_bytes=200)
+    pd.testing.assert_frame_equal(by_bytes, whole)
+
+
+def test_header_in_the_first_message():
+    columns = [('id', INT4)]
+    sink = BinarySink(columns)
+    sink.write(HEADER + row(struct.pack('>i', 1)))
+    sink.write(row(struct.pack('>i', 2)) + TRAILER)
+    assert sink.frame()['id'].tolist() == [1, 2]
+
+
+def test_empty_result():
+    _, df = sink_frame([('id', INT4), ('name', TEXT)], [])
+    assert list(df.columns) == ['id', 'name'] and len(df) == 0
+
+
+def test_errors():
+    with pytest.raises(ValueError):
+        sink_frame([('id', INT4), ('other', INT4)], [row(struct.pack('>i', 1))])
+    sink = BinarySink([('id', INT4)])
+    sink.write(b'x' * len(HEADER))
+    with pytest.raises(ValueError):
+        sink.frame()
+    with pytest.raises(UnsupportedType):
+        sink_frame([('tags', 1009)], [row(b'\x00' * 4)])
+    assert unsupported_columns([('id', INT4), ('tags', 1009), ('name', TEXT)]) == ['tags']
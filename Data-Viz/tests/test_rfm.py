@@ -0,0 +1,80 @@
+"""RFM features from event frames, in one pass and accumulated chunk by chunk."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from common import rfm
+
+
+def events(rows):
+    return pd.DataFrame(rows, columns=['user_id', 'event_time', 'purchase', 'price']).astype(
+        {'user_id': 'int32', 'event_time': 'datetime64[us]', 'purchase': bool, 'price': 'float32'})
+
+
+SMALL = events([
+    (7, '2023-02-27 10:00:00', False, 3.5),
+    (7, '2023-02-27 11:00:00', True, 3.5),
+    (7, '2023-02-28 09:00:00', True, 0.1),
+    (7, '2023-01-15 08:00:00', True, np.nan),
+    (3, '2022-12-31 23:59:59', False, 1.0),
+])
+
+
+def test_compute_features():
+    df = rfm.compute_features(SMALL, reference='2023-03-01')
+    assert df['user_id'].tolist() == [3, 7]
+    user = df.set_index('user_id').loc[7]
+    assert user['visit_count'] == 4
+    assert user['days_active'] == 3 and user['active_months'] == 2
+    assert user['purchase_count'] == 3
+    # a purchase without a price counts, but adds nothing; float32 sums to the cent
+    assert user['total_spent'] == 3.6 and user['monetary'] == 3.6
+    assert user['first_visit'] == pd.Timestamp('2023-01-15 08:00')
+    assert user['last_visit'] == pd.Timestamp('2023-02-28 09:00')
+    assert user['recency'] == pd.Timedelta(hours=15)
+    assert user['recency_days'] == 0
+    assert user['avg_purchase_value'] == pytest.approx(1.2)
+    assert user['visits_per_purchase'] == pytest.approx(4 / 3)
+    assert user['avg_daily_visits'] == pytest.approx(4 / 3)
+
+    other = df.set_index('user_id').loc[3]
+    assert other['purchase_count'] == 0 and other['total_spent'] == 0
+    assert other['avg_purchase_value'] == 0 and other['visits_per_purchase'] == 0
+    # whole days before the reference, floored
+    assert other['recency_days'] == 59
+    assert other['time_span'] == pd.Timedelta(0)
+
+
+def test_reference_date_moves_recency():
+    earlier = rfm.compute_features(SMALL, reference='2023-03-01')
+    later = rfm.compute_features(SMALL, reference='2023-03-11')
+    assert (later['recency_days'] - earlier['recency_days']).tolist() == [10, 10]
+
+
+def test_chunks_match_one_pass(monkeypatch):
+    rng = np.random.default_rng(0)
+    rows = 20_000
+    seconds = rng.integers(0, 150 * 86400, rows)
+    many = pd.DataFrame({
+        'user_id': rng.integers(1, 700, rows).astype(np.int32),
+        'event_time': np.datetime64('2022-10-01', 's') + seconds.astype('timedelta64[s]'),
+        'purchase': rng.random(rows) < 0.2,
+        'price': np.round(rng.lognormal(1.0, 1.0, rows), 2).astype(np.float32)
+    })
+    whole = rfm.compute_features(many)
+
+    # compacting every few chunks exercises the merge of partial aggregates
+    monkeypatch.setattr(rfm, 'COMPACT_ROWS', 1500)
+    accumulator = rfm.FeatureAccumulator()
+    for start in range(0, rows, 1200):
+        accumulator.add(many.iloc[start:start + 1200])
+    accumulator.add(many.iloc[:0])
+    chunked = accumulator.features()
+    assert accumulator.rows == rows
+    pd.testing.assert_frame_equal(chunked, whole)
+
+
+def test_no_events():
+    df = rfm.compute_features(SMALL.iloc[:0])
+    assert len(df) == 0
+    assert 'recency_days' in df.columns and 'monetary' in df.columns
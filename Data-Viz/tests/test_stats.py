@@ -0,0 +1,93 @@
+"""StreamingStats moments and KLL quantiles, single pass and merged."""
+import math
+
+import numpy as np
+import pytest
+
+from common.stats import KLLSketch, StreamingStats, box_stats, kll_k_for
+
+RANK_ERROR = 0.01
+
+
+def rank_errors(values, sketch, qs):
+    """Normalized rank error of each sketched quantile against the sorted values."""
+    ordered = np.sort(values)
+    estimates = sketch.quantiles(qs)
+    return [abs(np.searchsorted(ordered, estimate, side='right') / len(ordered) - q)
+            for q, estimate in zip(qs, estimates)]
+
+
+@pytest.fixture
+def prices():
+    return np.random.default_rng(0).lognormal(1.5, 0.8, 200_000)
+
+
+def test_moments_of_merged_chunks_match_one_pass(prices):
+    single = StreamingStats(RANK_ERROR)
+    single.update(prices)
+
+    rng = np.random.default_rng(1)
+    merged = StreamingStats(RANK_ERROR, seed=rng)
+    for chunk in np.array_split(prices, 37):
+        part = StreamingStats(RANK_ERROR, seed=rng)
+        part.update(chunk)
+        merged.merge(part)
+
+    for stats in (single, merged):
+        desc = stats.describe()
+        assert desc['count'] == len(prices)
+        assert desc['mean'] == pytest.approx(prices.mean(), rel=1e-12)
+        assert desc['std'] == pytest.approx(prices.std(ddof=1), rel=1e-9)
+        assert desc['min'] == prices.min() and desc['max'] == prices.max()
+
+
+def test_nan_and_empty():
+    stats = StreamingStats()
+    stats.update([np.nan, np.nan])
+    stats.merge(StreamingStats())
+    desc = stats.describe()
+    assert desc['count'] == 0
+    assert all(math.isnan(desc[name]) for name in ('mean', 'std', 'min', '25%', '50%', '75%', 'max'))
+
+    stats.update([np.nan, 2.0, 4.0])
+    desc = stats.describe()
+    assert (desc['count'], desc['mean'], desc['min'], desc['max']) == (2, 3.0, 2.0, 4.0)
+
+
+def test_kll_rank_error(prices):
+    sketch = KLLSketch(kll_k_for(RANK_ERROR), seed=2)
+    for chunk in np.array_split(prices, 100):
+        sketch.update(chunk)
+    qs = [0.01, 0.25, 0.5, 0.75, 0.99]
+    assert max(rank_errors(prices, sketch, qs)) <= 2 * RANK_ERROR
+    # compacted, far fewer items than values are kept
+    assert sum(len(level) for level in sketch.levels) < len(prices) / 20
+
+
+def test_merged_sketches_keep_the_rank_error(prices):
+    rng = np.random.default_rng(3)
+    merged = KLLSketch(kll_k_for(RANK_ERROR), seed=rng)
+    for chunk in np.array_split(prices, 50):
+        part = KLLSketch(kll_k_for(RANK_ERROR), seed=rng)
+        part.update(chunk)
+        merged.merge(part)
+    assert max(rank_errors(prices, merged, [0.1, 0.25, 0.5, 0.75, 0.9])) <= 2 * RANK_ERROR
+
+
+def test_small_inputs_are_exact():
+    sketch = KLLSketch(kll_k_for(RANK_ERROR), seed=0)
+    sketch.update([5.0, 1.0, 3.0])
+    assert sketch.quantiles([0.0, 0.5, 1.0]) == [1.0, 3.0, 5.0]
+    assert all(math.isnan(value) for value in KLLSketch(8).quantiles([0.5]))
+
+
+def test_kll_k_grows_as_the_error_shrinks():
+    assert kll_k_for(0.001) > kll_k_for(0.005) > kll_k_for(0.05) >= 8
+
+
+def test_box_stats_caps_the_fliers():
+    values = np.concatenate([np.full(10000, 10.0), np.arange(1000.0, 3000.0)])
+    stats = box_stats(values, max_fliers=50)
+    assert len(stats['fliers']) == 50
+    assert stats['fliers'][0] == 1000.0 and stats['fliers'][-1] == 2999.0
+    assert stats['count'] == len(values)
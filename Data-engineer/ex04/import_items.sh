@@ -31,12 +31,29 @@ echo "Items table created (skipped if already exists)."
 
 echo "--- Importing data from ${ITEM_CSV_HOST_PATH} ---"
 
+# item.csv repeats some product_id, with category_code or brand missing on one
+# of the rows: load into a temp table and insert one row per product, merging
+# the duplicates field by field (MAX skips NULLs). Products already in items
+# are left alone, so running the script again adds nothing.
 TEMP_COPY_SQL_HOST="temp_item_import_command.sql"
-echo "\\copy items FROM '${ITEM_CSV_CONTAINER_PATH}' WITH (FORMAT csv, HEADER true);" > "$TEMP_COPY_SQL_HOST"
+cat > "$TEMP_COPY_SQL_HOST" << SQL
+CREATE TEMP TABLE temp_items (LIKE items);
+\\copy temp_items FROM '${ITEM_CSV_CONTAINER_PATH}' WITH (FORMAT csv, HEADER true);
+INSERT INTO items
+SELECT
+    product_id,
+    MAX(category_id),
+    MAX(category_code),
+    MAX(brand)
+FROM temp_items t
+WHERE product_id IS NOT NULL
+  AND NOT EXISTS (SELECT 1 FROM items i WHERE i.product_id = t.product_id)
+GROUP BY product_id;
+SQL
 
 echo "--- Running import command inside container (using \\copy) ---"
-docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\"" < "$TEMP_COPY_SQL_HOST"
-echo "Data imported into items table."
+docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -v ON_ERROR_STOP=1 -U \"$DB_USER\" -d \"$DB_NAME\"" < "$TEMP_COPY_SQL_HOST"
+echo "Data imported into items table (one row per product)."
 
 echo "--- Checking row count in items table ---"
 docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\" -c \"SELECT COUNT(*) FROM items;\""
@@ -0,0 +1,54 @@
+-- Partitioned layout of the customers table.
+-- One range partition per month of event_time, so a BETWEEN on event_time only
+-- reads the months it covers, plus indexes for the queries of Data-Viz:
+-- purchases in a time range, and per-user aggregates.
+
+-- Step 1: Parent table, partitioned by month of event_time
+CREATE TABLE IF NOT EXISTS customers (
+    event_time TIMESTAMP,
+    event_type VARCHAR(255),
+    product_id INTEGER,
+    price DECIMAL,
+    user_id INTEGER,
+    user_session VARCHAR(255)
+) PARTITION BY RANGE (event_time);
+
+-- Step 2: Monthly partitions, e.g. customers_2022_10 for October 2022
+CREATE OR REPLACE FUNCTION create_customers_partition(month DATE)
+RETURNS VOID
+LANGUAGE plpgsql AS $$
+DECLARE
+    first_day DATE := date_trunc('month', month)::date;
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF customers FOR VALUES FROM (%L) TO (%L)',
+        'customers_' || to_char(first_day, 'YYYY_MM'),
+        first_day,
+        (first_day + INTERVAL '1 month')::date
+    );
+END
+$$;
+
+CREATE OR REPLACE FUNCTION create_customers_partitions(first_month DATE, last_month DATE)
+RETURNS VOID
+LANGUAGE sql AS $$
+    SELECT create_customers_partition(month::date)
+    FROM generate_series(date_trunc('month', first_month), date_trunc('month', last_month), INTERVAL '1 month') AS month
+$$;
+
+SELECT create_customers_partitions('2022-10-01', '2023-02-01');
+
+-- rows outside the monthly partitions (or without event_time) land here
+CREATE TABLE IF NOT EXISTS customers_default PARTITION OF customers DEFAULT;
+
+-- Step 3: Indexes, declared once on the parent and created on every partition
+-- BRIN on the append-ordered timestamps: a few pages per partition
+CREATE INDEX IF NOT EXISTS customers_event_time_brin ON customers USING brin (event_time);
+
+-- purchases in a time range (chart.py, mustache.py, Building.py), index-only
+CREATE INDEX IF NOT EXISTS customers_purchase_time_idx ON customers (event_time)
+    INCLUDE (user_id, price)
+    WHERE event_type = 'purchase';
+
+-- per-user aggregates (elbow.py, Clustering.py) and per-user time ranges
+CREATE INDEX IF NOT EXISTS customers_user_time_idx ON customers (user_id, event_time);
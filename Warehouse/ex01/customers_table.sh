@@ -13,6 +13,12 @@ CONTAINER_PROJECT_ROOT_MOUNT_PATH="/csv_data"
 CSV_HOST_DIR="../subject/customer"
 CSV_CONTAINER_DIR="${CONTAINER_PROJECT_ROOT_MOUNT_PATH}/subject/customer"
 
+if [ "$1" == "--partitioned" ]; then
+echo "--- Creating customers table partitioned by month ---"
+# an existing unpartitioned table is kept; convert it with Data-Viz/migrate_partitions.py
+docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\"" < "$(dirname "$0")/customers_partitioned.sql"
+docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\" -c \"TRUNCATE TABLE customers;\""
+else
 echo "--- Creating customers table ---"
 docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\"" << EOF
 CREATE TABLE IF NOT EXISTS customers (
@@ -26,9 +32,14 @@ CREATE TABLE IF NOT EXISTS customers (
 
 TRUNCATE TABLE customers;
 EOF
+fi
 
 echo "Customers table created successfully."
 
+echo "--- Creating rollup tables and triggers ---"
+docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\"" < "$(dirname "$0")/rollups.sql"
+echo "Rollups will be updated incrementally as each CSV file is loaded."
+
 echo "--- Importing data from CSV files directly into customers table ---"
 
 TEMP_COPY_SQL_HOST="temp_customers_import.sql"
@@ -0,0 +1,219 @@
+-- Incrementally maintained rollups of the customers table.
+-- Statement-level triggers aggregate only the rows of each INSERT / COPY, so
+-- appending a monthly CSV costs as much as that month, not the whole history.
+
+-- Step 1: Rollup tables keyed by (day, event_type) and (month, event_type)
+CREATE TABLE IF NOT EXISTS customers_daily_rollup (
+    day DATE NOT NULL,
+    event_type VARCHAR(255) NOT NULL,
+    event_count BIGINT NOT NULL,
+    price_sum NUMERIC NOT NULL,
+    price_count BIGINT NOT NULL,
+    PRIMARY KEY (day, event_type)
+);
+
+CREATE TABLE IF NOT EXISTS customers_monthly_rollup (
+    month DATE NOT NULL,
+    event_type VARCHAR(255) NOT NULL,
+    event_count BIGINT NOT NULL,
+    price_sum NUMERIC NOT NULL,
+    price_count BIGINT NOT NULL,
+    PRIMARY KEY (month, event_type)
+);
+
+-- Distinct users are kept as HyperLogLog registers (1024 per key, ~3% error),
+-- one row per non-empty register. Sketches merge by taking MAX(rank).
+CREATE TABLE IF NOT EXISTS customers_daily_users (
+    day DATE NOT NULL,
+    event_type VARCHAR(255) NOT NULL,
+    register SMALLINT NOT NULL,
+    rank SMALLINT NOT NULL,
+    PRIMARY KEY (day, event_type, register)
+);
+
+CREATE TABLE IF NOT EXISTS customers_monthly_users (
+    month DATE NOT NULL,
+    event_type VARCHAR(255) NOT NULL,
+    register SMALLINT NOT NULL,
+    rank SMALLINT NOT NULL,
+    PRIMARY KEY (month, event_type, register)
+);
+
+-- Step 2: Estimate a distinct count from merged registers
+-- present = number of non-empty registers, inverse_sum = SUM(2^-rank) over them
+CREATE OR REPLACE FUNCTION hll_estimate(present BIGINT, inverse_sum DOUBLE PRECISION)
+RETURNS DOUBLE PRECISION
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT CASE
+        WHEN raw <= 2.5 * 1024 AND present < 1024 THEN 1024 * ln(1024.0 / (1024 - present))
+        ELSE raw
+    END
+    FROM (
+        SELECT 0.7213 / (1 + 1.079 / 1024) * 1024 * 1024
+               / (COALESCE(inverse_sum, 0) + (1024 - COALESCE(present, 0))) AS raw
+    ) AS estimate
+$$;
+
+-- Step 3: SQL that folds the rows of a relation into the rollups
+-- (used with the trigger transition table and with customers for a rebuild)
+CREATE OR REPLACE FUNCTION customers_rollup_sql(source TEXT)
+RETURNS TEXT
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT format($f$
+        WITH daily AS (
+            SELECT event_time::date AS day,
+                   event_type,
+                   COUNT(*) AS event_count,
+                   COALESCE(SUM(price), 0) AS price_sum,
+                   COUNT(price) AS price_count
+            FROM %1$I
+            WHERE event_time IS NOT NULL AND event_type IS NOT NULL
+            GROUP BY 1, 2
+        ),
+        daily_upsert AS (
+            INSERT INTO customers_daily_rollup AS r
+            SELECT * FROM daily
+            ON CONFLICT (day, event_type) DO UPDATE SET
+                event_count = r.event_count + EXCLUDED.event_count,
+                price_sum = r.price_sum + EXCLUDED.price_sum,
+                price_count = r.price_count + EXCLUDED.price_count
+        ),
+        hashed AS (
+            SELECT event_time::date AS day,
+                   event_type,
+                   hashint8(user_id::bigint) AS h
+            FROM %1$I
+            WHERE event_time IS NOT NULL AND event_type IS NOT NULL AND user_id IS NOT NULL
+        ),
+        registers AS (
+            -- low 10 bits pick the register, the next 22 bits give the rank
+            SELECT day,
+                   event_type,
+                   (h & 1023)::smallint AS register,
+                   MAX(23 - length(ltrim(((h >> 10) & 4194303)::bit(22)::text, '0')))::smallint AS rank
+            FROM hashed
+            GROUP BY 1, 2, 3
+        ),
+        daily_users_upsert AS (
+            INSERT INTO customers_daily_users AS u
+            SELECT * FROM registers
+            ON CONFLICT (day, event_type, register) DO UPDATE SET
+                rank = GREATEST(u.rank, EXCLUDED.rank)
+        ),
+        monthly_upsert AS (
+            INSERT INTO customers_monthly_rollup AS r
+            SELECT date_trunc('month', day)::date, event_type,
+                   SUM(event_count), SUM(price_sum), SUM(price_count)
+            FROM daily
+            GROUP BY 1, 2
+            ON CONFLICT (month, event_type) DO UPDATE SET
+                event_count = r.event_count + EXCLUDED.event_count,
+                price_sum = r.price_sum + EXCLUDED.price_sum,
+                price_count = r.price_count + EXCLUDED.price_count
+        )
+        INSERT INTO customers_monthly_users AS u
+        SELECT date_trunc('month', day)::date, event_type, register, MAX(rank)
+        FROM registers
+        GROUP BY 1, 2, 3
+        ON CONFLICT (month, event_type, register) DO UPDATE SET
+            rank = GREATEST(u.rank, EXCLUDED.rank)
+    $f$, source)
+$$;
+
+-- Step 4: Triggers keeping the rollups in sync with customers
+CREATE OR REPLACE FUNCTION customers_rollup_insert()
+RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    EXECUTE customers_rollup_sql('new_rows');
+    RETURN NULL;
+END
+$$;
+
+-- Deleted rows are subtracted from counts and sums. Sketches cannot forget a
+-- user, so they may overestimate until rebuild_customers_rollups() is run.
+CREATE OR REPLACE FUNCTION customers_rollup_delete()
+RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    WITH daily AS (
+        SELECT event_time::date AS day,
+               event_type,
+               COUNT(*) AS event_count,
+               COALESCE(SUM(price), 0) AS price_sum,
+               COUNT(price) AS price_count
+        FROM old_rows
+        WHERE event_time IS NOT NULL AND event_type IS NOT NULL
+        GROUP BY 1, 2
+    ),
+    daily_update AS (
+        UPDATE customers_daily_rollup r
+        SET event_count = r.event_count - d.event_count,
+            price_sum = r.price_sum - d.price_sum,
+            price_count = r.price_count - d.price_count
+        FROM daily d
+        WHERE r.day = d.day AND r.event_type = d.event_type
+    )
+    UPDATE customers_monthly_rollup r
+    SET event_count = r.event_count - m.event_count,
+        price_sum = r.price_sum - m.price_sum,
+        price_count = r.price_count - m.price_count
+    FROM (
+        SELECT date_trunc('month', day)::date AS month, event_type,
+               SUM(event_count) AS event_count, SUM(price_sum) AS price_sum, SUM(price_count) AS price_count
+        FROM daily
+        GROUP BY 1, 2
+    ) AS m
+    WHERE r.month = m.month AND r.event_type = m.event_type;
+
+    DELETE FROM customers_daily_rollup WHERE event_count <= 0;
+    DELETE FROM customers_monthly_rollup WHERE event_count <= 0;
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION customers_rollup_truncate()
+RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    TRUNCATE customers_daily_rollup, customers_monthly_rollup,
+             customers_daily_users, customers_monthly_users;
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION rebuild_customers_rollups()
+RETURNS VOID
+LANGUAGE plpgsql AS $$
+BEGIN
+    TRUNCATE customers_daily_rollup, customers_monthly_rollup,
+             customers_daily_users, customers_monthly_users;
+    EXECUTE customers_rollup_sql('customers');
+END
+$$;
+
+DROP TRIGGER IF EXISTS customers_rollup_insert ON customers;
+CREATE TRIGGER customers_rollup_insert
+AFTER INSERT ON customers
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION customers_rollup_insert();
+
+DROP TRIGGER IF EXISTS customers_rollup_delete ON customers;
+CREATE TRIGGER customers_rollup_delete
+AFTER DELETE ON customers
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION customers_rollup_delete();
+
+DROP TRIGGER IF EXISTS customers_rollup_truncate ON customers;
+CREATE TRIGGER customers_rollup_truncate
+AFTER TRUNCATE ON customers
+FOR EACH STATEMENT EXECUTE FUNCTION customers_rollup_truncate();
+
+-- Step 5: Populate the rollups once for data loaded before they existed
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM customers_daily_rollup) THEN
+        PERFORM rebuild_customers_rollups();
+    END IF;
+END
+$$;
@@ -0,0 +1,60 @@
+-- Deduplication of newly loaded rows only.
+-- Instead of rewriting the whole customers table with DISTINCT ON, the rows of
+-- a staging relation are inserted unless the same event is already among the
+-- staged rows or in customers. Only the time range covered by the new rows is
+-- read from customers, so the cost follows the new month, not the history.
+
+-- Step 1: BRIN index on event_time so the range lookup skips the other months
+CREATE INDEX IF NOT EXISTS customers_event_time_brin ON customers USING brin (event_time);
+
+-- Step 2: Insert the new events of a staging relation into customers
+-- window_seconds = 0 drops exact duplicates only. A larger window also drops
+-- near-duplicates: the same event (type, product, price, user, session) seen
+-- again within window_seconds of the previous one, e.g. double submits in the
+-- same second. Rows without an event_time are always kept.
+CREATE OR REPLACE FUNCTION insert_new_customers(source REGCLASS, window_seconds INTEGER DEFAULT 0)
+RETURNS BIGINT
+LANGUAGE plpgsql AS $$
+DECLARE
+    first_time TIMESTAMP;
+    last_time TIMESTAMP;
+    inserted BIGINT;
+BEGIN
+    EXECUTE format('SELECT MIN(event_time), MAX(event_time) FROM %s', source)
+    INTO first_time, last_time;
+
+    EXECUTE format($f$
+        WITH incoming AS (
+            SELECT event_time, event_type, product_id, price, user_id, user_session,
+                   ROW(event_type, product_id, price, user_id, user_session)::text AS event_key
+            FROM %s
+        ),
+        candidates AS (
+            SELECT *,
+                   lag(event_time) OVER (PARTITION BY event_key, event_time IS NULL ORDER BY event_time) AS previous_time
+            FROM incoming
+        ),
+        existing AS (
+            SELECT event_time,
+                   ROW(event_type, product_id, price, user_id, user_session)::text AS event_key
+            FROM customers
+            WHERE event_time BETWEEN $1 - make_interval(secs => $3) AND $2 + make_interval(secs => $3)
+        )
+        INSERT INTO customers (event_time, event_type, product_id, price, user_id, user_session)
+        SELECT event_time, event_type, product_id, price, user_id, user_session
+        FROM candidates s
+        WHERE (previous_time IS NULL OR s.event_time - previous_time > make_interval(secs => $3))
+          AND NOT EXISTS (
+              SELECT 1
+              FROM existing c
+              WHERE c.event_key = s.event_key
+                AND c.event_time BETWEEN s.event_time - make_interval(secs => $3)
+                                     AND s.event_time + make_interval(secs => $3)
+          )
+    $f$, source)
+    USING first_time, last_time, window_seconds;
+
+    GET DIAGNOSTICS inserted = ROW_COUNT;
+    RETURN inserted;
+END
+$$;
@@ -13,6 +13,17 @@ CONTAINER_PROJECT_ROOT_MOUNT_PATH="/csv_data"
 SQL_HOST_PATH="./ex03/fusion.sql"
 SQL_CONTAINER_PATH="${CONTAINER_PROJECT_ROOT_MOUNT_PATH}/ex03/fusion.sql"
 
+# fusion modes: default rewrites customers with one UPDATE,
+# --lazy exposes the join as the customers_items view,
+# --batched updates one day per transaction and resumes after an interruption
+MODE="${1:-}"
+ITEMS_SQL_CONTAINER_PATH="${CONTAINER_PROJECT_ROOT_MOUNT_PATH}/ex03/items.sql"
+LAZY_SQL_CONTAINER_PATH="${CONTAINER_PROJECT_ROOT_MOUNT_PATH}/ex03/fusion_lazy.sql"
+BATCHED_SQL_CONTAINER_PATH="${CONTAINER_PROJECT_ROOT_MOUNT_PATH}/ex03/fusion_batched.sql"
+BATCH_SIZE="1 day"
+# dead row versions are vacuumed after this many batches so their space is reused
+BATCHES_PER_VACUUM=7
+
 echo "--- Checking if customers table exists ---"
 CUSTOMERS_COUNT=$(docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\" -t -c \"SELECT COUNT(*) FROM information_schema.tables WHERE table_name = 'customers';\"")
 
@@ -21,6 +32,42 @@ if [ "$CUSTOMERS_COUNT" -eq 0 ]; then
   exit 1
 fi
 
+if [ "$MODE" == "--lazy" ]; then
+  echo "--- Loading items and creating the customers_items view ---"
+  docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\" -f \"$ITEMS_SQL_CONTAINER_PATH\" -f \"$LAZY_SQL_CONTAINER_PATH\""
+  echo "--- customers_items view count ---"
+  docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\" -c \"SELECT COUNT(*) AS rows_with_category FROM customers_items WHERE category_id IS NOT NULL;\""
+  echo "--- Script execution complete ---"
+  exit 0
+fi
+
+if [ "$MODE" == "--batched" ]; then
+  PENDING=$(docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\" -tA -c \"SELECT COUNT(*) FROM pg_tables WHERE tablename = 'customers_fusion_batches';\"")
+  if [ "$PENDING" -eq 1 ]; then
+    PENDING=$(docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\" -tA -c \"SELECT COUNT(*) FROM customers_fusion_batches WHERE updated_rows IS NULL;\"")
+  fi
+
+  # items are only reloaded for a new run, a resumed run keeps the items it started with
+  if [ "$PENDING" -eq 0 ]; then
+    echo "--- Loading items ---"
+    docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\" -f \"$ITEMS_SQL_CONTAINER_PATH\""
+  else
+    echo "--- Resuming fusion, $PENDING batches left ---"
+  fi
+  docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\" -q -f \"$BATCHED_SQL_CONTAINER_PATH\""
+
+  REMAINING=-1
+  while [ "$REMAINING" -ne 0 ]; do
+    REMAINING=$(docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\" -tA -c \"CALL fuse_customers_batches(INTERVAL '$BATCH_SIZE', $BATCHES_PER_VACUUM);\"")
+    docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\" -q -c \"VACUUM customers;\""
+  done
+  echo "--- Batched fusion completed ---"
+  docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\" -c \"SELECT COUNT(*) AS batches, SUM(updated_rows) AS updated_rows FROM customers_fusion_batches;\""
+  docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\" -c \"SELECT COUNT(*) AS rows_with_category FROM customers WHERE category_id IS NOT NULL;\""
+  echo "--- Script execution complete ---"
+  exit 0
+fi
+
 echo "--- Running fusion SQL script ---"
 docker exec -i "$DB_CONTAINER" bash -c "PGPASSWORD=\"$DB_PASSWORD\" psql -U \"$DB_USER\" -d \"$DB_NAME\" -f \"$SQL_CONTAINER_PATH\""
 
@@ -1,33 +1,6 @@
--- Step 1: Drop items table if it exists to start fresh
-DROP TABLE IF EXISTS items;
-
--- Step 2: Create items table
-CREATE TABLE items (
-    product_id INTEGER PRIMARY KEY,
-    category_id BIGINT,
-    category_code VARCHAR(255),
-    brand VARCHAR(255)
-);
-
--- Step 3: Create a temporary table to load data first
-CREATE TEMP TABLE temp_items (
-    product_id INTEGER,
-    category_id BIGINT,
-    category_code VARCHAR(255),
-    brand VARCHAR(255)
-);
-
--- Load data into temp table
-\copy temp_items FROM '/csv_data/subject/item/item.csv' WITH (FORMAT csv, HEADER true, DELIMITER ',')
-
--- Insert distinct records into items table
-INSERT INTO items
-SELECT DISTINCT ON (product_id) 
-    product_id, 
-    category_id, 
-    category_code, 
-    brand
-FROM temp_items;
+-- Steps 1-3: load items, merging duplicate products (defined once in items.sql,
+-- \ir resolves it next to this file)
+\ir items.sql
 
 -- Step 4: Alter customers table to add new columns from items
 ALTER TABLE customers
@@ -45,6 +18,3 @@ FROM
     items i
 WHERE 
     c.product_id = i.product_id;
-
--- Grant permissions
-GRANT ALL PRIVILEGES ON items TO jaehwkim;
@@ -0,0 +1,92 @@
+-- Batched fusion: the item columns are written into customers one event_time
+-- range at a time, each range in its own transaction.
+-- Finished ranges are recorded, so an interrupted run resumes where it stopped,
+-- and rows that already carry the right item data are not rewritten again.
+
+-- Step 1: Add the item columns (nullable without default: no table rewrite)
+ALTER TABLE customers
+ADD COLUMN IF NOT EXISTS category_id BIGINT,
+ADD COLUMN IF NOT EXISTS category_code VARCHAR(255),
+ADD COLUMN IF NOT EXISTS brand VARCHAR(255);
+
+-- each batch reads its time range through this index instead of a full scan
+CREATE INDEX IF NOT EXISTS customers_event_time_brin ON customers USING brin (event_time);
+
+-- Step 2: Planned batches; updated_rows stays NULL until the batch is done.
+-- The batch starting at '-infinity' stands for the rows without event_time.
+CREATE TABLE IF NOT EXISTS customers_fusion_batches (
+    batch_start TIMESTAMP PRIMARY KEY,
+    batch_end TIMESTAMP NOT NULL,
+    updated_rows BIGINT,
+    finished_at TIMESTAMPTZ
+);
+
+-- Step 3: Fuse up to max_batches pending batches and return how many remain.
+-- When no batch is pending, a new run is planned over the current time range.
+CREATE OR REPLACE PROCEDURE fuse_customers_batches(
+    batch_size INTERVAL DEFAULT '1 day',
+    max_batches INTEGER DEFAULT NULL,
+    INOUT remaining BIGINT DEFAULT NULL
+)
+LANGUAGE plpgsql AS $$
+DECLARE
+    batch RECORD;
+    total BIGINT;
+    updated BIGINT;
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM customers_fusion_batches WHERE updated_rows IS NULL) THEN
+        TRUNCATE customers_fusion_batches;
+        INSERT INTO customers_fusion_batches (batch_start, batch_end)
+        SELECT day, day + batch_size
+        FROM (SELECT date_trunc('day', MIN(event_time)) AS first_time, MAX(event_time) AS last_time FROM customers) AS bounds,
+             generate_series(first_time, last_time, batch_size) AS day;
+        INSERT INTO customers_fusion_batches (batch_start, batch_end)
+        VALUES ('-infinity', '-infinity');
+        COMMIT;
+    END IF;
+
+    SELECT COUNT(*) INTO total FROM customers_fusion_batches;
+
+    FOR batch IN
+        SELECT batch_start, batch_end
+        FROM customers_fusion_batches
+        WHERE updated_rows IS NULL
+        ORDER BY batch_start
+        LIMIT max_batches
+    LOOP
+        IF batch.batch_start = '-infinity' THEN
+            UPDATE customers c
+            SET
+                category_id = i.category_id,
+                category_code = i.category_code,
+                brand = i.brand
+            FROM items i
+            WHERE c.product_id = i.product_id
+              AND c.event_time IS NULL
+              AND (c.category_id, c.category_code, c.brand) IS DISTINCT FROM (i.category_id, i.category_code, i.brand);
+        ELSE
+            UPDATE customers c
+            SET
+                category_id = i.category_id,
+                category_code = i.category_code,
+                brand = i.brand
+            FROM items i
+            WHERE c.product_id = i.product_id
+              AND c.event_time >= batch.batch_start AND c.event_time < batch.batch_end
+              AND (c.category_id, c.category_code, c.brand) IS DISTINCT FROM (i.category_id, i.category_code, i.brand);
+        END IF;
+        GET DIAGNOSTICS updated = ROW_COUNT;
+
+        UPDATE customers_fusion_batches
+        SET updated_rows = updated, finished_at = now()
+        WHERE batch_start = batch.batch_start;
+
+        SELECT COUNT(*) INTO remaining FROM customers_fusion_batches WHERE updated_rows IS NULL;
+        RAISE NOTICE 'fused % .. %: % rows (% of % batches done)',
+            batch.batch_start, batch.batch_end, updated, total - remaining, total;
+        COMMIT;
+    END LOOP;
+
+    SELECT COUNT(*) INTO remaining FROM customers_fusion_batches WHERE updated_rows IS NULL;
+END
+$$;
@@ -0,0 +1,19 @@
+-- Lazy fusion: customers joined with items at query time.
+-- Nothing in customers is rewritten; the join probes the items primary key
+-- (product_id), so the view costs no extra disk and always reflects both tables.
+
+CREATE OR REPLACE VIEW customers_items AS
+SELECT
+    c.event_time,
+    c.event_type,
+    c.product_id,
+    c.price,
+    c.user_id,
+    c.user_session,
+    i.category_id,
+    i.category_code,
+    i.brand
+FROM customers c
+LEFT JOIN items i ON i.product_id = c.product_id;
+
+GRANT ALL PRIVILEGES ON customers_items TO jaehwkim;
@@ -0,0 +1,41 @@
+-- Load item.csv into the items table shared by every fusion mode.
+-- CASCADE drops the lazy customers_items view, fusion_lazy.sql recreates it.
+
+-- Step 1: Drop items table if it exists to start fresh
+DROP TABLE IF EXISTS items CASCADE;
+
+-- Step 2: Create items table (the primary key is the product_id index of the join)
+CREATE TABLE items (
+    product_id INTEGER PRIMARY KEY,
+    category_id BIGINT,
+    category_code VARCHAR(255),
+    brand VARCHAR(255)
+);
+
+-- Step 3: Create a temporary table to load data first
+CREATE TEMP TABLE temp_items (
+    product_id INTEGER,
+    category_id BIGINT,
+    category_code VARCHAR(255),
+    brand VARCHAR(255)
+);
+
+-- Load data into temp table
+\copy temp_items FROM '/csv_data/subject/item/item.csv' WITH (FORMAT csv, HEADER true, DELIMITER ',')
+
+-- Insert one row per product, merging duplicates field by field:
+-- MAX() skips NULLs, so a complete row never loses to one missing its brand
+INSERT INTO items
+SELECT
+    product_id,
+    MAX(category_id),
+    MAX(category_code),
+    MAX(brand)
+FROM temp_items
+WHERE product_id IS NOT NULL
+GROUP BY product_id;
+
+ANALYZE items;
+
+-- Grant permissions
+GRANT ALL PRIVILEGES ON items TO jaehwkim;